@@ -0,0 +1,108 @@
+"""
+Motor de Conflitos de Agenda por Intervalos
+Calcula os slots livres de um profissional tratando cada ocupação como um
+intervalo semiaberto [inicio, fim):
+
+    agendamento -> [data_hora, data_hora + servico_duracao_minutos)
+    bloqueio    -> [inicio, fim)   (pode atravessar vários dias)
+
+As ocupações são ordenadas e mescladas uma única vez; cada slot é verificado
+com busca binária sobre os intervalos mesclados, em O((n + m) log m) para
+n slots e m ocupações.
+
+USO:
+    from agenda_intervalos import mesclar_intervalos, filtrar_slots_livres
+
+    ocupados = mesclar_intervalos(intervalos)
+    livres = filtrar_slots_livres(slots, timedelta(minutes=60), ocupados)
+
+BENCHMARK:
+    python agenda_intervalos.py
+"""
+
+from bisect import bisect_left
+from datetime import datetime, timedelta
+from typing import Iterable, List, Tuple
+
+Intervalo = Tuple[datetime, datetime]
+
+
+def mesclar_intervalos(intervalos: Iterable[Intervalo]) -> List[Intervalo]:
+    """Ordena e une intervalos sobrepostos ou encostados. Intervalos vazios são descartados."""
+    mesclados: List[Intervalo] = []
+    for inicio, fim in sorted(i for i in intervalos if i[1] > i[0]):
+        if mesclados and inicio <= mesclados[-1][1]:
+            if fim > mesclados[-1][1]:
+                mesclados[-1] = (mesclados[-1][0], fim)
+        else:
+            mesclados.append((inicio, fim))
+    return mesclados
+
+
+def conflita(inicio: datetime, fim: datetime, ocupados: List[Intervalo], inicios: List[datetime]) -> bool:
+    """
+    Indica se [inicio, fim) sobrepõe algum intervalo de `ocupados` (já mesclado).
+    `inicios` é a lista dos inícios de `ocupados`, usada na busca binária.
+    """
+    # Último intervalo ocupado que começa antes do fim do slot
+    indice = bisect_left(inicios, fim) - 1
+    return indice >= 0 and ocupados[indice][1] > inicio
+
+
+def filtrar_slots_livres(slots: List[datetime], duracao: timedelta, ocupados: List[Intervalo]) -> List[datetime]:
+    """Mantém apenas os slots [slot, slot + duracao) que não sobrepõem nenhum intervalo ocupado."""
+    if not ocupados:
+        return list(slots)
+    inicios = [inicio for inicio, _ in ocupados]
+    return [slot for slot in slots if not conflita(slot, slot + duracao, ocupados, inicios)]
+
+
+# =================================================================================
+# BENCHMARK
+# =================================================================================
+
+def _filtrar_slots_ingenuo(slots: List[datetime], duracao: timedelta, intervalos: List[Intervalo]) -> List[datetime]:
+    """Referência O(slots × ocupações), usada só para comparação no benchmark."""
+    return [
+        slot for slot in slots
+        if not any(inicio < slot + duracao and slot < fim for inicio, fim in intervalos)
+    ]
+
+
+def _benchmark(dias: int = 31, agendamentos_por_dia: int = 12, bloqueios: int = 40, repeticoes: int = 5):
+    import random
+    import timeit
+
+    random.seed(42)
+    base = datetime(2025, 1, 1)
+    duracao = timedelta(minutes=15)
+
+    slots = [
+        base + timedelta(days=d, hours=7, minutes=15 * i)
+        for d in range(dias) for i in range(14 * 4)
+    ]
+    intervalos: List[Intervalo] = []
+    for d in range(dias):
+        for _ in range(agendamentos_por_dia):
+            inicio = base + timedelta(days=d, hours=7, minutes=random.randrange(0, 14 * 60, 5))
+            intervalos.append((inicio, inicio + timedelta(minutes=random.choice((15, 30, 45, 60, 90)))))
+    for _ in range(bloqueios):
+        inicio = base + timedelta(minutes=random.randrange(0, dias * 24 * 60, 30))
+        intervalos.append((inicio, inicio + timedelta(hours=random.choice((1, 4, 26)))))
+
+    esperado = _filtrar_slots_ingenuo(slots, duracao, intervalos)
+    obtido = filtrar_slots_livres(slots, duracao, mesclar_intervalos(intervalos))
+    assert obtido == esperado, "Motor de intervalos divergiu da referência"
+
+    tempo_ingenuo = timeit.timeit(lambda: _filtrar_slots_ingenuo(slots, duracao, intervalos), number=repeticoes)
+    tempo_intervalos = timeit.timeit(
+        lambda: filtrar_slots_livres(slots, duracao, mesclar_intervalos(intervalos)), number=repeticoes
+    )
+
+    print(f"Slots: {len(slots)} | Ocupações: {len(intervalos)} | Livres: {len(obtido)}")
+    print(f"Ingênuo:    {tempo_ingenuo / repeticoes * 1000:8.2f} ms")
+    print(f"Intervalos: {tempo_intervalos / repeticoes * 1000:8.2f} ms")
+
+
+if __name__ == "__main__":
+    _benchmark()
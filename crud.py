@@ -4,12 +4,13 @@ import schemas
 from datetime import datetime, date, time, timedelta, timezone
 from zoneinfo import ZoneInfo
 import pytz
-from typing import Optional, List, Dict, Union
+from typing import Optional, List, Dict, Tuple, Union
 from crypto_utils import encrypt_data, decrypt_data
+from agenda_intervalos import mesclar_intervalos, filtrar_slots_livres
 
 
 # --- INÍCIO DA CORREÇÃO ---
-from fastapi import HTTPException
+from fastapi import BackgroundTasks, HTTPException
 # --- FIM DA CORREÇÃO ---
 
 
@@ -18,9 +19,18 @@ from fastapi import HTTPException
 from pydantic import BaseModel
 
 from firebase_admin import firestore, messaging, auth
+import copy
+import hashlib
+import json
 import logging
+import os
 import secrets
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from firebase_admin.firestore import transactional
+from google.api_core.exceptions import AlreadyExists, NotFound
+from google.rpc import code_pb2
+from google.cloud.firestore_v1.bulk_writer import BulkWriterOptions
 
 # --- IMPORT DO ACK: compatível com pacote ou script ---
 try:
@@ -99,6 +109,47 @@ def buscar_usuario_por_firebase_uid(db: firestore.client, firebase_uid: str) ->
         return None
 
 
+def buscar_usuarios_por_firebase_uids(
+    db: firestore.client,
+    firebase_uids: List[str],
+    campos: Optional[List[str]] = None
+) -> Dict[str, Dict]:
+    """
+    Versão em lote de `buscar_usuario_por_firebase_uid` para listagens: consultas
+    `in` de 30 UIDs por vez, nome e telefone descriptografados em uma única passada
+    e sem logs por usuário. `campos` restringe os campos lidos de cada documento.
+    Retorna {firebase_uid: usuario}.
+    """
+    uids = list(dict.fromkeys(uid for uid in firebase_uids if uid))
+    usuarios = {}
+    for i in range(0, len(uids), 30):
+        query = db.collection('usuarios').where('firebase_uid', 'in', uids[i:i + 30])
+        if campos:
+            query = query.select(list(set(campos) | {'firebase_uid'}))
+        for doc in query.stream():
+            user_doc = doc.to_dict()
+            user_doc['id'] = doc.id
+            usuarios.setdefault(user_doc['firebase_uid'], user_doc)
+
+    falhas = 0
+    for user_doc in usuarios.values():
+        if user_doc.get('nome'):
+            try:
+                user_doc['nome'] = decrypt_data(user_doc['nome'])
+            except Exception:
+                user_doc['nome'] = '[Erro na descriptografia do nome]'
+                falhas += 1
+        if user_doc.get('telefone'):
+            try:
+                user_doc['telefone'] = decrypt_data(user_doc['telefone'])
+            except Exception:
+                user_doc['telefone'] = None
+                falhas += 1
+    if falhas:
+        logger.warning(f"⚠️ {falhas} campos não puderam ser descriptografados na busca em lote de {len(usuarios)} usuários.")
+    return usuarios
+
+
 def criar_ou_atualizar_usuario(db: firestore.client, user_data: schemas.UsuarioSync) -> Dict:
     """
     Cria ou atualiza um usuário no Firestore, criptografando dados sensíveis.
@@ -118,8 +169,7 @@ def criar_ou_atualizar_usuario(db: firestore.client, user_data: schemas.UsuarioS
                 "nome": nome_criptografado, 
                 "email": user_data.email, 
                 "firebase_uid": user_data.firebase_uid,
-                "roles": {"platform": "super_admin"}, 
-                "fcm_tokens": []
+                "roles": {"platform": "super_admin"}
             }
             if telefone_criptografado:
                 user_dict['telefone'] = telefone_criptografado
@@ -266,8 +316,7 @@ def criar_ou_atualizar_usuario(db: firestore.client, user_data: schemas.UsuarioS
             "nome": nome_criptografado, 
             "email": user_data.email, 
             "firebase_uid": user_data.firebase_uid,
-            "roles": {negocio_id: role}, 
-            "fcm_tokens": []
+            "roles": {negocio_id: role}
         }
         if telefone_criptografado:
             user_dict['telefone'] = telefone_criptografado
@@ -358,74 +407,377 @@ def _is_apns_token(token: str) -> bool:
     return True
 
 
-def _limpar_tokens_duplicados(tokens: List[str]) -> List[str]:
-    """Remove duplicatas mantendo apenas a última ocorrência de cada token."""
-    # Usa dict para manter ordem de inserção (Python 3.7+) e eliminar duplicatas
-    seen = {}
-    for token in tokens:
-        seen[token] = True
-    return list(seen.keys())
+# ---------------------------------------------------------------------
+# REGISTRO DE DISPOSITIVOS (device_tokens)
+# ---------------------------------------------------------------------
+# Cada token de push vira um documento `device_tokens/{sha256(token)}` com o dono,
+# a plataforma, os negócios do usuário e o último registro. Isso torna o registro
+# uma escrita idempotente (um único set, sem leituras), a invalidação um delete
+# direto pelo hash e permite buscar os tokens de vários destinatários com uma
+# query `in`. Os arrays `fcm_tokens`/`apns_tokens` do perfil não são mais gravados;
+# tokens antigos que só existem neles são removidos com ArrayRemove na limpeza.
+
+DEVICE_TOKENS_COLLECTION = 'device_tokens'
+_CAMPO_TOKENS_POR_PLATAFORMA = {'fcm': 'fcm_tokens', 'apns': 'apns_tokens'}
+
+
+def _hash_device_token(token: str) -> str:
+    """ID determinístico do documento de registro para um token."""
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def registrar_device_token(
+    db: firestore.client,
+    usuario_id: str,
+    firebase_uid: str,
+    token: str,
+    plataforma: str,
+    roles: Optional[Dict[str, str]] = None,
+    status_por_negocio: Optional[Dict[str, str]] = None
+):
+    """
+    Registra (ou renova) um token de dispositivo com um único `set()` no documento
+    do token. Se o dispositivo trocou de dono, o documento simplesmente passa a
+    apontar para o novo usuário, então o dono anterior deixa de recebê-lo.
+    Tokens FCM também são inscritos nos tópicos dos negócios/roles em que o usuário está ativo.
+    """
+    topicos = _topicos_do_usuario(roles, status_por_negocio) if plataforma == 'fcm' else []
+    db.collection(DEVICE_TOKENS_COLLECTION).document(_hash_device_token(token)).set({
+        'token': token,
+        'plataforma': plataforma,
+        'usuario_id': usuario_id,
+        'firebase_uid': firebase_uid,
+        'negocio_ids': [negocio_id for negocio_id in (roles or {}) if negocio_id != 'platform'],
+        'topicos': topicos,
+        'last_seen': firestore.SERVER_TIMESTAMP,
+    })
+
+    for topico in topicos:
+        _inscrever_em_topico([token], topico)
+
+
+def invalidar_device_token(db: firestore.client, token: str, topicos: Optional[List[str]] = None) -> bool:
+    """
+    Remove um token do registro com um único `delete()` (com precondição de
+    existência). Retorna False se o token não estava registrado — nesse caso o
+    chamador pode limpar o array legado do perfil.
+    `topicos`: tópicos dos quais desinscrever o token (ex.: logout).
+    """
+    doc_ref = db.collection(DEVICE_TOKENS_COLLECTION).document(_hash_device_token(token))
+    try:
+        doc_ref.delete(option=db.write_option(exists=True))
+        removido = True
+    except NotFound:
+        removido = False
+
+    for topico in topicos or []:
+        _desinscrever_de_topico([token], topico)
+    return removido
+
+
+def _remover_token_legado(db: firestore.client, usuario_id: str, token: str, plataforma: str):
+    """Remove um token que só existe no array legado do perfil (antes da migração)."""
+    db.collection('usuarios').document(usuario_id).set({
+        _CAMPO_TOKENS_POR_PLATAFORMA[plataforma]: firestore.ArrayRemove([token])
+    }, merge=True)
+
+
+def buscar_tokens_por_usuarios(db: firestore.client, usuario_ids: List[str]) -> Dict[str, Dict[str, List[str]]]:
+    """
+    Busca os tokens de vários usuários de uma vez (uma query `in` a cada 30 IDs).
+    Retorna {usuario_id: {"fcm": [...], "apns": [...]}}; usuários sem tokens
+    aparecem com listas vazias.
+    """
+    resultado = {uid: {'fcm': [], 'apns': []} for uid in usuario_ids}
+    ids = list(resultado.keys())
+    for i in range(0, len(ids), 30):
+        query = db.collection(DEVICE_TOKENS_COLLECTION).where('usuario_id', 'in', ids[i:i + 30])
+        for doc in query.stream():
+            dados = doc.to_dict()
+            tokens = resultado.get(dados.get('usuario_id'))
+            if tokens is not None and dados.get('plataforma') in tokens:
+                tokens[dados['plataforma']].append(dados['token'])
+    return resultado
+
+
+def buscar_tokens_do_usuario(db: firestore.client, usuario_id: str) -> Tuple[List[str], List[str]]:
+    """Atalho de `buscar_tokens_por_usuarios` para um destinatário: (tokens_fcm, tokens_apns)."""
+    tokens = buscar_tokens_por_usuarios(db, [usuario_id])[usuario_id]
+    return tokens['fcm'], tokens['apns']
+
+
+def migrar_tokens_para_registro(db: firestore.client) -> Dict[str, int]:
+    """
+    Migração única: copia os arrays `fcm_tokens`/`apns_tokens` existentes para
+    a coleção `device_tokens`. Pode ser executada mais de uma vez sem efeito colateral.
+    """
+    stats = {"usuarios": 0, "tokens": 0}
+    tokens_por_topico: Dict[str, List[str]] = {}
+    batch = db.batch()
+    pendentes = 0
+    for usuario_doc in db.collection('usuarios').stream():
+        dados = usuario_doc.to_dict() or {}
+        roles = dados.get('roles') or {}
+        negocio_ids = [negocio_id for negocio_id in roles if negocio_id != 'platform']
+        possui_tokens = False
+        for plataforma, campo in _CAMPO_TOKENS_POR_PLATAFORMA.items():
+            topicos = _topicos_do_usuario(roles, dados.get('status_por_negocio')) if plataforma == 'fcm' else []
+            for token in dados.get(campo, []) or []:
+                batch.set(db.collection(DEVICE_TOKENS_COLLECTION).document(_hash_device_token(token)), {
+                    'token': token,
+                    'plataforma': plataforma,
+                    'usuario_id': usuario_doc.id,
+                    'firebase_uid': dados.get('firebase_uid'),
+                    'negocio_ids': negocio_ids,
+                    'topicos': topicos,
+                    'last_seen': firestore.SERVER_TIMESTAMP,
+                })
+                for topico in topicos:
+                    tokens_por_topico.setdefault(topico, []).append(token)
+                pendentes += 1
+                stats["tokens"] += 1
+                possui_tokens = True
+                if pendentes >= 400:
+                    batch.commit()
+                    batch = db.batch()
+                    pendentes = 0
+        if possui_tokens:
+            stats["usuarios"] += 1
+    if pendentes:
+        batch.commit()
+    for topico, tokens in tokens_por_topico.items():
+        _inscrever_em_topico(tokens, topico)
+    logger.info(f"📱 Migração de tokens concluída: {stats}")
+    return stats
 
 
 # ---------------------------------------------------------------------
-# FUNÇÕES DE GERENCIAMENTO DE FCM TOKENS (CORRIGIDAS)
+# TÓPICOS FCM POR NEGÓCIO/ROLE E AVISOS (BROADCAST)
 # ---------------------------------------------------------------------
+# Cada token FCM fica inscrito em `negocio_{id}_{role}` e `negocio_{id}_todos`.
+# Um aviso é enviado UMA vez por tópico (custo independente do tamanho do
+# público) e gravado em `negocios/{id}/avisos`; o histórico de cada destinatário
+# é preenchido em segundo plano logo após o envio, fora do caminho de leitura.
+
+TOPICO_TODOS = 'todos'
+ROLES_NEGOCIO = ['cliente', 'profissional', 'admin', 'tecnico', 'medico']
+
+
+def _nome_topico(negocio_id: str, role: str) -> str:
+    return f"negocio_{negocio_id}_{role}"
+
+
+def _topicos_do_usuario(
+    roles: Optional[Dict[str, str]],
+    status_por_negocio: Optional[Dict[str, str]] = None
+) -> List[str]:
+    """Tópicos em que os dispositivos de um usuário devem estar inscritos (negócios em que está inativo ficam de fora)."""
+    topicos = []
+    for negocio_id, role in (roles or {}).items():
+        if negocio_id == 'platform' or not role:
+            continue
+        if (status_por_negocio or {}).get(negocio_id) == 'inativo':
+            continue
+        topicos.append(_nome_topico(negocio_id, role))
+        topicos.append(_nome_topico(negocio_id, TOPICO_TODOS))
+    return topicos
+
+
+def _inscrever_em_topico(tokens: List[str], topico: str):
+    """Inscreve tokens FCM em um tópico (a API aceita até 1000 tokens por chamada)."""
+    for i in range(0, len(tokens), 1000):
+        try:
+            resposta = messaging.subscribe_to_topic(tokens[i:i + 1000], topico)
+            if resposta.failure_count:
+                logger.warning(f"⚠️ {resposta.failure_count} token(s) não inscritos no tópico {topico}")
+        except Exception as e:
+            logger.error(f"Erro ao inscrever tokens no tópico {topico}: {e}")
+
 
-def adicionar_fcm_token(db: firestore.client, firebase_uid: str, fcm_token: str):
+def _desinscrever_de_topico(tokens: List[str], topico: str):
+    """Remove tokens FCM de um tópico."""
+    for i in range(0, len(tokens), 1000):
+        try:
+            messaging.unsubscribe_from_topic(tokens[i:i + 1000], topico)
+        except Exception as e:
+            logger.error(f"Erro ao remover tokens do tópico {topico}: {e}")
+
+
+def _sincronizar_topicos_role(
+    db: firestore.client,
+    usuario_id: str,
+    negocio_id: str,
+    role_antiga: Optional[str],
+    role_nova: Optional[str]
+):
     """
-    Adiciona/atualiza um FCM token para um usuário.
+    Move os dispositivos FCM do usuário do tópico da role antiga para o da nova.
+    `role_nova=None` tira os dispositivos de todos os tópicos do negócio (usuário
+    inativado); `role_antiga=None` só inscreve (usuário reativado).
+    """
+    if role_antiga == role_nova:
+        return
+    topico_todos = _nome_topico(negocio_id, TOPICO_TODOS)
+    sair = [_nome_topico(negocio_id, role_antiga)] if role_antiga else []
+    entrar = [_nome_topico(negocio_id, role_nova), topico_todos] if role_nova else []
+    if not role_nova and role_antiga:
+        sair.append(topico_todos)
+
+    query = db.collection(DEVICE_TOKENS_COLLECTION).where('usuario_id', '==', usuario_id)
+    docs = [doc for doc in query.stream() if doc.to_dict().get('plataforma') == 'fcm']
+    if not docs:
+        return
+
+    tokens = [doc.to_dict()['token'] for doc in docs]
+    for topico in sair:
+        _desinscrever_de_topico(tokens, topico)
+    for topico in entrar:
+        _inscrever_em_topico(tokens, topico)
+
+    batch = db.batch()
+    for doc in docs:
+        if sair:
+            batch.update(doc.reference, {'topicos': firestore.ArrayRemove(sair)})
+        if entrar:
+            batch.update(doc.reference, {'topicos': firestore.ArrayUnion(entrar)})
+    batch.commit()
+    logger.info(f"📢 Tópicos de {len(tokens)} dispositivo(s) do usuário {usuario_id} atualizados: -{sair} +{entrar}")
+
 
-    CORREÇÕES IMPLEMENTADAS:
-    1. Remove ArrayUnion - usa SET direto com merge
-    2. Valida que o token é realmente FCM (não APNs)
-    3. Remove duplicatas automaticamente
-    4. Mantém apenas os últimos 5 tokens (limpa tokens antigos)
-    5. Remove tokens inválidos do banco
+def enviar_aviso_negocio(
+    db: firestore.client,
+    negocio_id: str,
+    titulo: str,
+    corpo: str,
+    roles: Optional[List[str]],
+    autor_id: str,
+    background_tasks: Optional[BackgroundTasks] = None
+) -> Dict:
     """
-    try:
-        logger.info(f"🔥 ADICIONANDO FCM TOKEN - UID: {firebase_uid}, Token: {fcm_token[:20]}...")
+    Envia um aviso para todo o negócio (roles vazio) ou para roles específicas.
+    Faz um envio FCM por tópico e uma única escrita no feed de avisos do negócio;
+    o histórico dos destinatários é preenchido depois da resposta quando
+    `background_tasks` é informado.
+    """
+    roles = roles or []
+    invalidas = [role for role in roles if role not in ROLES_NEGOCIO]
+    if invalidas:
+        raise ValueError(f"Role(s) inválida(s): {', '.join(invalidas)}.")
+
+    aviso_ref = db.collection('negocios').document(negocio_id).collection('avisos').document()
+    aviso_ref.set({
+        "title": titulo,
+        "body": corpo,
+        "roles": roles,
+        "autor_id": autor_id,
+        "data_criacao": firestore.SERVER_TIMESTAMP
+    })
 
-        # VALIDAÇÃO: Verifica se é realmente um FCM token
-        if not _is_fcm_token(fcm_token):
-            logger.error(f"❌ Token inválido ou não é FCM: {fcm_token[:30]}...")
-            return
+    topicos = [_nome_topico(negocio_id, role) for role in roles] or [_nome_topico(negocio_id, TOPICO_TODOS)]
+    data_payload = {"tipo": "AVISO_NEGOCIO", "aviso_id": aviso_ref.id, "negocio_id": negocio_id}
+    enviados = 0
+    for topico in topicos:
+        try:
+            messaging.send(messaging.Message(
+                notification=messaging.Notification(title=titulo, body=corpo),
+                data=data_payload,
+                topic=topico,
+                webpush=messaging.WebpushConfig(
+                    notification=messaging.WebpushNotification(tag=f"AVISO_NEGOCIO-aviso-{aviso_ref.id}")
+                )
+            ))
+            enviados += 1
+        except Exception as e:
+            logger.error(f"Erro ao enviar aviso {aviso_ref.id} para o tópico {topico}: {e}")
 
-        user_doc = buscar_usuario_por_firebase_uid(db, firebase_uid)
+    logger.info(f"📢 Aviso {aviso_ref.id} enviado para {enviados}/{len(topicos)} tópico(s) do negócio {negocio_id}")
 
-        if user_doc:
-            logger.info(f"✅ Usuário encontrado: ID={user_doc['id']}, Nome={user_doc.get('nome', 'N/A')[:20]}")
-            doc_ref = db.collection('usuarios').document(user_doc['id'])
+    if background_tasks is not None:
+        background_tasks.add_task(_distribuir_aviso_negocio, db, negocio_id, aviso_ref.id, titulo, corpo, roles)
+    else:
+        _distribuir_aviso_negocio(db, negocio_id, aviso_ref.id, titulo, corpo, roles)
+    return {"id": aviso_ref.id, "topicos": topicos, "enviados": enviados}
 
-            # Busca tokens existentes
-            current_doc = doc_ref.get()
-            current_data = current_doc.to_dict() or {}
-            existing_tokens = current_data.get('fcm_tokens', [])
 
-            # Remove o token se já existir (para reposicioná-lo no final como "mais recente")
-            if fcm_token in existing_tokens:
-                existing_tokens.remove(fcm_token)
+def _distribuir_aviso_negocio(
+    db: firestore.client,
+    negocio_id: str,
+    aviso_id: str,
+    titulo: str,
+    corpo: str,
+    roles: List[str]
+) -> int:
+    """
+    Grava o aviso no histórico de cada destinatário ativo do negócio (IDs
+    determinísticos `AVISO:{id}`, então reexecutar não duplica nem recontabiliza).
+    Retorna quantos destinatários foram processados.
+    """
+    try:
+        query = db.collection('usuarios')\
+            .where(f'roles.{negocio_id}', 'in', roles or ROLES_NEGOCIO)\
+            .select(['status_por_negocio'])
+        destinatarios = [
+            doc.id for doc in query.stream()
+            if ((doc.to_dict() or {}).get('status_por_negocio') or {}).get(negocio_id) != 'inativo'
+        ]
+        dados = {
+            "title": titulo,
+            "body": corpo,
+            "tipo": "AVISO_NEGOCIO",
+            "relacionado": {"aviso_id": aviso_id, "negocio_id": negocio_id},
+            "lida": False,
+            "data_criacao": firestore.SERVER_TIMESTAMP
+        }
+        if destinatarios:
+            with ThreadPoolExecutor(max_workers=min(len(destinatarios), 8)) as executor:
+                list(executor.map(
+                    lambda usuario_id: _persistir_notificacao(db, usuario_id, dict(dados), f"AVISO:{aviso_id}"),
+                    destinatarios
+                ))
+        logger.info(f"📢 Aviso {aviso_id} adicionado ao histórico de {len(destinatarios)} usuário(s) do negócio {negocio_id}")
+        return len(destinatarios)
+    except Exception as e:
+        logger.error(f"Erro ao distribuir o aviso {aviso_id} do negócio {negocio_id}: {e}")
+        return 0
+
 
-            # Adiciona o novo token no final
-            existing_tokens.append(fcm_token)
+# ---------------------------------------------------------------------
+# FUNÇÕES DE GERENCIAMENTO DE FCM TOKENS (CORRIGIDAS)
+# ---------------------------------------------------------------------
 
-            # Remove duplicatas
-            existing_tokens = _limpar_tokens_duplicados(existing_tokens)
+def adicionar_fcm_token(
+    db: firestore.client,
+    firebase_uid: str,
+    fcm_token: str,
+    usuario_id: Optional[str] = None,
+    roles: Optional[Dict[str, str]] = None,
+    status_por_negocio: Optional[Dict[str, str]] = None
+):
+    """
+    Adiciona/atualiza um FCM token para um usuário.
 
-            # LIMITE: Mantém apenas os últimos 5 tokens (evita acúmulo infinito)
-            if len(existing_tokens) > 5:
-                tokens_removidos = existing_tokens[:-5]
-                logger.info(f"🧹 Removendo {len(tokens_removidos)} tokens antigos (limite de 5 atingido)")
-                existing_tokens = existing_tokens[-5:]
+    O token é validado e gravado no registro `device_tokens`. Quando o chamador já
+    conhece o `usuario_id` (ex.: usuário autenticado), o usuário não é buscado pelo UID.
+    """
+    try:
+        logger.info(f"🔥 ADICIONANDO FCM TOKEN - UID: {firebase_uid}, Token: {fcm_token[:20]}...")
 
-            # ATUALIZAÇÃO: Usa SET com merge em vez de ArrayUnion
-            doc_ref.set({
-                'fcm_tokens': existing_tokens
-            }, merge=True)
+        # VALIDAÇÃO: Verifica se é realmente um FCM token
+        if not _is_fcm_token(fcm_token):
+            logger.error(f"❌ Token inválido ou não é FCM: {fcm_token[:30]}...")
+            return
 
-            logger.info(f"✅ FCM Token salvo. Total de tokens FCM: {len(existing_tokens)}")
+        if not usuario_id:
+            user_doc = buscar_usuario_por_firebase_uid(db, firebase_uid)
+            if not user_doc:
+                logger.error(f"❌ USUÁRIO NÃO ENCONTRADO PARA UID: {firebase_uid}")
+                return
+            usuario_id = user_doc['id']
+            roles = roles or user_doc.get('roles')
+            status_por_negocio = status_por_negocio or user_doc.get('status_por_negocio')
 
-        else:
-            logger.error(f"❌ USUÁRIO NÃO ENCONTRADO PARA UID: {firebase_uid}")
+        registrar_device_token(db, usuario_id, firebase_uid, fcm_token, 'fcm', roles, status_por_negocio)
+        logger.info(f"✅ FCM Token registrado para o usuário {usuario_id}")
 
     except Exception as e:
         logger.error(f"❌ ERRO ao adicionar FCM token para o UID {firebase_uid}: {e}", exc_info=True)
@@ -438,27 +790,15 @@ def remover_fcm_token(db: firestore.client, firebase_uid: str, fcm_token: str):
     """
     try:
         user_doc = buscar_usuario_por_firebase_uid(db, firebase_uid)
-
-        if user_doc:
-            doc_ref = db.collection('usuarios').document(user_doc['id'])
-
-            # Busca tokens atuais
-            current_doc = doc_ref.get()
-            current_data = current_doc.to_dict() or {}
-            existing_tokens = current_data.get('fcm_tokens', [])
-
-            # Remove o token se existir
-            if fcm_token in existing_tokens:
-                existing_tokens.remove(fcm_token)
-
-                # Atualiza o documento
-                doc_ref.set({
-                    'fcm_tokens': existing_tokens
-                }, merge=True)
-
-                logger.info(f"🗑️ FCM Token removido. Tokens restantes: {len(existing_tokens)}")
-            else:
-                logger.warning(f"⚠️ Token não encontrado para remoção: {fcm_token[:20]}...")
+        topicos = _topicos_do_usuario(user_doc.get('roles')) if user_doc else []
+        if invalidar_device_token(db, fcm_token, topicos):
+            logger.info(f"🗑️ FCM Token removido: {fcm_token[:20]}...")
+        elif user_doc:
+            # Token anterior à migração: só existe no array do perfil
+            _remover_token_legado(db, user_doc['id'], fcm_token, 'fcm')
+            logger.info(f"🗑️ FCM Token legado removido do perfil: {fcm_token[:20]}...")
+        else:
+            logger.warning(f"⚠️ Token não encontrado para remoção: {fcm_token[:20]}...")
 
     except Exception as e:
         logger.error(f"❌ Erro ao remover FCM token para o UID {firebase_uid}: {e}", exc_info=True)
@@ -470,27 +810,9 @@ def remover_fcm_token_por_id_usuario(db: firestore.client, usuario_id: str, fcm_
     Útil para limpeza quando um envio de notificação falha.
     """
     try:
-        doc_ref = db.collection('usuarios').document(usuario_id)
-
-        # Busca tokens atuais
-        current_doc = doc_ref.get()
-        if not current_doc.exists:
-            logger.warning(f"⚠️ Usuário {usuario_id} não encontrado para remover token")
-            return
-
-        current_data = current_doc.to_dict() or {}
-        existing_tokens = current_data.get('fcm_tokens', [])
-
-        # Remove o token se existir
-        if fcm_token in existing_tokens:
-            existing_tokens.remove(fcm_token)
-
-            # Atualiza o documento
-            doc_ref.set({
-                'fcm_tokens': existing_tokens
-            }, merge=True)
-
-            logger.info(f"🗑️ FCM Token inválido removido do usuário {usuario_id}. Tokens restantes: {len(existing_tokens)}")
+        if not invalidar_device_token(db, fcm_token):
+            _remover_token_legado(db, usuario_id, fcm_token, 'fcm')
+        logger.info(f"🗑️ FCM Token inválido removido do usuário {usuario_id}.")
 
     except Exception as e:
         logger.error(f"❌ Erro ao remover FCM token do usuário {usuario_id}: {e}", exc_info=True)
@@ -500,16 +822,18 @@ def remover_fcm_token_por_id_usuario(db: firestore.client, usuario_id: str, fcm_
 # FUNÇÕES DE GERENCIAMENTO DE APNS TOKENS (CORRIGIDAS)
 # ---------------------------------------------------------------------
 
-def adicionar_apns_token(db: firestore.client, firebase_uid: str, apns_token: str):
+def adicionar_apns_token(
+    db: firestore.client,
+    firebase_uid: str,
+    apns_token: str,
+    usuario_id: Optional[str] = None,
+    roles: Optional[Dict[str, str]] = None
+):
     """
     Adiciona/atualiza um APNs token (Safari/iOS) para um usuário.
 
-    CORREÇÕES IMPLEMENTADAS:
-    1. Remove ArrayUnion - usa SET direto com merge
-    2. Valida que o token é realmente APNs (não FCM)
-    3. Remove duplicatas automaticamente
-    4. Mantém apenas os últimos 5 tokens
-    5. Remove tokens inválidos do banco
+    Rejeita tokens FCM enviados por engano e grava no registro `device_tokens`
+    sem buscar o usuário pelo UID quando o `usuario_id` é informado.
     """
     try:
         logger.info(f"🍎 ADICIONANDO APNs TOKEN - UID: {firebase_uid}, Token: {apns_token[:20]}...")
@@ -525,42 +849,16 @@ def adicionar_apns_token(db: firestore.client, firebase_uid: str, apns_token: st
             logger.error("❌ Use adicionar_fcm_token() para tokens FCM!")
             return
 
-        user_doc = buscar_usuario_por_firebase_uid(db, firebase_uid)
-
-        if user_doc:
-            logger.info(f"✅ Usuário encontrado: ID={user_doc['id']}, Nome={user_doc.get('nome', 'N/A')[:20]}")
-            doc_ref = db.collection('usuarios').document(user_doc['id'])
-
-            # Busca tokens existentes
-            current_doc = doc_ref.get()
-            current_data = current_doc.to_dict() or {}
-            existing_tokens = current_data.get('apns_tokens', [])
-
-            # Remove o token se já existir (para reposicioná-lo no final como "mais recente")
-            if apns_token in existing_tokens:
-                existing_tokens.remove(apns_token)
-
-            # Adiciona o novo token no final
-            existing_tokens.append(apns_token)
-
-            # Remove duplicatas
-            existing_tokens = _limpar_tokens_duplicados(existing_tokens)
-
-            # LIMITE: Mantém apenas os últimos 5 tokens
-            if len(existing_tokens) > 5:
-                tokens_removidos = existing_tokens[:-5]
-                logger.info(f"🧹 Removendo {len(tokens_removidos)} tokens APNs antigos (limite de 5 atingido)")
-                existing_tokens = existing_tokens[-5:]
+        if not usuario_id:
+            user_doc = buscar_usuario_por_firebase_uid(db, firebase_uid)
+            if not user_doc:
+                logger.error(f"❌ USUÁRIO NÃO ENCONTRADO PARA UID: {firebase_uid}")
+                return
+            usuario_id = user_doc['id']
+            roles = roles or user_doc.get('roles')
 
-            # ATUALIZAÇÃO: Usa SET com merge em vez de ArrayUnion
-            doc_ref.set({
-                'apns_tokens': existing_tokens
-            }, merge=True)
-
-            logger.info(f"✅ APNs Token salvo. Total de tokens APNs: {len(existing_tokens)}")
-
-        else:
-            logger.error(f"❌ USUÁRIO NÃO ENCONTRADO PARA UID: {firebase_uid}")
+        registrar_device_token(db, usuario_id, firebase_uid, apns_token, 'apns', roles)
+        logger.info(f"✅ APNs Token registrado para o usuário {usuario_id}")
 
     except Exception as e:
         logger.error(f"❌ ERRO ao adicionar APNs token para o UID {firebase_uid}: {e}", exc_info=True)
@@ -569,28 +867,17 @@ def adicionar_apns_token(db: firestore.client, firebase_uid: str, apns_token: st
 def remover_apns_token(db: firestore.client, firebase_uid: str, apns_token: str):
     """Remove um APNs token específico de um usuário."""
     try:
-        user_doc = buscar_usuario_por_firebase_uid(db, firebase_uid)
+        if invalidar_device_token(db, apns_token):
+            logger.info(f"🗑️ APNs Token removido: {apns_token[:20]}...")
+            return
 
+        # Token anterior à migração: só existe no array do perfil
+        user_doc = buscar_usuario_por_firebase_uid(db, firebase_uid)
         if user_doc:
-            doc_ref = db.collection('usuarios').document(user_doc['id'])
-
-            # Busca tokens atuais
-            current_doc = doc_ref.get()
-            current_data = current_doc.to_dict() or {}
-            existing_tokens = current_data.get('apns_tokens', [])
-
-            # Remove o token se existir
-            if apns_token in existing_tokens:
-                existing_tokens.remove(apns_token)
-
-                # Atualiza o documento
-                doc_ref.set({
-                    'apns_tokens': existing_tokens
-                }, merge=True)
-
-                logger.info(f"🗑️ APNs Token removido. Tokens restantes: {len(existing_tokens)}")
-            else:
-                logger.warning(f"⚠️ APNs Token não encontrado para remoção: {apns_token[:20]}...")
+            _remover_token_legado(db, user_doc['id'], apns_token, 'apns')
+            logger.info(f"🗑️ APNs Token legado removido do perfil: {apns_token[:20]}...")
+        else:
+            logger.warning(f"⚠️ APNs Token não encontrado para remoção: {apns_token[:20]}...")
 
     except Exception as e:
         logger.error(f"❌ Erro ao remover APNs token para o UID {firebase_uid}: {e}", exc_info=True)
@@ -602,27 +889,9 @@ def remover_apns_token_por_id_usuario(db: firestore.client, usuario_id: str, apn
     Útil para limpeza quando um envio de notificação falha.
     """
     try:
-        doc_ref = db.collection('usuarios').document(usuario_id)
-
-        # Busca tokens atuais
-        current_doc = doc_ref.get()
-        if not current_doc.exists:
-            logger.warning(f"⚠️ Usuário {usuario_id} não encontrado para remover APNs token")
-            return
-
-        current_data = current_doc.to_dict() or {}
-        existing_tokens = current_data.get('apns_tokens', [])
-
-        # Remove o token se existir
-        if apns_token in existing_tokens:
-            existing_tokens.remove(apns_token)
-
-            # Atualiza o documento
-            doc_ref.set({
-                'apns_tokens': existing_tokens
-            }, merge=True)
-
-            logger.info(f"🗑️ APNs Token inválido removido do usuário {usuario_id}. Tokens restantes: {len(existing_tokens)}")
+        if not invalidar_device_token(db, apns_token):
+            _remover_token_legado(db, usuario_id, apns_token, 'apns')
+        logger.info(f"🗑️ APNs Token inválido removido do usuário {usuario_id}.")
 
     except Exception as e:
         logger.error(f"❌ Erro ao remover APNs token do usuário {usuario_id}: {e}", exc_info=True)
@@ -745,83 +1014,108 @@ def admin_listar_negocios(db: firestore.client) -> List[Dict]:
 #     return None
 
 
+def _ids_profissionais_por_uid(db: firestore.client, negocio_id: str, firebase_uids: List[str]) -> Dict[str, str]:
+    """Versão em lote de `buscar_profissional_por_uid` que retorna só {firebase_uid: profissional_id}."""
+    uids = list(dict.fromkeys(uid for uid in firebase_uids if uid))
+    ids = {}
+    for i in range(0, len(uids), 30):
+        query = db.collection('profissionais')\
+            .where('negocio_id', '==', negocio_id)\
+            .where('usuario_uid', 'in', uids[i:i + 30])\
+            .select(['usuario_uid'])
+        for doc in query.stream():
+            ids.setdefault(doc.to_dict().get('usuario_uid'), doc.id)
+    return ids
+
+
+def _descriptografar_usuario_listagem(usuario_data: Dict) -> int:
+    """Descriptografa nome, telefone e endereço no próprio dicionário. Retorna quantos campos falharam."""
+    falhas = 0
+    for campo in ('nome', 'telefone'):
+        if usuario_data.get(campo):
+            try:
+                usuario_data[campo] = decrypt_data(usuario_data[campo])
+            except Exception:
+                usuario_data[campo] = "[Erro na descriptografia]"
+                falhas += 1
+
+    if usuario_data.get('endereco'):
+        endereco_descriptografado = {}
+        for key, value in usuario_data['endereco'].items():
+            if value and isinstance(value, str) and value.strip():
+                try:
+                    endereco_descriptografado[key] = decrypt_data(value)
+                except Exception:
+                    endereco_descriptografado[key] = "[Erro na descriptografia]"
+                    falhas += 1
+            else:
+                endereco_descriptografado[key] = value
+        usuario_data['endereco'] = endereco_descriptografado
+    return falhas
+
+
 def admin_listar_usuarios_por_negocio(db: firestore.client, negocio_id: str, status: str = 'ativo') -> List[Dict]:
     """
     Lista todos os usuários de um negócio, com filtro de status.
-    VERSÃO FINAL: Retorna o campo de status corretamente para cada usuário.
+    Os vínculos (perfil profissional da equipe e enfermeiro dos pacientes) são resolvidos
+    em lote depois da consulta principal, então o custo não cresce com leituras por linha.
     """
-    usuarios = []
     try:
         query = db.collection('usuarios').where(f'roles.{negocio_id}', 'in', ['cliente', 'profissional', 'admin', 'tecnico', 'medico'])
 
+        usuarios = []
+        # firebase_uid de todos os usuários do negócio, inclusive os filtrados pelo status,
+        # para resolver o enfermeiro dos pacientes sem reler o documento dele
+        uid_por_usuario_id = {}
         for doc in query.stream():
             usuario_data = doc.to_dict()
-            
+            uid_por_usuario_id[doc.id] = usuario_data.get('firebase_uid')
+
             # Pega o status do usuário para o negócio específico, com 'ativo' como padrão.
             status_no_negocio = usuario_data.get('status_por_negocio', {}).get(negocio_id, 'ativo')
-            
-            # LÓGICA DE FILTRO (continua a mesma)
-            deve_incluir = False
-            if status == 'all':
-                deve_incluir = True
-            elif status_no_negocio == status:
-                deve_incluir = True
-
-            if deve_incluir:
-                usuario_data['id'] = doc.id
-                
-                # Descriptografa campos sensíveis do usuário
-                if 'nome' in usuario_data and usuario_data['nome']:
-                    try:
-                        usuario_data['nome'] = decrypt_data(usuario_data['nome'])
-                    except Exception as e:
-                        logger.error(f"Erro ao descriptografar nome do usuário {doc.id}: {e}")
-                        usuario_data['nome'] = "[Erro na descriptografia]"
-                
-                if 'telefone' in usuario_data and usuario_data['telefone']:
-                    try:
-                        usuario_data['telefone'] = decrypt_data(usuario_data['telefone'])
-                    except Exception as e:
-                        logger.error(f"Erro ao descriptografar telefone do usuário {doc.id}: {e}")
-                        usuario_data['telefone'] = "[Erro na descriptografia]"
-                
-                if 'endereco' in usuario_data and usuario_data['endereco']:
-                    endereco_descriptografado = {}
-                    for key, value in usuario_data['endereco'].items():
-                        if value and isinstance(value, str) and value.strip():
-                            try:
-                                endereco_descriptografado[key] = decrypt_data(value)
-                            except Exception as e:
-                                logger.error(f"Erro ao descriptografar campo de endereço {key} do usuário {doc.id}: {e}")
-                                endereco_descriptografado[key] = "[Erro na descriptografia]"
-                        else:
-                            endereco_descriptografado[key] = value
-                    usuario_data['endereco'] = endereco_descriptografado
-                
-                # ***** A CORREÇÃO ESTÁ AQUI *****
-                # Adiciona o status do negócio ao dicionário de resposta.
-                # O nome do campo foi corrigido no schema para 'status_por_negocio' para ser mais claro.
-                # Esta linha garante que o dado seja populado na resposta da API.
-                usuario_data['status_por_negocio'] = {negocio_id: status_no_negocio}
-
-                # A lógica de enriquecimento de dados continua a mesma...
-                user_role = usuario_data.get("roles", {}).get(negocio_id)
-                if user_role in ['profissional', 'admin']:
-                    firebase_uid = usuario_data.get('firebase_uid')
-                    if firebase_uid:
-                        perfil_profissional = buscar_profissional_por_uid(db, negocio_id, firebase_uid)
-                        usuario_data['profissional_id'] = perfil_profissional.get('id') if perfil_profissional else None
-                elif user_role == 'cliente':
-                    enfermeiro_user_id = usuario_data.get('enfermeiro_id')
-                    if enfermeiro_user_id:
-                        enfermeiro_doc = db.collection('usuarios').document(enfermeiro_user_id).get()
-                        if enfermeiro_doc.exists:
-                            firebase_uid_enfermeiro = enfermeiro_doc.to_dict().get('firebase_uid')
-                            perfil_enfermeiro = buscar_profissional_por_uid(db, negocio_id, firebase_uid_enfermeiro)
-                            usuario_data['enfermeiro_vinculado_id'] = perfil_enfermeiro.get('id') if perfil_enfermeiro else None
-                    usuario_data['tecnicos_vinculados_ids'] = usuario_data.get('tecnicos_ids', [])
-
-                usuarios.append(usuario_data)
+            if status != 'all' and status_no_negocio != status:
+                continue
+
+            usuario_data['id'] = doc.id
+            # O status do negócio vai na resposta no campo 'status_por_negocio'
+            usuario_data['status_por_negocio'] = {negocio_id: status_no_negocio}
+            usuarios.append(usuario_data)
+
+        # --- Descriptografia em uma única passada, com um só log de falhas ---
+        falhas = sum(_descriptografar_usuario_listagem(usuario_data) for usuario_data in usuarios)
+        if falhas:
+            logger.error(f"{falhas} campos não puderam ser descriptografados na listagem de usuários do negócio {negocio_id}.")
+
+        # --- Enfermeiros vinculados que não estão na consulta principal: um get_all ---
+        enfermeiros_ids = {
+            u.get('enfermeiro_id') for u in usuarios
+            if u.get('roles', {}).get(negocio_id) == 'cliente' and u.get('enfermeiro_id')
+        }
+        faltantes = [uid for uid in enfermeiros_ids if uid not in uid_por_usuario_id]
+        if faltantes:
+            refs = [db.collection('usuarios').document(usuario_id) for usuario_id in faltantes]
+            for doc in db.get_all(refs, field_paths=['firebase_uid']):
+                if doc.exists:
+                    uid_por_usuario_id[doc.id] = (doc.to_dict() or {}).get('firebase_uid')
+
+        # --- Perfis profissionais da equipe e dos enfermeiros: consultas `in` em lote ---
+        uids_profissionais = [
+            u.get('firebase_uid') for u in usuarios
+            if u.get('roles', {}).get(negocio_id) in ['profissional', 'admin']
+        ] + [uid_por_usuario_id.get(usuario_id) for usuario_id in enfermeiros_ids]
+        profissional_id_por_uid = _ids_profissionais_por_uid(db, negocio_id, uids_profissionais)
+
+        for usuario_data in usuarios:
+            user_role = usuario_data.get("roles", {}).get(negocio_id)
+            if user_role in ['profissional', 'admin']:
+                firebase_uid = usuario_data.get('firebase_uid')
+                if firebase_uid:
+                    usuario_data['profissional_id'] = profissional_id_por_uid.get(firebase_uid)
+            elif user_role == 'cliente':
+                enfermeiro_user_id = usuario_data.get('enfermeiro_id')
+                if enfermeiro_user_id and enfermeiro_user_id in uid_por_usuario_id:
+                    usuario_data['enfermeiro_vinculado_id'] = profissional_id_por_uid.get(uid_por_usuario_id[enfermeiro_user_id])
+                usuario_data['tecnicos_vinculados_ids'] = usuario_data.get('tecnicos_ids', [])
 
         return usuarios
     except Exception as e:
@@ -850,6 +1144,17 @@ def admin_set_usuario_status(db: firestore.client, negocio_id: str, user_id: str
     if doc.exists:
         data = doc.to_dict()
         data['id'] = doc.id
+
+        # Usuário inativo sai dos tópicos do negócio; ao reativar, volta para os da sua role
+        role = (data.get('roles') or {}).get(negocio_id)
+        if role:
+            try:
+                if status == 'inativo':
+                    _sincronizar_topicos_role(db, user_id, negocio_id, role, None)
+                else:
+                    _sincronizar_topicos_role(db, user_id, negocio_id, None, role)
+            except Exception as e:
+                logger.error(f"Erro ao atualizar tópicos FCM do usuário {user_id}: {e}")
         
         # Descriptografa campos sensíveis do usuário
         if 'nome' in data and data['nome']:
@@ -911,6 +1216,12 @@ def admin_atualizar_role_usuario(db: firestore.client, negocio_id: str, user_id:
     role_path = f'roles.{negocio_id}'
     user_ref.update({role_path: novo_role})
 
+    try:
+        if (user_data.get('status_por_negocio') or {}).get(negocio_id) != 'inativo':
+            _sincronizar_topicos_role(db, user_id, negocio_id, role_antiga, novo_role)
+    except Exception as e:
+        logger.error(f"Erro ao atualizar tópicos FCM do usuário {user_id}: {e}")
+
     criar_log_auditoria(
         db,
         autor_uid=autor_uid,
@@ -938,6 +1249,7 @@ def admin_atualizar_role_usuario(db: firestore.client, negocio_id: str, user_id:
             # Reativa o perfil se já existir e estiver inativo
             prof_ref = db.collection('profissionais').document(perfil_profissional['id'])
             prof_ref.update({"ativo": True})
+            invalidar_catalogo('profissionais', negocio_id)
             logger.info(f"Perfil profissional reativado para o usuário {user_data['email']} no negócio {negocio_id}.")
 
     elif novo_role == 'cliente' or novo_role == 'tecnico' or novo_role == 'medico': # Desativa perfil se virar cliente, tecnico ou medico
@@ -945,6 +1257,7 @@ def admin_atualizar_role_usuario(db: firestore.client, negocio_id: str, user_id:
             # Desativa o perfil profissional se existir e estiver ativo
             prof_ref = db.collection('profissionais').document(perfil_profissional['id'])
             prof_ref.update({"ativo": False})
+            invalidar_catalogo('profissionais', negocio_id)
             logger.info(f"Perfil profissional desativado para o usuário {user_data['email']} no negócio {negocio_id}.")
 
     logger.info(f"Role do usuário {user_data['email']} atualizada para '{novo_role}' no negócio {negocio_id}.")
@@ -1140,6 +1453,11 @@ def admin_promover_cliente_para_profissional(db: firestore.client, negocio_id: s
             user_ref.update({
                 f'roles.{negocio_id}': 'profissional'
             })
+            try:
+                if (user_doc.get('status_por_negocio') or {}).get(negocio_id) != 'inativo':
+                    _sincronizar_topicos_role(db, user_doc['id'], negocio_id, 'cliente', 'profissional')
+            except Exception as e:
+                logger.error(f"Erro ao atualizar tópicos FCM do usuário {user_doc['id']}: {e}")
             
             # 2. Cria o perfil profissional básico
             novo_profissional_data = schemas.ProfissionalCreate(
@@ -1179,12 +1497,18 @@ def admin_rebaixar_profissional_para_cliente(db: firestore.client, negocio_id: s
             user_ref.update({
                 f'roles.{negocio_id}': 'cliente'
             })
+            try:
+                if (user_doc.get('status_por_negocio') or {}).get(negocio_id) != 'inativo':
+                    _sincronizar_topicos_role(db, user_doc['id'], negocio_id, 'profissional', 'cliente')
+            except Exception as e:
+                logger.error(f"Erro ao atualizar tópicos FCM do usuário {user_doc['id']}: {e}")
             
             # 2. Desativa o perfil profissional
             perfil_profissional = buscar_profissional_por_uid(db, negocio_id, profissional_uid)
             if perfil_profissional:
                 prof_ref = db.collection('profissionais').document(perfil_profissional['id'])
                 prof_ref.update({"ativo": False})
+                invalidar_catalogo('profissionais', negocio_id)
 
             logger.info(f"Usuário {user_doc['email']} rebaixado para cliente no negócio {negocio_id}.")
             
@@ -1197,6 +1521,61 @@ def admin_rebaixar_profissional_para_cliente(db: firestore.client, negocio_id: s
         logger.error(f"Erro ao rebaixar profissional {profissional_uid}: {e}")
         return None
 
+# =================================================================================
+# CACHE DO CATÁLOGO DO NEGÓCIO (MÉDICOS, SERVIÇOS E PROFISSIONAIS)
+# =================================================================================
+# Listas que mudam pouco e aparecem em quase toda tela ficam em memória por
+# CATALOGO_CACHE_TTL_SEGUNDOS. As funções que alteram cada lista a invalidam na
+# hora; entre instâncias, a defasagem máxima é o TTL. Cada entrada guarda um ETag
+# calculado sobre o conteúdo, usado nas respostas condicionais.
+CATALOGO_CACHE_TTL_SEGUNDOS = int(os.getenv('CATALOGO_CACHE_TTL_SEGUNDOS', '120'))
+
+_catalogo_cache: Dict[Tuple[str, str], Tuple[float, str, List[Dict]]] = {}
+_catalogo_cache_lock = threading.Lock()
+
+
+def invalidar_catalogo(tipo: str, chave: Optional[str]):
+    """Descarta a lista em cache de `tipo` ('medicos' e 'profissionais' por negócio, 'servicos' por profissional)."""
+    if not chave:
+        return
+    with _catalogo_cache_lock:
+        _catalogo_cache.pop((tipo, chave), None)
+
+
+def obter_catalogo(db: firestore.client, tipo: str, chave: str) -> Tuple[List[Dict], str]:
+    """
+    Retorna (lista, etag) do catálogo, lendo do Firestore só quando a entrada expirou ou
+    foi invalidada. Se a leitura falhar, serve a última entrada (mesmo expirada); sem
+    entrada, a exceção é propagada. O retorno é sempre uma cópia profunda do cache.
+    """
+    agora = datetime.now(timezone.utc).timestamp()
+    with _catalogo_cache_lock:
+        entrada = _catalogo_cache.get((tipo, chave))
+    if entrada and entrada[0] > agora:
+        return copy.deepcopy(entrada[2]), entrada[1]
+
+    carregadores = {
+        'medicos': _carregar_medicos_por_negocio,
+        'servicos': _carregar_servicos_por_profissional,
+        'profissionais': _carregar_profissionais_por_negocio,
+    }
+    try:
+        itens = carregadores[tipo](db, chave)
+    except Exception as e:
+        # Falhas não entram no cache
+        logger.error(f"Erro ao carregar catálogo '{tipo}' para {chave}: {e}")
+        if entrada:
+            logger.warning(f"Servindo catálogo '{tipo}' expirado para {chave}.")
+            return copy.deepcopy(entrada[2]), entrada[1]
+        raise
+
+    conteudo = json.dumps(itens, sort_keys=True, default=str, ensure_ascii=False)
+    etag = f'"{hashlib.sha1(conteudo.encode()).hexdigest()[:20]}"'
+    with _catalogo_cache_lock:
+        _catalogo_cache[(tipo, chave)] = (agora + CATALOGO_CACHE_TTL_SEGUNDOS, etag, copy.deepcopy(itens))
+    return itens, etag
+
+
 # =================================================================================
 # FUNÇÕES DE GESTÃO CLÍNICA (MÉDICOS)
 # =================================================================================
@@ -1207,20 +1586,23 @@ def criar_medico(db: firestore.client, medico_data: schemas.MedicoBase) -> Dict:
     doc_ref = db.collection('medicos').document()
     doc_ref.set(medico_dict)
     medico_dict['id'] = doc_ref.id
+    invalidar_catalogo('medicos', medico_dict.get('negocio_id'))
     return medico_dict
 
-def listar_medicos_por_negocio(db: firestore.client, negocio_id: str) -> List[Dict]:
-    """Lista todos os médicos de referência de uma clínica."""
+def _carregar_medicos_por_negocio(db: firestore.client, negocio_id: str) -> List[Dict]:
     medicos = []
+    query = db.collection('medicos').where('negocio_id', '==', negocio_id)
+    for doc in query.stream():
+        medico_data = doc.to_dict()
+        medico_data['id'] = doc.id
+        medicos.append(medico_data)
+    return medicos
+
+def listar_medicos_por_negocio(db: firestore.client, negocio_id: str) -> List[Dict]:
+    """Lista todos os médicos de referência de uma clínica (via cache do catálogo)."""
     try:
-        query = db.collection('medicos').where('negocio_id', '==', negocio_id)
-        for doc in query.stream():
-            medico_data = doc.to_dict()
-            medico_data['id'] = doc.id
-            medicos.append(medico_data)
-        return medicos
-    except Exception as e:
-        logger.error(f"Erro ao listar médicos para o negocio_id {negocio_id}: {e}")
+        return obter_catalogo(db, 'medicos', negocio_id)[0]
+    except Exception:
         return []
 
 def update_medico(db: firestore.client, negocio_id: str, medico_id: str, update_data: schemas.MedicoUpdate) -> Optional[Dict]:
@@ -1241,6 +1623,7 @@ def update_medico(db: firestore.client, negocio_id: str, medico_id: str, update_
 
         medico_ref.update(update_dict)
         logger.info(f"Médico {medico_id} atualizado.")
+        invalidar_catalogo('medicos', negocio_id)
 
         updated_doc = medico_ref.get().to_dict()
         updated_doc['id'] = medico_id
@@ -1261,6 +1644,7 @@ def delete_medico(db: firestore.client, negocio_id: str, medico_id: str) -> bool
 
         medico_ref.delete()
         logger.info(f"Médico {medico_id} deletado.")
+        invalidar_catalogo('medicos', negocio_id)
         return True
     except Exception as e:
         logger.error(f"Erro ao deletar médico {medico_id}: {e}")
@@ -1299,79 +1683,119 @@ def atualizar_perfil_profissional(db: firestore.client, profissional_id: str, up
 
         prof_ref.update(update_dict)
         logger.info(f"Perfil do profissional {profissional_id} atualizado.")
-        
-        return buscar_profissional_por_id(db, profissional_id)
+
+        if 'fotos' in update_dict:
+            _atualizar_thumbnail_postagens(db, profissional_id, (update_dict['fotos'] or {}).get('thumbnail'))
+
+        profissional = buscar_profissional_por_id(db, profissional_id)
+        invalidar_catalogo('profissionais', (profissional or {}).get('negocio_id'))
+        return profissional
     except Exception as e:
         logger.error(f"Erro ao atualizar perfil do profissional {profissional_id}: {e}")
         return None
 
-def criar_profissional(db: firestore.client, profissional_data: schemas.ProfissionalCreate) -> Dict:
-    """Cria um novo profissional no Firestore."""
-    prof_dict = profissional_data.dict()
-    doc_ref = db.collection('profissionais').document()
-    doc_ref.set(prof_dict)
-    prof_dict['id'] = doc_ref.id
-    return prof_dict
+def _atualizar_thumbnail_postagens(db: firestore.client, profissional_id: str, thumbnail: Optional[str]) -> int:
+    """Propaga a miniatura do profissional para as postagens dele que ainda têm a antiga."""
+    query = db.collection('postagens')\
+        .where('profissional_id', '==', profissional_id)\
+        .select(['profissional_foto_thumbnail', 'negocio_id'])
 
-# Em crud.py
+    batch = db.batch()
+    pendentes = 0
+    atualizadas = 0
+    negocios = set()
+    for doc in query.stream():
+        dados = doc.to_dict() or {}
+        if dados.get('profissional_foto_thumbnail') == thumbnail:
+            continue
+        negocios.add(dados.get('negocio_id'))
+        batch.update(doc.reference, {'profissional_foto_thumbnail': thumbnail})
+        pendentes += 1
+        atualizadas += 1
+        if pendentes >= 400:
+            batch.commit()
+            batch = db.batch()
+            pendentes = 0
+    if pendentes:
+        batch.commit()
 
-# Em crud.py
+    for negocio_id in negocios:
+        _incrementar_versao_feed(db, negocio_id)
+    if atualizadas:
+        logger.info(f"🖼️ Miniatura atualizada em {atualizadas} postagens do profissional {profissional_id}.")
+    return atualizadas
 
-# Em crud.py
+
+def sincronizar_thumbnails_postagens(db: firestore.client) -> Dict[str, int]:
+    """
+    Migração única: alinha a miniatura desnormalizada de todas as postagens com o
+    perfil atual de cada profissional (postagens antigas dependiam do join no feed).
+    """
+    stats = {"profissionais": 0, "postagens_atualizadas": 0}
+    for doc in db.collection('profissionais').select(['fotos']).stream():
+        stats["profissionais"] += 1
+        thumbnail = ((doc.to_dict() or {}).get('fotos') or {}).get('thumbnail')
+        stats["postagens_atualizadas"] += _atualizar_thumbnail_postagens(db, doc.id, thumbnail)
+    logger.info(f"🖼️ Sincronização de miniaturas das postagens concluída: {stats}")
+    return stats
+
+def criar_profissional(db: firestore.client, profissional_data: schemas.ProfissionalCreate) -> Dict:
+    """Cria um novo profissional no Firestore."""
+    prof_dict = profissional_data.dict()
+    doc_ref = db.collection('profissionais').document()
+    doc_ref.set(prof_dict)
+    prof_dict['id'] = doc_ref.id
+    invalidar_catalogo('profissionais', prof_dict.get('negocio_id'))
+    return prof_dict
 
 def listar_profissionais_por_negocio(db: firestore.client, negocio_id: str) -> List[Dict]:
-    """Lista todos os profissionais ativos de um negócio específico, enriquecendo com dados do usuário."""
-    profissionais = []
+    """Lista todos os profissionais ativos de um negócio específico (via cache do catálogo)."""
     try:
-        query = db.collection('profissionais').where('negocio_id', '==', negocio_id).where('ativo', '==', True)
-        
-        for doc in query.stream():
-            prof_data = doc.to_dict()
-            prof_data['id'] = doc.id
+        return obter_catalogo(db, 'profissionais', negocio_id)[0]
+    except Exception:
+        return []
 
-            firebase_uid = prof_data.get('usuario_uid')
-            logger.info(f"🔍 DEBUG PROFISSIONAL - ID: {prof_data.get('id')}, usuario_uid: {firebase_uid}")
+def _carregar_profissionais_por_negocio(db: firestore.client, negocio_id: str) -> List[Dict]:
+    """
+    Carrega os profissionais ativos do negócio, enriquecendo com dados do usuário.
+    Os usuários são buscados em lote, então a listagem custa um número constante de consultas.
+    """
+    query = db.collection('profissionais').where('negocio_id', '==', negocio_id).where('ativo', '==', True)
+    profissionais = []
+    for doc in query.stream():
+        prof_data = doc.to_dict()
+        prof_data['id'] = doc.id
+        profissionais.append(prof_data)
 
-            # --- INÍCIO DA CORREÇÃO ---
-            # Busca os dados do usuário, mas não pula o profissional se não encontrar
-            if firebase_uid:
-                usuario_doc = buscar_usuario_por_firebase_uid(db, firebase_uid)
-                if usuario_doc:
-                    prof_data['nome'] = usuario_doc.get('nome', prof_data.get('nome'))
-                    # Tenta buscar a imagem do usuário em diferentes campos possíveis
-                    user_image = (usuario_doc.get('profile_image_url') or
-                                 usuario_doc.get('profile_image') or
-                                 prof_data.get('fotos', {}).get('thumbnail'))
-                    prof_data['profile_image_url'] = user_image
-                    logger.info(f"🖼️ PROFISSIONAL DEBUG - Profissional {prof_data.get('id')}: user_image_url={usuario_doc.get('profile_image_url')}, user_image={usuario_doc.get('profile_image')}, prof_fotos_thumbnail={prof_data.get('fotos', {}).get('thumbnail')}, final_image={user_image}")
-                    prof_data['email'] = usuario_doc.get('email', '')
-                else:
-                    # Fallback se o usuário não for encontrado
-                    prof_fallback_image = (prof_data.get('fotos', {}).get('thumbnail') or
-                                         prof_data.get('fotos', {}).get('perfil') or
-                                         prof_data.get('fotos', {}).get('original'))
-                    prof_data['profile_image_url'] = prof_fallback_image
-                    prof_data['email'] = ''
-                    logger.info(f"🖼️ PROFISSIONAL DEBUG - Profissional {prof_data.get('id')} (sem usuário): prof_fotos={prof_data.get('fotos', {})}, final_image={prof_fallback_image}")
-            else:
-                # Fallback se não houver firebase_uid
-                prof_fallback_image = (prof_data.get('fotos', {}).get('thumbnail') or
-                                     prof_data.get('fotos', {}).get('perfil') or
-                                     prof_data.get('fotos', {}).get('original'))
-                prof_data['profile_image_url'] = prof_fallback_image
-                prof_data['email'] = ''
-                logger.info(f"🖼️ PROFISSIONAL DEBUG - Profissional {prof_data.get('id')} (sem firebase_uid): prof_fotos={prof_data.get('fotos', {})}, final_image={prof_fallback_image}")
-            
-            # Garante que o firebase_uid sempre esteja na resposta
-            prof_data['firebase_uid'] = firebase_uid
-            # --- FIM DA CORREÇÃO ---
+    usuarios = buscar_usuarios_por_firebase_uids(
+        db,
+        [prof.get('usuario_uid') for prof in profissionais],
+        campos=['nome', 'email', 'profile_image_url', 'profile_image']
+    )
 
-            profissionais.append(prof_data)
-            
-        return profissionais
-    except Exception as e:
-        logger.error(f"Erro ao listar profissionais para o negocio_id {negocio_id}: {e}")
-        return []
+    for prof_data in profissionais:
+        firebase_uid = prof_data.get('usuario_uid')
+        fotos = prof_data.get('fotos', {})
+        # Busca os dados do usuário, mas não pula o profissional se não encontrar
+        usuario_doc = usuarios.get(firebase_uid) if firebase_uid else None
+        if usuario_doc:
+            prof_data['nome'] = usuario_doc.get('nome', prof_data.get('nome'))
+            # Tenta buscar a imagem do usuário em diferentes campos possíveis
+            prof_data['profile_image_url'] = (usuario_doc.get('profile_image_url') or
+                                              usuario_doc.get('profile_image') or
+                                              fotos.get('thumbnail'))
+            prof_data['email'] = usuario_doc.get('email', '')
+        else:
+            # Fallback se o usuário (ou o firebase_uid) não for encontrado
+            prof_data['profile_image_url'] = (fotos.get('thumbnail') or
+                                              fotos.get('perfil') or
+                                              fotos.get('original'))
+            prof_data['email'] = ''
+
+        # Garante que o firebase_uid sempre esteja na resposta
+        prof_data['firebase_uid'] = firebase_uid
+
+    return profissionais
             
 
 def buscar_profissional_por_id(db: firestore.client, profissional_id: str) -> Optional[Dict]:
@@ -1398,20 +1822,23 @@ def criar_servico(db: firestore.client, servico_data: schemas.ServicoCreate) ->
     doc_ref = db.collection('servicos').document()
     doc_ref.set(servico_dict)
     servico_dict['id'] = doc_ref.id
+    invalidar_catalogo('servicos', servico_dict.get('profissional_id'))
     return servico_dict
 
-def listar_servicos_por_profissional(db: firestore.client, profissional_id: str) -> List[Dict]:
-    """Lista todos os serviços de um profissional específico."""
+def _carregar_servicos_por_profissional(db: firestore.client, profissional_id: str) -> List[Dict]:
     servicos = []
+    query = db.collection('servicos').where('profissional_id', '==', profissional_id)
+    for doc in query.stream():
+        servico_data = doc.to_dict()
+        servico_data['id'] = doc.id
+        servicos.append(servico_data)
+    return servicos
+
+def listar_servicos_por_profissional(db: firestore.client, profissional_id: str) -> List[Dict]:
+    """Lista todos os serviços de um profissional específico (via cache do catálogo)."""
     try:
-        query = db.collection('servicos').where('profissional_id', '==', profissional_id)
-        for doc in query.stream():
-            servico_data = doc.to_dict()
-            servico_data['id'] = doc.id
-            servicos.append(servico_data)
-        return servicos
-    except Exception as e:
-        logger.error(f"Erro ao listar serviços para o profissional_id {profissional_id}: {e}")
+        return obter_catalogo(db, 'servicos', profissional_id)[0]
+    except Exception:
         return []
 
 def atualizar_servico(db: firestore.client, servico_id: str, profissional_id: str, update_data: schemas.ServicoUpdate) -> Optional[Dict]:
@@ -1430,6 +1857,7 @@ def atualizar_servico(db: firestore.client, servico_id: str, profissional_id: st
 
         servico_ref.update(update_dict)
         logger.info(f"Serviço {servico_id} atualizado pelo profissional {profissional_id}.")
+        invalidar_catalogo('servicos', profissional_id)
         
         updated_doc = servico_ref.get().to_dict()
         updated_doc['id'] = servico_id
@@ -1450,6 +1878,7 @@ def deletar_servico(db: firestore.client, servico_id: str, profissional_id: str)
             
         servico_ref.delete()
         logger.info(f"Serviço {servico_id} deletado pelo profissional {profissional_id}.")
+        invalidar_catalogo('servicos', profissional_id)
         return True
     except Exception as e:
         logger.error(f"Erro ao deletar serviço {servico_id}: {e}")
@@ -1476,7 +1905,8 @@ def definir_horarios_trabalho(db: firestore.client, profissional_id: str, horari
             "hora_fim": horario.hora_fim.isoformat()
         }
         horarios_ref.document(str(horario.dia_semana)).set(horario_to_save)
-    
+
+    invalidar_cache_disponibilidade(profissional_id)
     return listar_horarios_trabalho(db, profissional_id)
 
 def listar_horarios_trabalho(db: firestore.client, profissional_id: str) -> List[Dict]:
@@ -1495,73 +1925,253 @@ def criar_bloqueio(db: firestore.client, profissional_id: str, bloqueio_data: sc
     bloqueios_ref = db.collection('profissionais').document(profissional_id).collection('bloqueios')
     time_created, doc_ref = bloqueios_ref.add(bloqueio_dict)
     bloqueio_dict['id'] = doc_ref.id
+    invalidar_cache_disponibilidade(profissional_id, _dias_do_intervalo(bloqueio_data.inicio, bloqueio_data.fim))
     return bloqueio_dict
 
 def deletar_bloqueio(db: firestore.client, profissional_id: str, bloqueio_id: str) -> bool:
     """Deleta um bloqueio da agenda de um profissional."""
     try:
         bloqueio_ref = db.collection('profissionais').document(profissional_id).collection('bloqueios').document(bloqueio_id)
-        if bloqueio_ref.get().exists:
+        bloqueio_doc = bloqueio_ref.get()
+        if bloqueio_doc.exists:
             bloqueio_ref.delete()
+            bloqueio = bloqueio_doc.to_dict()
+            invalidar_cache_disponibilidade(profissional_id, _dias_do_intervalo(bloqueio['inicio'], bloqueio['fim']))
             return True
         return False
     except Exception as e:
         logger.error(f"Erro ao deletar bloqueio {bloqueio_id}: {e}")
         return False
         
-def calcular_horarios_disponiveis(db: firestore.client, profissional_id: str, dia: date, duracao_servico_min: int = 60) -> List[time]:
-    """Calcula os horários disponíveis para um profissional em um dia específico."""
-    dia_semana = dia.weekday()
-    
-    horario_trabalho_ref = db.collection('profissionais').document(profissional_id).collection('horarios_trabalho').document(str(dia_semana))
-    horario_trabalho_doc = horario_trabalho_ref.get()
+DISPONIBILIDADE_MAX_DIAS = 31
+DISPONIBILIDADE_MAX_PROFISSIONAIS = 20
 
-    if not horario_trabalho_doc.exists:
-        return [] 
+# Agendamentos antigos sem 'servico_duracao_minutos' ocupam este tempo
+AGENDAMENTO_DURACAO_PADRAO_MINUTOS = 60
+# Agendamentos que começam até este tempo antes do período ainda podem invadi-lo
+AGENDAMENTO_DURACAO_MAXIMA = timedelta(hours=24)
+STATUS_AGENDAMENTO_OCUPA_HORARIO = ['pendente', 'confirmado']
 
-    horario_trabalho = horario_trabalho_doc.to_dict()
-    
-    slots_disponiveis = []
-    hora_inicio_str = horario_trabalho['hora_inicio']
-    hora_fim_str = horario_trabalho['hora_fim']
+# --- Cache de disponibilidade por (profissional, dia, duração) ---
+# O TTL curto limita a defasagem entre instâncias; dentro da instância, as
+# escritas na agenda invalidam exatamente os dias afetados.
+DISPONIBILIDADE_CACHE_TTL_SEGUNDOS = int(os.getenv('DISPONIBILIDADE_CACHE_TTL_SEGUNDOS', '30'))
+DISPONIBILIDADE_CACHE_MAX_ENTRADAS = 5000
 
-    hora_inicio = datetime.combine(dia, time.fromisoformat(hora_inicio_str))
-    hora_fim = datetime.combine(dia, time.fromisoformat(hora_fim_str))
-    
+_cache_disponibilidade: Dict[str, Dict] = {}
+_cache_disponibilidade_geracao: Dict[str, int] = {}
+_cache_disponibilidade_stats = {"hits": 0, "misses": 0, "invalidacoes": 0}
+_cache_disponibilidade_lock = threading.Lock()
+
+
+def _dias_do_intervalo(inicio: datetime, fim: datetime) -> List[date]:
+    """Dias de calendário tocados pelo intervalo [inicio, fim)."""
+    inicio = inicio.replace(tzinfo=None)
+    ultimo = max(inicio, fim.replace(tzinfo=None) - timedelta(microseconds=1))
+    return [inicio.date() + timedelta(days=i) for i in range((ultimo.date() - inicio.date()).days + 1)]
+
+
+def invalidar_cache_disponibilidade(profissional_id: str, dias: Optional[List[date]] = None):
+    """Remove do cache os dias informados do profissional (ou todos, se `dias` for None)."""
+    with _cache_disponibilidade_lock:
+        _cache_disponibilidade_geracao[profissional_id] = _cache_disponibilidade_geracao.get(profissional_id, 0) + 1
+        entradas = _cache_disponibilidade.get(profissional_id)
+        if not entradas:
+            return
+        if dias is None:
+            removidas = len(entradas)
+            _cache_disponibilidade.pop(profissional_id, None)
+        else:
+            dias_iso = {dia.isoformat() for dia in dias}
+            chaves = [chave for chave in entradas if chave[0] in dias_iso]
+            for chave in chaves:
+                del entradas[chave]
+            removidas = len(chaves)
+        _cache_disponibilidade_stats["invalidacoes"] += removidas
+
+
+def _invalidar_cache_agendamento(agendamento: Dict):
+    """Invalida os dias ocupados por um agendamento na agenda do profissional."""
+    inicio = agendamento.get('data_hora')
+    if not inicio or not agendamento.get('profissional_id'):
+        return
+    duracao = agendamento.get('servico_duracao_minutos') or AGENDAMENTO_DURACAO_PADRAO_MINUTOS
+    invalidar_cache_disponibilidade(
+        agendamento['profissional_id'],
+        _dias_do_intervalo(inicio, inicio + timedelta(minutes=duracao))
+    )
+
+
+def estatisticas_cache_disponibilidade() -> Dict:
+    """Métricas do cache de disponibilidade desta instância."""
+    with _cache_disponibilidade_lock:
+        hits = _cache_disponibilidade_stats["hits"]
+        misses = _cache_disponibilidade_stats["misses"]
+        total = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": round(hits / total, 4) if total else 0.0,
+            "invalidacoes": _cache_disponibilidade_stats["invalidacoes"],
+            "entradas": sum(len(entradas) for entradas in _cache_disponibilidade.values()),
+            "ttl_segundos": DISPONIBILIDADE_CACHE_TTL_SEGUNDOS,
+        }
+
+
+def _ler_cache_disponibilidade(profissional_id: str, chave) -> Optional[List[time]]:
+    agora = datetime.now(timezone.utc).timestamp()
+    with _cache_disponibilidade_lock:
+        entrada = _cache_disponibilidade.get(profissional_id, {}).get(chave)
+        if entrada and entrada[0] > agora:
+            _cache_disponibilidade_stats["hits"] += 1
+            return list(entrada[1])
+        _cache_disponibilidade_stats["misses"] += 1
+        return None
+
+
+def _gravar_cache_disponibilidade(profissional_id: str, chave, geracao: int, horarios: List[time]):
+    agora = datetime.now(timezone.utc).timestamp()
+    with _cache_disponibilidade_lock:
+        # Uma escrita na agenda aconteceu durante o cálculo: o resultado pode estar velho
+        if _cache_disponibilidade_geracao.get(profissional_id, 0) != geracao:
+            return
+        total = sum(len(entradas) for entradas in _cache_disponibilidade.values())
+        if total >= DISPONIBILIDADE_CACHE_MAX_ENTRADAS:
+            for prof_id in list(_cache_disponibilidade):
+                entradas = _cache_disponibilidade[prof_id]
+                for c in [c for c, (expira, _) in entradas.items() if expira <= agora]:
+                    del entradas[c]
+                if not entradas:
+                    del _cache_disponibilidade[prof_id]
+            if sum(len(entradas) for entradas in _cache_disponibilidade.values()) >= DISPONIBILIDADE_CACHE_MAX_ENTRADAS:
+                _cache_disponibilidade.clear()
+        _cache_disponibilidade.setdefault(profissional_id, {})[chave] = (
+            agora + DISPONIBILIDADE_CACHE_TTL_SEGUNDOS, list(horarios)
+        )
+
+
+def _carregar_agenda_profissional(db: firestore.client, profissional_id: str, data_inicio: date, data_fim: date) -> Dict:
+    """
+    Lê de uma vez tudo o que é preciso para calcular a disponibilidade de um
+    profissional no período e já devolve as ocupações (agendamentos ativos e
+    bloqueios) como intervalos ordenados e mesclados.
+    """
+    prof_ref = db.collection('profissionais').document(profissional_id)
+    inicio_periodo = datetime.combine(data_inicio, time.min)
+    fim_periodo = datetime.combine(data_fim, time.max)
+
+    horarios = {doc.id: doc.to_dict() for doc in prof_ref.collection('horarios_trabalho').stream()}
+
+    intervalos = []
+    agendamentos_query = db.collection('agendamentos')\
+        .where('profissional_id', '==', profissional_id)\
+        .where('status', 'in', STATUS_AGENDAMENTO_OCUPA_HORARIO)\
+        .where('data_hora', '>=', inicio_periodo - AGENDAMENTO_DURACAO_MAXIMA)\
+        .where('data_hora', '<=', fim_periodo)
+    for ag in agendamentos_query.stream():
+        ag_data = ag.to_dict()
+        inicio = ag_data['data_hora'].replace(tzinfo=None)
+        duracao = ag_data.get('servico_duracao_minutos') or AGENDAMENTO_DURACAO_PADRAO_MINUTOS
+        intervalos.append((inicio, inicio + timedelta(minutes=duracao)))
+
+    bloqueios_query = prof_ref.collection('bloqueios')\
+        .where('inicio', '<=', fim_periodo)\
+        .where('fim', '>=', inicio_periodo)
+    for b in bloqueios_query.stream():
+        b_data = b.to_dict()
+        intervalos.append((b_data['inicio'].replace(tzinfo=None), b_data['fim'].replace(tzinfo=None)))
+
+    return {"horarios": horarios, "ocupados": mesclar_intervalos(intervalos)}
+
+
+def _calcular_slots_dia(agenda: Dict, dia: date, duracao_servico_min: int) -> List[datetime]:
+    """Calcula, em memória, os slots livres de um dia a partir da agenda carregada."""
+    horario_trabalho = agenda["horarios"].get(str(dia.weekday()))
+    if not horario_trabalho:
+        return []
+
+    hora_inicio = datetime.combine(dia, time.fromisoformat(horario_trabalho['hora_inicio']))
+    hora_fim = datetime.combine(dia, time.fromisoformat(horario_trabalho['hora_fim']))
+    duracao = timedelta(minutes=duracao_servico_min)
+
+    slots = []
     hora_atual = hora_inicio
     while hora_atual < hora_fim:
-        slots_disponiveis.append(hora_atual)
-        hora_atual += timedelta(minutes=duracao_servico_min)
+        slots.append(hora_atual)
+        hora_atual += duracao
 
-    agendamentos_no_dia_query = db.collection('agendamentos')\
-        .where('profissional_id', '==', profissional_id)\
-        .where('status', '==', 'pendente')\
-        .where('data_hora', '>=', datetime.combine(dia, time.min))\
-        .where('data_hora', '<=', datetime.combine(dia, time.max))
-        
-    horarios_ocupados = {ag.to_dict()['data_hora'].replace(tzinfo=None) for ag in agendamentos_no_dia_query.stream()}
-    
-    bloqueios_no_dia_query = db.collection('profissionais').document(profissional_id).collection('bloqueios')\
-        .where('inicio', '<=', datetime.combine(dia, time.max))\
-        .where('fim', '>=', datetime.combine(dia, time.min))
-    
-    bloqueios = [b.to_dict() for b in bloqueios_no_dia_query.stream()]
+    return filtrar_slots_livres(slots, duracao, agenda["ocupados"])
 
-    horarios_finais = []
-    for slot in slots_disponiveis:
-        if slot in horarios_ocupados:
-            continue
-        
-        em_bloqueio = False
-        for bloqueio in bloqueios:
-            if bloqueio['inicio'].replace(tzinfo=None) <= slot < bloqueio['fim'].replace(tzinfo=None):
-                em_bloqueio = True
-                break
-        
-        if not em_bloqueio:
-            horarios_finais.append(slot.time())
-            
-    return horarios_finais
+
+def calcular_horarios_disponiveis(db: firestore.client, profissional_id: str, dia: date, duracao_servico_min: int = 60) -> List[time]:
+    """Calcula os horários disponíveis para um profissional em um dia específico (com cache)."""
+    chave = (dia.isoformat(), duracao_servico_min)
+    horarios = _ler_cache_disponibilidade(profissional_id, chave)
+    if horarios is not None:
+        return horarios
+
+    with _cache_disponibilidade_lock:
+        geracao = _cache_disponibilidade_geracao.get(profissional_id, 0)
+    agenda = _carregar_agenda_profissional(db, profissional_id, dia, dia)
+    horarios = [slot.time() for slot in _calcular_slots_dia(agenda, dia, duracao_servico_min)]
+    _gravar_cache_disponibilidade(profissional_id, chave, geracao, horarios)
+    return horarios
+
+
+def calcular_disponibilidade_periodo(
+    db: firestore.client,
+    profissional_ids: List[str],
+    data_inicio: date,
+    data_fim: date,
+    duracao_servico_min: int = 60
+) -> Dict:
+    """
+    Calcula a disponibilidade de vários profissionais em um intervalo de dias.
+
+    Cada profissional tem sua agenda lida uma única vez para o período inteiro
+    (em paralelo entre profissionais) e os slots são calculados em memória.
+    Cada dia é devolvido como um bitset compacto: `inicio` é o primeiro slot do
+    expediente e o caractere i de `mapa` indica se o slot `inicio + i*duracao`
+    está livre ('1') ou ocupado ('0').
+    """
+    if data_fim < data_inicio:
+        raise ValueError("data_fim deve ser igual ou posterior a data_inicio.")
+    total_dias = (data_fim - data_inicio).days + 1
+    if total_dias > DISPONIBILIDADE_MAX_DIAS:
+        raise ValueError(f"O período máximo é de {DISPONIBILIDADE_MAX_DIAS} dias.")
+    profissional_ids = list(dict.fromkeys(profissional_ids))
+    if not profissional_ids or len(profissional_ids) > DISPONIBILIDADE_MAX_PROFISSIONAIS:
+        raise ValueError(f"Informe de 1 a {DISPONIBILIDADE_MAX_PROFISSIONAIS} profissionais.")
+
+    with ThreadPoolExecutor(max_workers=min(len(profissional_ids), 8)) as executor:
+        agendas = dict(zip(profissional_ids, executor.map(
+            lambda prof_id: _carregar_agenda_profissional(db, prof_id, data_inicio, data_fim),
+            profissional_ids
+        )))
+
+    passo = timedelta(minutes=duracao_servico_min)
+    profissionais = []
+    for profissional_id in profissional_ids:
+        agenda = agendas[profissional_id]
+        dias = {}
+        for i in range(total_dias):
+            dia = data_inicio + timedelta(days=i)
+            horario_trabalho = agenda["horarios"].get(str(dia.weekday()))
+            if not horario_trabalho:
+                dias[dia.isoformat()] = {"inicio": None, "mapa": ""}
+                continue
+
+            inicio_expediente = datetime.combine(dia, time.fromisoformat(horario_trabalho['hora_inicio']))
+            fim_expediente = datetime.combine(dia, time.fromisoformat(horario_trabalho['hora_fim']))
+            total_slots = max(0, -(-(fim_expediente - inicio_expediente) // passo))
+            livres = {int((slot - inicio_expediente) / passo) for slot in _calcular_slots_dia(agenda, dia, duracao_servico_min)}
+            dias[dia.isoformat()] = {
+                "inicio": inicio_expediente.time(),
+                "mapa": "".join('1' if indice in livres else '0' for indice in range(total_slots)),
+            }
+        profissionais.append({"profissional_id": profissional_id, "dias": dias})
+
+    return {"duracao_minutos": duracao_servico_min, "profissionais": profissionais}
 
 # =================================================================================
 # HELPER: envio FCM unitário por token (sem /batch)
@@ -1640,7 +2250,13 @@ def _send_data_push_to_tokens(
                 "registration-token-not-registered"    # mensagem do FCM
             ]):
                 try:
-                    remover_fcm_token(db, firebase_uid_destinatario, t)
+                    if not invalidar_device_token(db, t):
+                        # Token anterior à migração: só existe no array do perfil
+                        dono = buscar_usuarios_por_firebase_uids(
+                            db, [firebase_uid_destinatario], campos=['firebase_uid']
+                        ).get(firebase_uid_destinatario)
+                        if dono:
+                            _remover_token_legado(db, dono['id'], t, 'fcm')
                     logger.info(f"{logger_prefix}Token inválido removido do usuário {firebase_uid_destinatario}.")
                 except Exception as rem_err:
                     logger.error(f"{logger_prefix}Falha ao remover token inválido: {rem_err}")
@@ -1651,41 +2267,172 @@ def _send_data_push_to_tokens(
 # FUNÇÕES DE AGENDAMENTOS
 # =================================================================================
 
-def criar_agendamento(db: firestore.client, agendamento_data: schemas.AgendamentoCreate, cliente: schemas.UsuarioProfile) -> Dict:
-    """Cria um novo agendamento, desnormalizando os dados necessários."""
-    
-    profissional = buscar_profissional_por_id(db, agendamento_data.profissional_id)
-    servico_doc = db.collection('servicos').document(agendamento_data.servico_id).get()
+# --- Reservas de horário (trava de slot) ---
+# Cada agendamento ativo ocupa um documento em 'agenda_reservas' para cada bloco de
+# RESERVA_GRANULARIDADE_MINUTOS do seu intervalo [início, início + duração). Os
+# documentos são criados com `create` na mesma transação do agendamento, que também
+# consulta os bloqueios do intervalo: se alguma reserva já existir ou houver bloqueio,
+# nada é gravado. Cada reserva guarda o `agendamento_id` dono, e o cancelamento só
+# apaga as reservas do próprio agendamento. Agendamentos anteriores às reservas são
+# cobertos por `migrar_reservas_agendamentos`.
+RESERVAS_COLLECTION = 'agenda_reservas'
+RESERVA_GRANULARIDADE_MINUTOS = 5
+
+
+class HorarioIndisponivel(Exception):
+    """O intervalo pedido já está reservado por outro agendamento."""
+
+
+def _normalizar_data_hora(data_hora: datetime) -> datetime:
+    """Converte para UTC sem tzinfo (datetimes sem fuso já são tratados como UTC)."""
+    if data_hora.tzinfo is not None:
+        return data_hora.astimezone(timezone.utc).replace(tzinfo=None)
+    return data_hora
+
+
+def _refs_reserva_agendamento(db: firestore.client, profissional_id: str, data_hora: datetime, duracao_minutos: int) -> List:
+    """Referências dos documentos de reserva que cobrem o intervalo do agendamento."""
+    granularidade = timedelta(minutes=RESERVA_GRANULARIDADE_MINUTOS)
+    inicio = _normalizar_data_hora(data_hora)
+    fim = inicio + timedelta(minutes=duracao_minutos or AGENDAMENTO_DURACAO_PADRAO_MINUTOS)
+    bloco = inicio.replace(second=0, microsecond=0)
+    bloco -= timedelta(minutes=bloco.minute % RESERVA_GRANULARIDADE_MINUTOS)
+
+    refs = []
+    while bloco < fim:
+        refs.append((bloco, db.collection(RESERVAS_COLLECTION).document(f"{profissional_id}_{bloco:%Y%m%dT%H%M}")))
+        bloco += granularidade
+    return refs
+
+
+def _cancelar_e_liberar_reservas(db: firestore.client, agendamento_ref, novo_status: str) -> Dict:
+    """
+    Muda o status do agendamento e apaga suas reservas em uma única transação.
+
+    O agendamento é relido dentro da transação: só um agendamento ainda ativo libera
+    reservas (dois cancelamentos simultâneos não apagam nada duas vezes), e só são
+    apagadas as reservas cujo `agendamento_id` é o dele, nunca as de um agendamento
+    que já ocupou o horário liberado. Retorna o agendamento com o novo status.
+    """
+    @firestore.transactional
+    def _cancelar(transaction) -> Dict:
+        snapshot = agendamento_ref.get(transaction=transaction)
+        agendamento = snapshot.to_dict()
+        agendamento['id'] = snapshot.id
+
+        reservas = []
+        if agendamento.get('status') in STATUS_AGENDAMENTO_OCUPA_HORARIO:
+            refs = [ref for _, ref in _refs_reserva_agendamento(
+                db, agendamento['profissional_id'], agendamento['data_hora'], agendamento.get('servico_duracao_minutos')
+            )]
+            reservas = [
+                reserva for reserva in transaction.get_all(refs)
+                if reserva.exists and (reserva.to_dict() or {}).get('agendamento_id') == snapshot.id
+            ]
+
+        transaction.update(agendamento_ref, {"status": novo_status})
+        for reserva in reservas:
+            transaction.delete(reserva.reference)
+        agendamento['status'] = novo_status
+        return agendamento
+
+    return _cancelar(db.transaction())
+
+
+def migrar_reservas_agendamentos(db: firestore.client, now: Optional[datetime] = None) -> Dict[str, int]:
+    """
+    Migração única: cria as reservas dos agendamentos futuros ainda ativos
+    (pendente/confirmado) gravados antes da trava de horário. Reservas existentes
+    não são sobrescritas; blocos já ocupados por outro agendamento (conflitos
+    antigos) são contados e registrados no log. Pode ser executada mais de uma vez.
+    """
+    now = _normalizar_data_hora(now or datetime.now(timezone.utc))
+    stats = {"agendamentos": 0, "reservas_criadas": 0, "conflitos": 0}
+    query = db.collection('agendamentos')\
+        .where('status', 'in', STATUS_AGENDAMENTO_OCUPA_HORARIO)\
+        .where('data_hora', '>=', now)
+
+    batch = db.batch()
+    pendentes = 0
+    for ag in query.stream():
+        dados = ag.to_dict() or {}
+        if not dados.get('profissional_id') or not dados.get('data_hora'):
+            continue
+        stats["agendamentos"] += 1
+        blocos = _refs_reserva_agendamento(
+            db, dados['profissional_id'], dados['data_hora'], dados.get('servico_duracao_minutos')
+        )
+        existentes = {snap.reference.path: snap for snap in db.get_all([ref for _, ref in blocos])}
+        for bloco, reserva_ref in blocos:
+            reserva = existentes.get(reserva_ref.path)
+            if reserva is not None and reserva.exists:
+                if (reserva.to_dict() or {}).get('agendamento_id') != ag.id:
+                    stats["conflitos"] += 1
+                    logger.warning(f"⚠️ Bloco {reserva_ref.id} já reservado; agendamento {ag.id} em conflito.")
+                continue
+            batch.set(reserva_ref, {
+                "profissional_id": dados['profissional_id'],
+                "dia": bloco.date().isoformat(),
+                "inicio": bloco,
+                "agendamento_id": ag.id,
+            })
+            stats["reservas_criadas"] += 1
+            pendentes += 1
+            if pendentes >= 400:
+                batch.commit()
+                batch = db.batch()
+                pendentes = 0
+
+    if pendentes:
+        batch.commit()
+    logger.info(f"📅 Migração de reservas de agendamentos concluída: {stats}")
+    return stats
+
+
+def criar_agendamento(
+    db: firestore.client,
+    agendamento_data: schemas.AgendamentoCreate,
+    cliente: schemas.UsuarioProfile,
+    background_tasks: Optional[BackgroundTasks] = None
+) -> Dict:
+    """
+    Cria um novo agendamento, desnormalizando os dados necessários.
+
+    Profissional e serviço são lidos juntos em um único get_all; o cliente já vem
+    carregado (e descriptografado) da autenticação. Se `background_tasks` for
+    informado, a notificação ao profissional é enviada depois da resposta.
+    """
+    prof_ref = db.collection('profissionais').document(agendamento_data.profissional_id)
+    servico_ref = db.collection('servicos').document(agendamento_data.servico_id)
+    snapshots = {snap.reference.path: snap for snap in db.get_all([prof_ref, servico_ref])}
+    prof_doc = snapshots.get(prof_ref.path)
+    servico_doc = snapshots.get(servico_ref.path)
 
-    if not profissional or not servico_doc.exists:
+    if not prof_doc or not prof_doc.exists or not servico_doc or not servico_doc.exists:
         raise ValueError("Profissional ou serviço não encontrado.")
 
+    profissional = prof_doc.to_dict()
+    profissional['id'] = prof_doc.id
     servico = servico_doc.to_dict()
 
-    # Enriquecer profissional com dados do usuário (nome descriptografado) ANTES de construir agendamento_dict
+    # Enriquecer profissional com dados do usuário (nome descriptografado) ANTES de construir agendamento_dict.
+    # O mesmo documento é reaproveitado na notificação.
     firebase_uid = profissional.get('usuario_uid')
     nome_profissional_real = profissional.get('nome', 'Profissional')
+    prof_user = None
     if firebase_uid:
-        usuario_doc = buscar_usuario_por_firebase_uid(db, firebase_uid)
-        if usuario_doc:
-            nome_profissional_real = usuario_doc.get('nome', nome_profissional_real)
-            logger.info(f"🔧 AGENDAMENTO - Nome do profissional enriquecido: {nome_profissional_real}")
+        prof_user = buscar_usuario_por_firebase_uid(db, firebase_uid)
+        if prof_user:
+            nome_profissional_real = prof_user.get('nome', nome_profissional_real)
         else:
             logger.warning(f"🔧 AGENDAMENTO - Usuário não encontrado para firebase_uid: {firebase_uid}")
 
-    # Enriquecer cliente com dados reais do usuário
-    nome_cliente_real = cliente.nome
-    cliente_doc = buscar_usuario_por_firebase_uid(db, cliente.firebase_uid)
-    if cliente_doc:
-        nome_cliente_real = cliente_doc.get('nome', cliente.nome)
-        logger.info(f"🔧 AGENDAMENTO - Nome do cliente enriquecido: {nome_cliente_real}")
-
     agendamento_dict = {
         "negocio_id": agendamento_data.negocio_id,
         "data_hora": agendamento_data.data_hora,
         "status": "pendente",
         "cliente_id": cliente.id,
-        "cliente_nome": nome_cliente_real,
+        "cliente_nome": cliente.nome,
         "profissional_id": profissional['id'],
         "profissional_nome": nome_profissional_real,
         "profissional_foto_thumbnail": profissional.get('fotos', {}).get('thumbnail'),
@@ -1696,63 +2443,92 @@ def criar_agendamento(db: firestore.client, agendamento_data: schemas.Agendament
     }
 
     doc_ref = db.collection('agendamentos').document()
-    doc_ref.set(agendamento_dict)
-    
-    agendamento_dict['id'] = doc_ref.id
-    
-    # --- INÍCIO DA LÓGICA DE NOTIFICAÇÃO ---
-    prof_user = buscar_usuario_por_firebase_uid(db, profissional['usuario_uid'])
-    if prof_user: # Verifica se o usuário profissional existe
-        data_formatada = agendamento_data.data_hora.strftime('%d/%m/%Y')
-        hora_formatada = agendamento_data.data_hora.strftime('%H:%M')
-        mensagem_body = f"Você tem um novo agendamento com {cliente.nome} para o dia {data_formatada} às {hora_formatada}."
-        
-        # 1. Persistir a notificação no Firestore
-        try:
-            notificacao_id = f"NOVO_AGENDAMENTO:{doc_ref.id}"
-            dedupe_key = notificacao_id
-            
-            notificacao_doc_ref = db.collection('usuarios').document(prof_user['id']).collection('notificacoes').document(notificacao_id)
-            
-            notificacao_doc_ref.set({
-                "title": "Novo Agendamento!",
-                "body": mensagem_body,
-                "tipo": "NOVO_AGENDAMENTO",
-                "relacionado": { "agendamento_id": doc_ref.id },
-                "lida": False,
-                "data_criacao": firestore.SERVER_TIMESTAMP,
-                "dedupe_key": dedupe_key
+    inicio = _normalizar_data_hora(agendamento_data.data_hora)
+    fim = inicio + timedelta(minutes=servico['duracao_minutos'] or AGENDAMENTO_DURACAO_PADRAO_MINUTOS)
+    bloqueios_query = prof_ref.collection('bloqueios')\
+        .where('inicio', '<', fim)\
+        .where('fim', '>', inicio)\
+        .limit(1)
+
+    # Confere os bloqueios, reserva o intervalo e grava o agendamento em uma única transação
+    @firestore.transactional
+    def _reservar(transaction):
+        if list(transaction.get(bloqueios_query)):
+            raise HorarioIndisponivel("Este horário está bloqueado na agenda do profissional.")
+        for bloco, reserva_ref in _refs_reserva_agendamento(
+            db, profissional['id'], agendamento_data.data_hora, servico['duracao_minutos']
+        ):
+            transaction.create(reserva_ref, {
+                "profissional_id": profissional['id'],
+                "dia": bloco.date().isoformat(),
+                "inicio": bloco,
+                "agendamento_id": doc_ref.id,
             })
-            logger.info(f"Notificação de novo agendamento PERSISTIDA para o profissional {profissional['id']}.")
-        except Exception as e:
-            logger.error(f"Erro ao PERSISTIR notificação de novo agendamento: {e}")
+        transaction.set(doc_ref, agendamento_dict)
 
-        # 2. Enviar a notificação via FCM, se houver tokens
-        if prof_user.get('fcm_tokens'):
-            titulo = "Novo Agendamento!"
-            corpo = mensagem_body
+    try:
+        _reservar(db.transaction())
+    except AlreadyExists:
+        raise HorarioIndisponivel("Este horário não está mais disponível.")
+    
+    agendamento_dict['id'] = doc_ref.id
+    _invalidar_cache_agendamento(agendamento_dict)
 
-            data_payload = {
-                "tipo": "NOVO_AGENDAMENTO",
-                "agendamento_id": doc_ref.id
-            }
-            try:
-                _send_data_push_to_tokens(
-                    db=db,
-                    firebase_uid_destinatario=profissional['usuario_uid'],
-                    tokens=prof_user['fcm_tokens'],
-                    data_dict=data_payload,
-                    logger_prefix="[Novo agendamento] ",
-                    notification_title=titulo,
-                    notification_body=corpo
-                )
-            except Exception as e:
-                logger.error(f"Erro ao ENVIAR notificação de novo agendamento: {e}")
-    # --- FIM DA LÓGICA DE NOTIFICAÇÃO ---
+    if prof_user:
+        if background_tasks is not None:
+            background_tasks.add_task(_notificar_profissional_novo_agendamento, db, agendamento_dict, prof_user)
+        else:
+            _notificar_profissional_novo_agendamento(db, agendamento_dict, prof_user)
 
     return agendamento_dict
 
 
+def _notificar_profissional_novo_agendamento(db: firestore.client, agendamento: Dict, prof_user: Dict):
+    """Persiste e envia ao profissional a notificação de novo agendamento."""
+    agendamento_id = agendamento['id']
+    data_formatada = agendamento['data_hora'].strftime('%d/%m/%Y')
+    hora_formatada = agendamento['data_hora'].strftime('%H:%M')
+    mensagem_body = f"Você tem um novo agendamento com {agendamento['cliente_nome']} para o dia {data_formatada} às {hora_formatada}."
+
+    # 1. Persistir a notificação no Firestore
+    try:
+        notificacao_id = f"NOVO_AGENDAMENTO:{agendamento_id}"
+        dedupe_key = notificacao_id
+
+        _persistir_notificacao(db, prof_user['id'], {
+            "title": "Novo Agendamento!",
+            "body": mensagem_body,
+            "tipo": "NOVO_AGENDAMENTO",
+            "relacionado": { "agendamento_id": agendamento_id },
+            "lida": False,
+            "data_criacao": firestore.SERVER_TIMESTAMP,
+            "dedupe_key": dedupe_key
+        }, notificacao_id)
+        logger.info(f"Notificação de novo agendamento PERSISTIDA para o profissional {agendamento['profissional_id']}.")
+    except Exception as e:
+        logger.error(f"Erro ao PERSISTIR notificação de novo agendamento: {e}")
+
+    # 2. Enviar a notificação via FCM, se houver tokens
+    tokens_fcm, _ = buscar_tokens_do_usuario(db, prof_user['id'])
+    if tokens_fcm:
+        data_payload = {
+            "tipo": "NOVO_AGENDAMENTO",
+            "agendamento_id": agendamento_id
+        }
+        try:
+            _send_data_push_to_tokens(
+                db=db,
+                firebase_uid_destinatario=prof_user['firebase_uid'],
+                tokens=tokens_fcm,
+                data_dict=data_payload,
+                logger_prefix="[Novo agendamento] ",
+                notification_title="Novo Agendamento!",
+                notification_body=mensagem_body
+            )
+        except Exception as e:
+            logger.error(f"Erro ao ENVIAR notificação de novo agendamento: {e}")
+
+
 def cancelar_agendamento(db: firestore.client, agendamento_id: str, cliente_id: str) -> Optional[Dict]:
     """
     Cancela um agendamento a pedido do cliente, atualizando seu status.
@@ -1769,8 +2545,8 @@ def cancelar_agendamento(db: firestore.client, agendamento_id: str, cliente_id:
     if agendamento.get('cliente_id') != cliente_id:
         return None
     
-    agendamento_ref.update({"status": "cancelado_pelo_cliente"})
-    agendamento["status"] = "cancelado_pelo_cliente"
+    agendamento = _cancelar_e_liberar_reservas(db, agendamento_ref, "cancelado_pelo_cliente")
+    _invalidar_cache_agendamento(agendamento)
         
     profissional = buscar_profissional_por_id(db, agendamento['profissional_id'])
     if profissional:
@@ -1785,9 +2561,7 @@ def cancelar_agendamento(db: firestore.client, agendamento_id: str, cliente_id:
                 notificacao_id = f"AGENDAMENTO_CANCELADO_CLIENTE:{agendamento_id}"
                 dedupe_key = notificacao_id
                 
-                notificacao_doc_ref = db.collection('usuarios').document(prof_user['id']).collection('notificacoes').document(notificacao_id)
-                
-                notificacao_doc_ref.set({
+                _persistir_notificacao(db, prof_user['id'], {
                     "title": "Agendamento Cancelado",
                     "body": mensagem_body,
                     "tipo": "AGENDAMENTO_CANCELADO_CLIENTE",
@@ -1795,13 +2569,14 @@ def cancelar_agendamento(db: firestore.client, agendamento_id: str, cliente_id:
                     "lida": False,
                     "data_criacao": firestore.SERVER_TIMESTAMP,
                     "dedupe_key": dedupe_key
-                })
+                }, notificacao_id)
                 logger.info(f"Notificação de cancelamento pelo cliente PERSISTIDA para o profissional {profissional['id']}.")
             except Exception as e:
                 logger.error(f"Erro ao PERSISTIR notificação de cancelamento pelo cliente: {e}")
 
             # 2. Enviar a notificação via FCM, se houver tokens
-            if prof_user.get('fcm_tokens'):
+            tokens_fcm, _ = buscar_tokens_do_usuario(db, prof_user['id'])
+            if tokens_fcm:
                 titulo = "Agendamento Cancelado"
                 corpo = mensagem_body
 
@@ -1812,7 +2587,7 @@ def cancelar_agendamento(db: firestore.client, agendamento_id: str, cliente_id:
                     _send_data_push_to_tokens(
                         db=db,
                         firebase_uid_destinatario=profissional['usuario_uid'],
-                        tokens=prof_user['fcm_tokens'],
+                        tokens=tokens_fcm,
                         data_dict=data_payload,
                         logger_prefix="[Cancelamento pelo cliente] ",
                         notification_title=titulo,
@@ -1842,9 +2617,9 @@ def cancelar_agendamento_pelo_profissional(db: firestore.client, agendamento_id:
         logger.warning(f"Profissional {profissional_id} tentou cancelar agendamento {agendamento_id} sem permissão.")
         return None  # Profissional não autorizado
 
-    # Atualiza o status
-    agendamento_ref.update({"status": "cancelado_pelo_profissional"})
-    agendamento["status"] = "cancelado_pelo_profissional"
+    # Atualiza o status e libera o horário
+    agendamento = _cancelar_e_liberar_reservas(db, agendamento_ref, "cancelado_pelo_profissional")
+    _invalidar_cache_agendamento(agendamento)
     logger.info(f"Agendamento {agendamento_id} cancelado pelo profissional {profissional_id}.")
     
     # Dispara a notificação para o cliente
@@ -1880,6 +2655,7 @@ def confirmar_agendamento_pelo_profissional(db: firestore.client, agendamento_id
     # Atualiza o status
     agendamento_ref.update({"status": "confirmado"})
     agendamento["status"] = "confirmado"
+    _invalidar_cache_agendamento(agendamento)
     logger.info(f"Agendamento {agendamento_id} confirmado pelo profissional {profissional_id}.")
 
     # Dispara a notificação para o cliente
@@ -1888,11 +2664,52 @@ def confirmar_agendamento_pelo_profissional(db: firestore.client, agendamento_id
     return agendamento
 
 
-def listar_agendamentos_por_cliente(db: firestore.client, negocio_id: str, cliente_id: str) -> List[Dict]:
-    """Lista os agendamentos de um cliente em um negócio específico."""
+AGENDAMENTOS_PAGINA_PADRAO = 50
+AGENDAMENTOS_PAGINA_MAXIMA = 200
+# Sem `desde`, a agenda mostra os próximos agendamentos e os deste período para trás
+AGENDAMENTOS_JANELA_PASSADA_DIAS = 30
+
+
+def _listar_agendamentos(
+    db: firestore.client,
+    negocio_id: str,
+    campo_dono: str,
+    dono_id: str,
+    desde: Optional[datetime],
+    ate: Optional[datetime],
+    limit: int,
+    after: Optional[str]
+) -> List[Dict]:
+    """
+    Consulta paginada de agendamentos de um cliente ou profissional, do mais recente
+    para o mais antigo, dentro da janela [desde, ate]. `after` é o ID do último
+    agendamento da página anterior. Usa os índices compostos
+    (negocio_id, cliente_id|profissional_id, data_hora DESC) de firestore.indexes.json.
+    """
+    if desde is None:
+        desde = datetime.now(timezone.utc) - timedelta(days=AGENDAMENTOS_JANELA_PASSADA_DIAS)
+    desde = _normalizar_data_hora(desde)
+    ate = _normalizar_data_hora(ate) if ate is not None else None
+    if ate is not None and ate < desde:
+        raise ValueError("'ate' deve ser posterior a 'desde'.")
+    limit = max(1, min(limit, AGENDAMENTOS_PAGINA_MAXIMA))
+
+    agendamentos_ref = db.collection('agendamentos')
+    query = agendamentos_ref.where('negocio_id', '==', negocio_id)\
+        .where(campo_dono, '==', dono_id)\
+        .where('data_hora', '>=', desde)
+    if ate is not None:
+        query = query.where('data_hora', '<=', ate)
+    query = query.order_by('data_hora', direction=firestore.Query.DESCENDING).limit(limit)
+
+    if after:
+        cursor_doc = agendamentos_ref.document(after).get()
+        cursor_data = cursor_doc.to_dict() if cursor_doc.exists else {}
+        if cursor_data.get('negocio_id') != negocio_id or cursor_data.get(campo_dono) != dono_id:
+            raise ValueError("Cursor de paginação inválido.")
+        query = query.start_after(cursor_doc)
+
     agendamentos = []
-    query = db.collection('agendamentos').where('negocio_id', '==', negocio_id).where('cliente_id', '==', cliente_id).order_by('data_hora', direction=firestore.Query.DESCENDING)
-    
     for doc in query.stream():
         ag_data = doc.to_dict()
         ag_data['id'] = doc.id
@@ -1924,41 +2741,31 @@ def listar_agendamentos_por_cliente(db: firestore.client, negocio_id: str, clien
     
     return agendamentos
 
-def listar_agendamentos_por_profissional(db: firestore.client, negocio_id: str, profissional_id: str) -> List[Dict]:
-    """Lista os agendamentos de um profissional em um negócio específico."""
-    agendamentos = []
-    query = db.collection('agendamentos').where('negocio_id', '==', negocio_id).where('profissional_id', '==', profissional_id).order_by('data_hora', direction=firestore.Query.DESCENDING)
-    
-    for doc in query.stream():
-        ag_data = doc.to_dict()
-        ag_data['id'] = doc.id
-        
-        # Descriptografa nomes se estiverem criptografados (detecta pelo padrão gAAAAA)
-        if 'cliente_nome' in ag_data and ag_data['cliente_nome']:
-            cliente_nome = ag_data['cliente_nome']
-            if isinstance(cliente_nome, str) and cliente_nome.startswith('gAAAAA'):
-                try:
-                    ag_data['cliente_nome'] = decrypt_data(cliente_nome)
-                    logger.info(f"🔓 Cliente nome descriptografado no agendamento {doc.id}")
-                except Exception as e:
-                    logger.error(f"Erro ao descriptografar cliente_nome no agendamento {doc.id}: {e}")
-                    ag_data['cliente_nome'] = "[Erro na descriptografia]"
-            # Se não começa com gAAAAA, mantém o valor original (não criptografado)
 
-        if 'profissional_nome' in ag_data and ag_data['profissional_nome']:
-            profissional_nome = ag_data['profissional_nome']
-            if isinstance(profissional_nome, str) and profissional_nome.startswith('gAAAAA'):
-                try:
-                    ag_data['profissional_nome'] = decrypt_data(profissional_nome)
-                    logger.info(f"🔓 Profissional nome descriptografado no agendamento {doc.id}")
-                except Exception as e:
-                    logger.error(f"Erro ao descriptografar profissional_nome no agendamento {doc.id}: {e}")
-                    ag_data['profissional_nome'] = "[Erro na descriptografia]"
-            # Se não começa com gAAAAA, mantém o valor original (não criptografado)
-        
-        agendamentos.append(ag_data)
-        
-    return agendamentos
+def listar_agendamentos_por_cliente(
+    db: firestore.client,
+    negocio_id: str,
+    cliente_id: str,
+    desde: Optional[datetime] = None,
+    ate: Optional[datetime] = None,
+    limit: int = AGENDAMENTOS_PAGINA_PADRAO,
+    after: Optional[str] = None
+) -> List[Dict]:
+    """Lista os agendamentos de um cliente em um negócio específico (janela de datas + cursor)."""
+    return _listar_agendamentos(db, negocio_id, 'cliente_id', cliente_id, desde, ate, limit, after)
+
+
+def listar_agendamentos_por_profissional(
+    db: firestore.client,
+    negocio_id: str,
+    profissional_id: str,
+    desde: Optional[datetime] = None,
+    ate: Optional[datetime] = None,
+    limit: int = AGENDAMENTOS_PAGINA_PADRAO,
+    after: Optional[str] = None
+) -> List[Dict]:
+    """Lista os agendamentos de um profissional em um negócio específico (janela de datas + cursor)."""
+    return _listar_agendamentos(db, negocio_id, 'profissional_id', profissional_id, desde, ate, limit, after)
 
 # =================================================================================
 # FUNÇÕES DE FEED E INTERAÇÕES
@@ -1981,10 +2788,12 @@ def criar_postagem(db: firestore.client, postagem_data: schemas.PostagemCreate,
     post_dict['profissional_foto_thumbnail'] = profissional.get('fotos', {}).get('thumbnail')
     post_dict['total_curtidas'] = 0
     post_dict['total_comentarios'] = 0
+    post_dict['contadores_sharded'] = True
     
     doc_ref = db.collection('postagens').document()
     doc_ref.set(post_dict)
     post_dict['id'] = doc_ref.id
+    _incrementar_versao_feed(db, post_dict.get('negocio_id'))
     return post_dict
 
 def listar_postagens_por_profissional(db: firestore.client, profissional_id: str) -> List[Dict]:
@@ -2000,65 +2809,276 @@ def listar_postagens_por_profissional(db: firestore.client, profissional_id: str
         postagens.append(post_data)
     return postagens
 
-def listar_feed_por_negocio(db: firestore.client, negocio_id: str, user_id: Optional[str] = None) -> List[Dict]:
-    """Lista o feed de postagens de um negócio específico."""
-    postagens = []
-    query = db.collection('postagens')\
+FEED_PAGINA_PADRAO = 20
+FEED_PAGINA_MAXIMA = 100
+
+# --- Cache do feed por negócio ---
+# Cada negócio tem um carimbo de versão em 'feed_versoes/{negocio_id}', incrementado
+# só quando o conteúdo muda: postagem criada ou apagada, thumbnail sincronizada e a
+# consolidação periódica dos contadores. Curtidas e comentários não tocam o carimbo
+# (seria um documento disputado por negócio): descartam só as páginas em memória do
+# negócio nesta instância (`_invalidar_feed_local`); nas demais, a prévia de
+# comentários se atualiza em até FEED_CACHE_TTL_SEGUNDOS.
+# As páginas (sem a marcação de curtida, que é por usuário) ficam em memória
+# enquanto a versão não muda.
+FEED_VERSOES_COLLECTION = 'feed_versoes'
+FEED_CACHE_TTL_SEGUNDOS = int(os.getenv('FEED_CACHE_TTL_SEGUNDOS', '300'))
+FEED_CACHE_MAX_PAGINAS = 1000
+
+_feed_cache: Dict[tuple, Tuple[int, float, List[Dict]]] = {}
+_feed_cache_lock = threading.Lock()
+
+
+def _incrementar_versao_feed(db: firestore.client, negocio_id: Optional[str], transaction=None):
+    """Invalida as páginas em cache do feed do negócio (em todas as instâncias)."""
+    if not negocio_id:
+        return
+    versao_ref = db.collection(FEED_VERSOES_COLLECTION).document(negocio_id)
+    dados = {'versao': firestore.Increment(1), 'atualizado_em': firestore.SERVER_TIMESTAMP}
+    if transaction is not None:
+        transaction.set(versao_ref, dados, merge=True)
+    else:
+        versao_ref.set(dados, merge=True)
+
+
+def _invalidar_feed_local(negocio_id: Optional[str]):
+    """Descarta as páginas do feed do negócio em cache nesta instância (com e sem prévia)."""
+    if not negocio_id:
+        return
+    with _feed_cache_lock:
+        for chave in [chave for chave in _feed_cache if chave[0] == negocio_id]:
+            del _feed_cache[chave]
+
+
+def _versao_feed(db: firestore.client, negocio_id: str) -> int:
+    doc = db.collection(FEED_VERSOES_COLLECTION).document(negocio_id).get()
+    return (doc.to_dict() or {}).get('versao', 0) if doc.exists else 0
+
+
+def obter_feed_por_negocio(
+    db: firestore.client,
+    negocio_id: str,
+    user_id: Optional[str] = None,
+    limit: int = FEED_PAGINA_PADRAO,
+    after: Optional[str] = None,
+    if_none_match: Optional[str] = None,
+    preview_comentarios: int = 0
+) -> Tuple[Optional[List[Dict]], str]:
+    """
+    Versão com cache de `listar_feed_por_negocio`. Retorna (postagens, etag); se o
+    `If-None-Match` do cliente ainda corresponder à versão atual e às curtidas do
+    usuário na página, retorna (None, etag). Com `preview_comentarios` > 0, cada postagem traz
+    os últimos comentários em `comentarios_recentes` (também em cache).
+    """
+    limit = max(1, min(limit, FEED_PAGINA_MAXIMA))
+    preview_comentarios = max(0, min(preview_comentarios, COMENTARIOS_PREVIEW_MAXIMO))
+    versao = _versao_feed(db, negocio_id)
+
+    chave = (negocio_id, limit, after, preview_comentarios)
+    agora = datetime.now(timezone.utc).timestamp()
+    with _feed_cache_lock:
+        entrada = _feed_cache.get(chave)
+    if entrada and entrada[0] == versao and entrada[1] > agora:
+        postagens = [dict(post) for post in entrada[2]]
+    else:
+        postagens = listar_feed_por_negocio(db, negocio_id, None, limit=limit, after=after)
+        if preview_comentarios and postagens:
+            with ThreadPoolExecutor(max_workers=min(len(postagens), 8)) as executor:
+                previews = executor.map(
+                    lambda post: listar_comentarios_recentes(db, post['id'], preview_comentarios), postagens
+                )
+                for post, comentarios in zip(postagens, previews):
+                    post['comentarios_recentes'] = comentarios
+        with _feed_cache_lock:
+            if len(_feed_cache) >= FEED_CACHE_MAX_PAGINAS:
+                _feed_cache.clear()
+            _feed_cache[chave] = (versao, agora + FEED_CACHE_TTL_SEGUNDOS, [dict(post) for post in postagens])
+
+    # As curtidas do usuário não mudam a versão do feed, então entram no ETag:
+    # curtir ou descurtir algo da página gera um ETag novo só para quem curtiu.
+    if user_id and postagens:
+        _marcar_curtidas_do_usuario(db, postagens, user_id)
+    curtidas = ','.join(sorted(post['id'] for post in postagens if post.get('curtido_pelo_usuario')))
+    assinatura = f"{negocio_id}:{versao}:{limit}:{after or ''}:{preview_comentarios}:{curtidas}"
+    etag = f'W/"{hashlib.sha1(assinatura.encode()).hexdigest()[:20]}"'
+    if if_none_match and etag in [valor.strip() for valor in if_none_match.split(',')]:
+        return None, etag
+    return postagens, etag
+
+
+def listar_feed_por_negocio(
+    db: firestore.client,
+    negocio_id: str,
+    user_id: Optional[str] = None,
+    limit: int = FEED_PAGINA_PADRAO,
+    after: Optional[str] = None
+) -> List[Dict]:
+    """
+    Lista o feed de postagens de um negócio, da mais recente para a mais antiga.
+    Paginado por cursor em `data_postagem`: `after` é o ID da última postagem da página anterior.
+    Nome e foto do profissional já estão desnormalizados na postagem (ver
+    `_atualizar_thumbnail_postagens`), então a leitura não faz joins.
+    """
+    postagens_ref = db.collection('postagens')
+    limit = max(1, min(limit, FEED_PAGINA_MAXIMA))
+    query = postagens_ref\
         .where('negocio_id', '==', negocio_id)\
-        .order_by('data_postagem', direction=firestore.Query.DESCENDING)
-        
-    # Cache para perfis de profissionais já buscados, para evitar múltiplas leituras do mesmo perfil
-    perfis_profissionais_cache = {}
+        .order_by('data_postagem', direction=firestore.Query.DESCENDING)\
+        .limit(limit)
 
+    if after:
+        cursor_doc = postagens_ref.document(after).get()
+        if not cursor_doc.exists or cursor_doc.to_dict().get('negocio_id') != negocio_id:
+            raise ValueError("Cursor de paginação inválido.")
+        query = query.start_after(cursor_doc)
+
+    postagens = []
     for doc in query.stream():
         post_data = doc.to_dict()
         post_data['id'] = doc.id
-        
-        # --- INÍCIO DA CORREÇÃO ---
-        profissional_id = post_data.get('profissional_id')
-        if profissional_id in perfis_profissionais_cache:
-            perfil_profissional = perfis_profissionais_cache[profissional_id]
-        else:
-            perfil_profissional = buscar_profissional_por_id(db, profissional_id)
-            perfis_profissionais_cache[profissional_id] = perfil_profissional
-        
-        if perfil_profissional:
-            post_data['profissional_foto_thumbnail'] = perfil_profissional.get('fotos', {}).get('thumbnail')
-        # --- FIM DA CORREÇÃO ---
-
         post_data['curtido_pelo_usuario'] = False
-        if user_id:
-            curtida_ref = db.collection('postagens').document(doc.id).collection('curtidas').document(user_id)
-            if curtida_ref.get().exists:
-                post_data['curtido_pelo_usuario'] = True
-                
         postagens.append(post_data)
+
+    if user_id and postagens:
+        _marcar_curtidas_do_usuario(db, postagens, user_id)
     return postagens
 
+
+def _marcar_curtidas_do_usuario(db: firestore.client, postagens: List[Dict], user_id: str):
+    """Preenche 'curtido_pelo_usuario' de todas as postagens com um único get_all nas curtidas."""
+    curtida_refs = [
+        db.collection('postagens').document(post['id']).collection('curtidas').document(user_id)
+        for post in postagens
+    ]
+    curtidas = {snap.reference.parent.parent.id for snap in db.get_all(curtida_refs) if snap.exists}
+    for post in postagens:
+        post['curtido_pelo_usuario'] = post['id'] in curtidas
+
+# --- Contadores distribuídos de curtidas/comentários ---
+# Cada postagem tem POSTAGEM_CONTADOR_SHARDS documentos em 'contadores_shards'; cada
+# escrita incrementa um shard sorteado, então uma postagem popular não fica limitada
+# às escritas por segundo de um único documento. `total_curtidas`/`total_comentarios`
+# na postagem são recalculados periodicamente por `consolidar_contadores_postagens`;
+# até lá, os totais servidos no feed ficam defasados (documentado em PostagemResponse).
+POSTAGEM_CONTADOR_SHARDS = int(os.getenv('POSTAGEM_CONTADOR_SHARDS', '10'))
+CONTADORES_SHARDS_COLLECTION = 'contadores_shards'
+# Documento com os totais que a postagem tinha antes dos shards
+CONTADOR_BASE_ID = 'base'
+CONSOLIDACAO_CONTADORES_ESTADO = ('jobs_estado', 'consolidacao_contadores_postagens')
+
+
+def _shard_contador_ref(db: firestore.client, postagem_id: str):
+    shard = str(secrets.randbelow(POSTAGEM_CONTADOR_SHARDS))
+    return db.collection('postagens').document(postagem_id).collection(CONTADORES_SHARDS_COLLECTION).document(shard)
+
+
+def _incrementar_contador_postagem(db: firestore.client, postagem_id: str, campo: str, valor: int, transaction=None):
+    """Incrementa `campo` ('curtidas' ou 'comentarios') em um shard aleatório da postagem."""
+    shard_ref = _shard_contador_ref(db, postagem_id)
+    dados = {campo: firestore.Increment(valor), 'atualizado_em': firestore.SERVER_TIMESTAMP}
+    if transaction is not None:
+        transaction.set(shard_ref, dados, merge=True)
+    else:
+        shard_ref.set(dados, merge=True)
+
+
+def consolidar_contadores_postagens(db: firestore.client, now: Optional[datetime] = None) -> Dict[str, int]:
+    """
+    Soma os shards das postagens que receberam curtidas/comentários desde a última
+    execução e grava os totais na postagem. Postagens anteriores aos shards têm seus
+    totais antigos preservados no documento 'base' na primeira consolidação.
+    Invalida o feed dos negócios afetados.
+    """
+    now = now or datetime.now(timezone.utc)
+    estado_ref = db.collection(CONSOLIDACAO_CONTADORES_ESTADO[0]).document(CONSOLIDACAO_CONTADORES_ESTADO[1])
+    estado_doc = estado_ref.get()
+    ultima_execucao = (estado_doc.to_dict() or {}).get('ultima_execucao') if estado_doc.exists else None
+    # Margem para escritas que receberam timestamp antes de a execução anterior terminar
+    desde = (ultima_execucao or datetime(1970, 1, 1, tzinfo=timezone.utc)) - timedelta(minutes=1)
+
+    alterados = db.collection_group(CONTADORES_SHARDS_COLLECTION)\
+        .where('atualizado_em', '>=', desde)\
+        .select([firestore.FieldPath.document_id()])
+    post_refs = {doc.reference.parent.parent.path: doc.reference.parent.parent for doc in alterados.stream()}
+
+    stats = {"postagens": 0, "atualizadas": 0}
+    negocios = set()
+    refs = list(post_refs.values())
+    for inicio in range(0, len(refs), 100):
+        batch = db.batch()
+        for post_doc in db.get_all(refs[inicio:inicio + 100]):
+            if not post_doc.exists:
+                continue
+            stats["postagens"] += 1
+            post = post_doc.to_dict()
+            shards_ref = post_doc.reference.collection(CONTADORES_SHARDS_COLLECTION)
+
+            totais = {'curtidas': 0, 'comentarios': 0}
+            tem_base = False
+            for shard in shards_ref.stream():
+                dados = shard.to_dict() or {}
+                tem_base = tem_base or shard.id == CONTADOR_BASE_ID
+                for campo in totais:
+                    totais[campo] += dados.get(campo, 0) or 0
+
+            atualizacao = {}
+            if not post.get('contadores_sharded'):
+                if not tem_base:
+                    base = {'curtidas': post.get('total_curtidas', 0) or 0, 'comentarios': post.get('total_comentarios', 0) or 0}
+                    batch.set(shards_ref.document(CONTADOR_BASE_ID), base)
+                    for campo in totais:
+                        totais[campo] += base[campo]
+                atualizacao['contadores_sharded'] = True
+
+            total_curtidas = max(totais['curtidas'], 0)
+            total_comentarios = max(totais['comentarios'], 0)
+            if post.get('total_curtidas') != total_curtidas or post.get('total_comentarios') != total_comentarios:
+                atualizacao.update({'total_curtidas': total_curtidas, 'total_comentarios': total_comentarios})
+                negocios.add(post.get('negocio_id'))
+            if atualizacao:
+                batch.update(post_doc.reference, atualizacao)
+                stats["atualizadas"] += 1
+        batch.commit()
+
+    for negocio_id in negocios:
+        _incrementar_versao_feed(db, negocio_id)
+    estado_ref.set({'ultima_execucao': now}, merge=True)
+    logger.info(f"❤️ Consolidação de contadores das postagens concluída: {stats}")
+    return stats
+
+
 def toggle_curtida(db: firestore.client, postagem_id: str, user_id: str) -> bool:
-    """Adiciona ou remove uma curtida de uma postagem."""
+    """
+    Adiciona ou remove uma curtida de uma postagem. O `total_curtidas` da postagem só
+    reflete a mudança na próxima `consolidar_contadores_postagens`.
+    """
     post_ref = db.collection('postagens').document(postagem_id)
     curtida_ref = post_ref.collection('curtidas').document(user_id)
-    
-    curtida_doc = curtida_ref.get()
-    
+
+    # A transação só lê a postagem (leituras não disputam o documento) e escreve
+    # a curtida do usuário e um shard do contador, então curtidas simultâneas na
+    # mesma postagem não disputam o mesmo documento. Ler a postagem na transação
+    # impede curtir uma postagem apagada entre a checagem e a escrita.
     @firestore.transactional
-    def update_in_transaction(transaction, post_reference, curtida_reference, curtida_existe):
-        if curtida_existe:
+    def update_in_transaction(transaction, curtida_reference):
+        post_doc = post_ref.get(transaction=transaction)
+        if not post_doc.exists:
+            raise ValueError("Postagem não encontrada.")
+        negocio_id = post_doc.to_dict().get('negocio_id')
+        curtida_doc = curtida_reference.get(transaction=transaction)
+        if curtida_doc.exists:
             transaction.delete(curtida_reference)
-            transaction.update(post_reference, {
-                'total_curtidas': firestore.Increment(-1)
-            })
-            return False  # Descurtiu
-        else:
-            transaction.set(curtida_reference, {'data': datetime.utcnow()})
-            transaction.update(post_reference, {
-                'total_curtidas': firestore.Increment(1)
-            })
-            return True  # Curtiu
-
-    transaction = db.transaction()
-    return update_in_transaction(transaction, post_ref, curtida_ref, curtida_doc.exists)
+            _incrementar_contador_postagem(db, postagem_id, 'curtidas', -1, transaction)
+            return False, negocio_id  # Descurtiu
+        transaction.set(curtida_reference, {'data': datetime.utcnow()})
+        _incrementar_contador_postagem(db, postagem_id, 'curtidas', 1, transaction)
+        return True, negocio_id  # Curtiu
+
+    # O carimbo de versão do feed não é tocado aqui (documento disputado); basta
+    # descartar as páginas locais do negócio.
+    curtiu, negocio_id = update_in_transaction(db.transaction(), curtida_ref)
+    _invalidar_feed_local(negocio_id)
+    return curtiu
 
 def criar_comentario(db: firestore.client, comentario_data: schemas.ComentarioCreate, usuario: schemas.UsuarioProfile) -> Dict:
     """Cria um novo comentário e atualiza o contador na postagem."""
@@ -2072,42 +3092,234 @@ def criar_comentario(db: firestore.client, comentario_data: schemas.ComentarioCr
     doc_ref = post_ref.collection('comentarios').document()
     doc_ref.set(comentario_dict)
     
-    post_ref.update({'total_comentarios': firestore.Increment(1)})
+    _incrementar_contador_postagem(db, comentario_data.postagem_id, 'comentarios', 1)
+    # A prévia de comentários do feed fica em cache junto com a página
+    _invalidar_feed_local(comentario_data.negocio_id)
     
     comentario_dict['id'] = doc_ref.id
     return comentario_dict
 
-def listar_comentarios(db: firestore.client, postagem_id: str) -> List[Dict]:
-    """Lista todos os comentários de uma postagem."""
+COMENTARIOS_PAGINA_PADRAO = 30
+COMENTARIOS_PAGINA_MAXIMA = 100
+COMENTARIOS_PREVIEW_MAXIMO = 5
+
+
+def listar_comentarios(
+    db: firestore.client,
+    postagem_id: str,
+    limit: int = COMENTARIOS_PAGINA_PADRAO,
+    after: Optional[str] = None,
+    before: Optional[str] = None
+) -> List[Dict]:
+    """
+    Lista os comentários de uma postagem em ordem cronológica, paginados por cursor.
+    `after` traz os comentários seguintes (mais novos) ao ID informado e `before` os
+    anteriores (mais antigos); sem cursor, retorna os primeiros da conversa.
+    """
+    if after and before:
+        raise ValueError("Informe apenas um cursor: 'after' ou 'before'.")
+    comentarios_ref = db.collection('postagens').document(postagem_id).collection('comentarios')
+    limit = max(1, min(limit, COMENTARIOS_PAGINA_MAXIMA))
+    query = comentarios_ref.order_by('data', direction=firestore.Query.ASCENDING)
+
+    cursor_id = after or before
+    if cursor_id:
+        cursor_doc = comentarios_ref.document(cursor_id).get()
+        if not cursor_doc.exists:
+            raise ValueError("Cursor de paginação inválido.")
+        if after:
+            query = query.start_after(cursor_doc).limit(limit)
+        else:
+            query = query.end_before(cursor_doc).limit_to_last(limit)
+    else:
+        query = query.limit(limit)
+
+    # limit_to_last não suporta stream(); get() já devolve na ordem da consulta
     comentarios = []
+    for doc in query.get():
+        comentario_data = doc.to_dict()
+        comentario_data['id'] = doc.id
+        comentarios.append(comentario_data)
+    return comentarios
+
+
+def listar_comentarios_recentes(db: firestore.client, postagem_id: str, quantidade: int) -> List[Dict]:
+    """Prévia com os `quantidade` comentários mais recentes, em ordem cronológica."""
     query = db.collection('postagens').document(postagem_id).collection('comentarios')\
-        .order_by('data', direction=firestore.Query.ASCENDING)
-    
+        .order_by('data', direction=firestore.Query.DESCENDING)\
+        .limit(max(1, min(quantidade, COMENTARIOS_PAGINA_MAXIMA)))
+    comentarios = []
     for doc in query.stream():
         comentario_data = doc.to_dict()
         comentario_data['id'] = doc.id
         comentarios.append(comentario_data)
+    comentarios.reverse()
     return comentarios
 
-def deletar_postagem(db: firestore.client, postagem_id: str, profissional_id: str) -> bool:
-    """Deleta uma postagem, garantindo que ela pertence ao profissional correto."""
+
+# --- Exclusão em cascata de postagens ---
+# A postagem some do feed na hora; curtidas, comentários e shards de contador são
+# apagados depois, em segundo plano, com um BulkWriter de vazão limitada. O progresso
+# fica em 'exclusoes_postagens/{postagem_id}' e `varrer_postagens_orfas` retoma
+# exclusões interrompidas; as subcoleções de postagens apagadas antes disso são
+# limpas uma vez por `migrar_subcolecoes_orfas_postagens`.
+EXCLUSOES_POSTAGENS_COLLECTION = 'exclusoes_postagens'
+EXCLUSAO_OPS_INICIAIS_POR_SEGUNDO = int(os.getenv('EXCLUSAO_OPS_INICIAIS_POR_SEGUNDO', '100'))
+EXCLUSAO_OPS_MAXIMAS_POR_SEGUNDO = int(os.getenv('EXCLUSAO_OPS_MAXIMAS_POR_SEGUNDO', '500'))
+EXCLUSAO_PAGINA = 500
+EXCLUSAO_RETOMAR_APOS = timedelta(minutes=10)
+SUBCOLECOES_POSTAGEM = ('curtidas', 'comentarios', CONTADORES_SHARDS_COLLECTION)
+
+
+def deletar_postagem(
+    db: firestore.client,
+    postagem_id: str,
+    profissional_id: str,
+    background_tasks: Optional[BackgroundTasks] = None
+) -> bool:
+    """
+    Deleta uma postagem, garantindo que ela pertence ao profissional correto.
+    As subcoleções são apagadas por `excluir_dependencias_postagem`, depois da
+    resposta quando `background_tasks` é informado.
+    """
     try:
         post_ref = db.collection('postagens').document(postagem_id)
         post_doc = post_ref.get()
         if not post_doc.exists or post_doc.to_dict().get('profissional_id') != profissional_id:
             logger.warning(f"Tentativa de exclusão da postagem {postagem_id} por profissional não autorizado ({profissional_id}).")
             return False
-        
-        # O ideal seria deletar também subcoleções como curtidas e comentários,
-        # mas isso requer uma lógica mais complexa (ex: Cloud Function).
-        # Por enquanto, deletamos apenas o post principal.
-        post_ref.delete()
+
+        batch = db.batch()
+        batch.set(db.collection(EXCLUSOES_POSTAGENS_COLLECTION).document(postagem_id), {
+            "status": "pendente",
+            "negocio_id": post_doc.to_dict().get('negocio_id'),
+            "apagados": 0,
+            "solicitado_em": firestore.SERVER_TIMESTAMP,
+            "atualizado_em": firestore.SERVER_TIMESTAMP,
+        })
+        batch.delete(post_ref)
+        batch.commit()
+        _incrementar_versao_feed(db, post_doc.to_dict().get('negocio_id'))
         logger.info(f"Postagem {postagem_id} deletada pelo profissional {profissional_id}.")
+
+        if background_tasks is not None:
+            background_tasks.add_task(excluir_dependencias_postagem, db, postagem_id)
+        else:
+            excluir_dependencias_postagem(db, postagem_id)
         return True
     except Exception as e:
         logger.error(f"Erro ao deletar postagem {postagem_id}: {e}")
         return False
 
+
+def _enfileirar_exclusao_recursiva(doc_ref, bulk_writer, ao_enfileirar) -> None:
+    """Percorre as subcoleções de `doc_ref` (em qualquer profundidade) enfileirando as exclusões."""
+    for colecao in doc_ref.collections():
+        # list_documents também devolve documentos "fantasmas" que só têm subcoleções
+        for filho in colecao.list_documents(page_size=EXCLUSAO_PAGINA):
+            _enfileirar_exclusao_recursiva(filho, bulk_writer, ao_enfileirar)
+            bulk_writer.delete(filho)
+            ao_enfileirar()
+
+
+def excluir_dependencias_postagem(db: firestore.client, postagem_id: str) -> int:
+    """Apaga todas as subcoleções de uma postagem, registrando o progresso. Retorna o total apagado."""
+    job_ref = db.collection(EXCLUSOES_POSTAGENS_COLLECTION).document(postagem_id)
+    post_ref = db.collection('postagens').document(postagem_id)
+    progresso = {"enfileirados": 0, "apagados": 0}
+    progresso_lock = threading.Lock()
+
+    def _on_write_result(*_):
+        with progresso_lock:
+            progresso["apagados"] += 1
+
+    def _ao_enfileirar():
+        progresso["enfileirados"] += 1
+        if progresso["enfileirados"] % EXCLUSAO_PAGINA == 0:
+            with progresso_lock:
+                apagados = progresso["apagados"]
+            job_ref.set({"apagados": apagados, "atualizado_em": firestore.SERVER_TIMESTAMP}, merge=True)
+
+    try:
+        job_ref.set({"status": "em_andamento", "atualizado_em": firestore.SERVER_TIMESTAMP}, merge=True)
+        bulk_writer = db.bulk_writer(options=BulkWriterOptions(
+            initial_ops_per_second=EXCLUSAO_OPS_INICIAIS_POR_SEGUNDO,
+            max_ops_per_second=EXCLUSAO_OPS_MAXIMAS_POR_SEGUNDO,
+        ))
+        bulk_writer.on_write_result(_on_write_result)
+        _enfileirar_exclusao_recursiva(post_ref, bulk_writer, _ao_enfileirar)
+        bulk_writer.close()
+
+        job_ref.set({
+            "status": "concluida",
+            "apagados": progresso["apagados"],
+            "concluido_em": firestore.SERVER_TIMESTAMP,
+            "atualizado_em": firestore.SERVER_TIMESTAMP,
+        }, merge=True)
+        logger.info(f"🗑️ Subcoleções da postagem {postagem_id} apagadas: {progresso['apagados']} documentos.")
+        return progresso["apagados"]
+    except Exception as e:
+        logger.error(f"Erro na exclusão em cascata da postagem {postagem_id}: {e}")
+        job_ref.set({"status": "erro", "erro": str(e), "apagados": progresso["apagados"], "atualizado_em": firestore.SERVER_TIMESTAMP}, merge=True)
+        return progresso["apagados"]
+
+
+def varrer_postagens_orfas(db: firestore.client, now: Optional[datetime] = None) -> Dict[str, int]:
+    """
+    Retoma exclusões em cascata interrompidas a partir do log em `exclusoes_postagens`.
+    Só lê os jobs não concluídos, então o custo não depende do volume de curtidas e
+    comentários. Subcoleções deixadas pela exclusão antiga (anterior ao log) são
+    tratadas uma única vez por `migrar_subcolecoes_orfas_postagens`.
+    """
+    now = now or datetime.now(timezone.utc)
+    stats = {"exclusoes_retomadas": 0, "documentos_apagados": 0}
+
+    # Exclusões que falharam ou pararam no meio (ex.: instância encerrada)
+    pendentes = db.collection(EXCLUSOES_POSTAGENS_COLLECTION)\
+        .where('status', 'in', ['pendente', 'em_andamento', 'erro'])
+    for job in pendentes.stream():
+        atualizado_em = (job.to_dict() or {}).get('atualizado_em')
+        if atualizado_em and now - atualizado_em < EXCLUSAO_RETOMAR_APOS:
+            continue
+        stats["exclusoes_retomadas"] += 1
+        stats["documentos_apagados"] += excluir_dependencias_postagem(db, job.id)
+
+    logger.info(f"🧹 Varredura de postagens órfãs concluída: {stats}")
+    return stats
+
+
+def migrar_subcolecoes_orfas_postagens(db: firestore.client) -> Dict[str, int]:
+    """
+    Migração única (manual): percorre os collection groups de curtidas, comentários e
+    shards de contador e apaga as subcoleções cuja postagem não existe mais, deixadas
+    pela exclusão antiga que só apagava o documento da postagem. Lê todos os
+    documentos desses grupos; não deve ser agendada.
+    """
+    stats = {"postagens_orfas": 0, "documentos_apagados": 0}
+    candidatas = {}
+    for grupo in SUBCOLECOES_POSTAGEM:
+        for doc in db.collection_group(grupo).select([firestore.FieldPath.document_id()]).stream():
+            post_ref = doc.reference.parent.parent
+            if post_ref is not None and post_ref.parent.id == 'postagens':
+                candidatas[post_ref.path] = post_ref
+
+    refs = list(candidatas.values())
+    for inicio in range(0, len(refs), 100):
+        for post_doc in db.get_all(refs[inicio:inicio + 100]):
+            if post_doc.exists:
+                continue
+            stats["postagens_orfas"] += 1
+            db.collection(EXCLUSOES_POSTAGENS_COLLECTION).document(post_doc.id).set({
+                "status": "pendente",
+                "origem": "migracao",
+                "solicitado_em": firestore.SERVER_TIMESTAMP,
+                "atualizado_em": firestore.SERVER_TIMESTAMP,
+            }, merge=True)
+            stats["documentos_apagados"] += excluir_dependencias_postagem(db, post_doc.id)
+
+    logger.info(f"🧹 Migração de subcoleções órfãs de postagens concluída: {stats}")
+    return stats
+
 def deletar_comentario(db: firestore.client, postagem_id: str, comentario_id: str, user_id: str) -> bool:
     """Deleta um comentário, garantindo que ele pertence ao usuário correto."""
     try:
@@ -2120,10 +3332,9 @@ def deletar_comentario(db: firestore.client, postagem_id: str, comentario_id: st
         
         comentario_ref.delete()
         
-        # Atualiza o contador de comentários na postagem principal
-        db.collection('postagens').document(postagem_id).update({
-            'total_comentarios': firestore.Increment(-1)
-        })
+        # Atualiza o contador de comentários da postagem (shard)
+        _incrementar_contador_postagem(db, postagem_id, 'comentarios', -1)
+        _invalidar_feed_local(comentario_doc.to_dict().get('negocio_id'))
         
         logger.info(f"Comentário {comentario_id} deletado pelo usuário {user_id}.")
         return True
@@ -2135,103 +3346,294 @@ def deletar_comentario(db: firestore.client, postagem_id: str, comentario_id: st
 # FUNÇÕES DE AVALIAÇÕES
 # =================================================================================
 
+AVALIACOES_PAGINA_PADRAO = 20
+AVALIACOES_PAGINA_MAXIMA = 100
+
+
+def _resumo_avaliacoes_vazio() -> Dict:
+    return {"total": 0, "soma": 0, "media": 0.0, "histograma": {str(nota): 0 for nota in range(1, 6)}}
+
+
 def criar_avaliacao(db: firestore.client, avaliacao_data: schemas.AvaliacaoCreate, usuario: schemas.UsuarioProfile) -> Dict:
-    """Cria uma nova avaliação para um profissional, desnormalizando os dados do cliente."""
+    """
+    Cria uma nova avaliação para um profissional, desnormalizando os dados do cliente.
+    Na mesma transação, atualiza `avaliacoes_resumo` (total, soma, média e histograma
+    por nota) no documento do profissional.
+    """
     avaliacao_dict = avaliacao_data.dict()
     avaliacao_dict['data'] = datetime.utcnow()
     avaliacao_dict['cliente_id'] = usuario.id
     avaliacao_dict['cliente_nome'] = usuario.nome
 
     doc_ref = db.collection('avaliacoes').document()
-    doc_ref.set(avaliacao_dict)
+    prof_ref = db.collection('profissionais').document(avaliacao_data.profissional_id)
+
+    @firestore.transactional
+    def _criar_em_transacao(transaction):
+        prof_doc = prof_ref.get(transaction=transaction)
+        if not prof_doc.exists:
+            raise ValueError("Profissional não encontrado.")
+        resumo = (prof_doc.to_dict() or {}).get('avaliacoes_resumo') or _resumo_avaliacoes_vazio()
+        histograma = {**_resumo_avaliacoes_vazio()['histograma'], **resumo.get('histograma', {})}
+        histograma[str(avaliacao_data.nota)] += 1
+        total = resumo.get('total', 0) + 1
+        soma = resumo.get('soma', 0) + avaliacao_data.nota
+
+        transaction.set(doc_ref, avaliacao_dict)
+        transaction.update(prof_ref, {'avaliacoes_resumo': {
+            "total": total,
+            "soma": soma,
+            "media": round(soma / total, 2),
+            "histograma": histograma,
+        }})
+        return (prof_doc.to_dict() or {}).get('negocio_id')
+
+    # O resumo de avaliações aparece na listagem de profissionais do negócio
+    invalidar_catalogo('profissionais', _criar_em_transacao(db.transaction()))
     avaliacao_dict['id'] = doc_ref.id
-    
-    # Opcional: recalcular a nota média do profissional aqui usando uma transação
-    
     return avaliacao_dict
 
-def listar_avaliacoes_por_profissional(db: firestore.client, profissional_id: str) -> List[Dict]:
-    """Lista todas as avaliações de um profissional específico."""
-    avaliacoes = []
-    query = db.collection('avaliacoes')\
-        .where('profissional_id', '==', profissional_id)\
-        .order_by('data', direction=firestore.Query.DESCENDING)
-        
-    for doc in query.stream():
-        avaliacao_data = doc.to_dict()
-        avaliacao_data['id'] = doc.id
-        avaliacoes.append(avaliacao_data)
-    return avaliacoes
 
-# =================================================================================
-# FUNÇÕES DE NOTIFICAÇÕES
-# =================================================================================
+def obter_resumo_avaliacoes(db: firestore.client, profissional_id: str) -> Dict:
+    """Retorna o resumo de avaliações mantido no documento do profissional (uma leitura)."""
+    prof_doc = db.collection('profissionais').document(profissional_id).get()
+    if not prof_doc.exists:
+        raise ValueError("Profissional não encontrado.")
+    return (prof_doc.to_dict() or {}).get('avaliacoes_resumo') or _resumo_avaliacoes_vazio()
+
+
+def listar_avaliacoes_por_profissional(
+    db: firestore.client,
+    profissional_id: str,
+    limit: int = AVALIACOES_PAGINA_PADRAO,
+    after: Optional[str] = None
+) -> List[Dict]:
+    """
+    Lista as avaliações de um profissional, da mais recente para a mais antiga.
+    Paginado por cursor: `after` é o ID da última avaliação da página anterior.
+    """
+    avaliacoes_ref = db.collection('avaliacoes')
+    limit = max(1, min(limit, AVALIACOES_PAGINA_MAXIMA))
+    query = avaliacoes_ref\
+        .where('profissional_id', '==', profissional_id)\
+        .order_by('data', direction=firestore.Query.DESCENDING)\
+        .limit(limit)
+
+    if after:
+        cursor_doc = avaliacoes_ref.document(after).get()
+        if not cursor_doc.exists or cursor_doc.to_dict().get('profissional_id') != profissional_id:
+            raise ValueError("Cursor de paginação inválido.")
+        query = query.start_after(cursor_doc)
+
+    avaliacoes = []
+    for doc in query.stream():
+        avaliacao_data = doc.to_dict()
+        avaliacao_data['id'] = doc.id
+        avaliacoes.append(avaliacao_data)
+    return avaliacoes
+
+
+def recalcular_resumos_avaliacoes(db: firestore.client) -> Dict[str, int]:
+    """
+    Migração/reconciliação: recalcula `avaliacoes_resumo` de todos os profissionais
+    a partir das avaliações existentes, usando agregações count() por nota.
+    """
+    stats = {"profissionais": 0, "corrigidos": 0}
+    avaliacoes_ref = db.collection('avaliacoes')
+    for prof_doc in db.collection('profissionais').select(['avaliacoes_resumo']).stream():
+        stats["profissionais"] += 1
+        histograma = {}
+        for nota in range(1, 6):
+            query = avaliacoes_ref.where('profissional_id', '==', prof_doc.id).where('nota', '==', nota)
+            histograma[str(nota)] = query.count().get()[0][0].value
+        total = sum(histograma.values())
+        soma = sum(int(nota) * quantidade for nota, quantidade in histograma.items())
+        resumo = {"total": total, "soma": soma, "media": round(soma / total, 2) if total else 0.0, "histograma": histograma}
+
+        if (prof_doc.to_dict() or {}).get('avaliacoes_resumo') != resumo:
+            prof_doc.reference.update({'avaliacoes_resumo': resumo})
+            stats["corrigidos"] += 1
+
+    logger.info(f"⭐ Recalculo dos resumos de avaliações concluído: {stats}")
+    return stats
+
+# =================================================================================
+# FUNÇÕES DE NOTIFICAÇÕES
+# =================================================================================
+
+# ---------------------------------------------------------------------
+# CONTADOR DE NÃO LIDAS (usuarios/{id}.unread_count)
+# ---------------------------------------------------------------------
+# Toda criação de notificação passa por `_persistir_notificacao`, que grava o
+# documento e incrementa `unread_count` de forma atômica; as marcações de
+# leitura decrementam. `reconciliar_contadores_nao_lidas` corrige desvios.
+
+def _persistir_notificacao(
+    db: firestore.client,
+    usuario_id: str,
+    dados: Dict,
+    notificacao_id: Optional[str] = None
+) -> str:
+    """
+    Grava uma notificação no histórico do usuário mantendo o contador de não lidas,
+    sem leituras: o documento e o incremento vão no mesmo batch.
+
+    Sem `notificacao_id` cria um documento novo. Com `notificacao_id` (IDs de
+    deduplicação) usa `create()`: se a notificação já existe o batch inteiro é
+    rejeitado com AlreadyExists e nada é gravado (nem o contador).
+    Retorna o ID do documento.
+    """
+    usuario_ref = db.collection('usuarios').document(usuario_id)
+    notificacoes_ref = usuario_ref.collection('notificacoes')
+    doc_ref = notificacoes_ref.document(notificacao_id) if notificacao_id else notificacoes_ref.document()
+
+    batch = db.batch()
+    if notificacao_id:
+        batch.create(doc_ref, dados)
+    else:
+        batch.set(doc_ref, dados)
+    if not dados.get('lida', False):
+        batch.set(usuario_ref, {'unread_count': firestore.Increment(1)}, merge=True)
+    try:
+        batch.commit()
+    except AlreadyExists:
+        logger.debug(f"Notificação {notificacao_id} já existe para o usuário {usuario_id}; ignorada.")
+    return doc_ref.id
+
+
+def reconciliar_contadores_nao_lidas(db: firestore.client) -> Dict[str, int]:
+    """
+    Recalcula `unread_count` de todos os usuários com agregação `count()`
+    (sem baixar as notificações) e corrige os que divergirem.
+    """
+    stats = {"usuarios_verificados": 0, "contadores_corrigidos": 0}
+    for usuario_doc in db.collection('usuarios').stream():
+        stats["usuarios_verificados"] += 1
+        try:
+            query = usuario_doc.reference.collection('notificacoes').where('lida', '==', False)
+            total = query.count().get()[0][0].value
+            if (usuario_doc.to_dict() or {}).get('unread_count') != total:
+                usuario_doc.reference.update({'unread_count': total})
+                stats["contadores_corrigidos"] += 1
+        except Exception as e:
+            logger.error(f"Erro ao reconciliar contador de não lidas do usuário {usuario_doc.id}: {e}")
+    logger.info(f"🔢 Reconciliação de contadores de não lidas concluída: {stats}")
+    return stats
+
+
+NOTIFICACOES_PAGINA_PADRAO = 50
+NOTIFICACOES_PAGINA_MAXIMA = 200
+
+
+def listar_notificacoes(
+    db: firestore.client,
+    usuario_id: str,
+    limit: int = NOTIFICACOES_PAGINA_PADRAO,
+    after: Optional[str] = None
+) -> List[Dict]:
+    """
+    Lista o histórico de notificações de um usuário, da mais recente para a mais antiga.
+    Paginado por cursor: `after` é o ID da última notificação da página anterior.
+    Os documentos são devolvidos como estão gravados (campos legados normalizados
+    por `migrar_campos_notificacoes`).
+    """
+    notificacoes_ref = db.collection('usuarios').document(usuario_id).collection('notificacoes')
+    limit = max(1, min(limit, NOTIFICACOES_PAGINA_MAXIMA))
+
+    query = notificacoes_ref.order_by('data_criacao', direction=firestore.Query.DESCENDING).limit(limit)
+    if after:
+        cursor_doc = notificacoes_ref.document(after).get()
+        if not cursor_doc.exists:
+            raise ValueError("Cursor de paginação inválido.")
+        query = query.start_after(cursor_doc)
 
-def listar_notificacoes(db: firestore.client, usuario_id: str) -> List[Dict]:
-    """Lista o histórico de notificações de um usuário."""
     notificacoes = []
-    # No Firestore, as notificações podem ser uma subcoleção dentro do documento do usuário
-    query = db.collection('usuarios').document(usuario_id).collection('notificacoes')\
-        .order_by('data_criacao', direction=firestore.Query.DESCENDING)
-    
     for doc in query.stream():
         notificacao_data = doc.to_dict()
         notificacao_data['id'] = doc.id
-        
-        # Mapear campos para compatibilidade com schema
-        # Se tem 'titulo', mapear para 'title'
-        if 'titulo' in notificacao_data and 'title' not in notificacao_data:
-            notificacao_data['title'] = notificacao_data['titulo']
-        
-        # Se tem 'corpo', mapear para 'body'  
-        if 'corpo' in notificacao_data and 'body' not in notificacao_data:
-            notificacao_data['body'] = notificacao_data['corpo']
-            
-        # Garantir campos obrigatórios estão presentes e não são null
-        if 'title' not in notificacao_data or notificacao_data['title'] is None:
-            notificacao_data['title'] = notificacao_data.get('titulo', 'Notificação')
+        notificacoes.append(notificacao_data)
+    return notificacoes
 
-        if 'body' not in notificacao_data or notificacao_data['body'] is None:
-            notificacao_data['body'] = notificacao_data.get('corpo', 'Conteúdo da notificação')
 
-        # Garantir campo 'lida' existe e não é null
-        if 'lida' not in notificacao_data or notificacao_data['lida'] is None:
-            notificacao_data['lida'] = False
+def migrar_campos_notificacoes(db: firestore.client) -> Dict[str, int]:
+    """
+    Migração única: normaliza notificações antigas para o formato atual
+    (`titulo`/`corpo` -> `title`/`body`, `lida` e `tipo` nunca nulos).
+    Pode ser executada mais de uma vez; documentos já normalizados são ignorados.
+    """
+    stats = {"verificadas": 0, "normalizadas": 0}
+    batch = db.batch()
+    pendentes = 0
+
+    for doc in db.collection_group('notificacoes').stream():
+        stats["verificadas"] += 1
+        dados = doc.to_dict()
+        atualizacao = {}
+
+        if dados.get('title') is None:
+            atualizacao['title'] = dados.get('titulo') or 'Notificação'
+        if dados.get('body') is None:
+            atualizacao['body'] = dados.get('corpo') or 'Conteúdo da notificação'
+        if 'titulo' in dados:
+            atualizacao['titulo'] = firestore.DELETE_FIELD
+        if 'corpo' in dados:
+            atualizacao['corpo'] = firestore.DELETE_FIELD
+        if dados.get('lida') is None:
+            atualizacao['lida'] = False
+        if 'tipo' in dados and dados['tipo'] is None:
+            atualizacao['tipo'] = 'GERAL'
+
+        if not atualizacao:
+            continue
 
-        # Garantir campo 'data_criacao' existe e não é null
-        if 'data_criacao' not in notificacao_data or notificacao_data['data_criacao'] is None:
-            notificacao_data['data_criacao'] = firestore.SERVER_TIMESTAMP
+        batch.update(doc.reference, atualizacao)
+        stats["normalizadas"] += 1
+        pendentes += 1
+        if pendentes >= 400:
+            batch.commit()
+            batch = db.batch()
+            pendentes = 0
 
-        # Garantir que campos string não sejam null
-        if notificacao_data['title'] is None:
-            notificacao_data['title'] = 'Notificação'
-        if notificacao_data['body'] is None:
-            notificacao_data['body'] = 'Conteúdo da notificação'
-        if 'tipo' in notificacao_data and notificacao_data['tipo'] is None:
-            notificacao_data['tipo'] = 'GERAL'
-        
-        notificacoes.append(notificacao_data)
-    return notificacoes
+    if pendentes:
+        batch.commit()
+    logger.info(f"🔔 Migração de campos de notificações concluída: {stats}")
+    return stats
 
 def contar_notificacoes_nao_lidas(db: firestore.client, usuario_id: str) -> int:
-    """Conta o número de notificações não lidas de um usuário."""
-    query = db.collection('usuarios').document(usuario_id).collection('notificacoes')\
-        .where('lida', '==', False)
-    
-    # .get() em uma query retorna um snapshot da coleção, podemos contar os documentos
-    docs = query.get()
-    return len(docs)
+    """
+    Retorna o número de notificações não lidas de um usuário a partir do
+    contador `unread_count` (uma única leitura do documento do usuário).
+    Usuários ainda sem contador são contados com agregação `count()`; o campo é
+    gravado por `reconciliar_contadores_nao_lidas`.
+    """
+    usuario_ref = db.collection('usuarios').document(usuario_id)
+    usuario_doc = usuario_ref.get()
+    if not usuario_doc.exists:
+        return 0
+
+    unread_count = (usuario_doc.to_dict() or {}).get('unread_count')
+    if unread_count is None:
+        query = usuario_ref.collection('notificacoes').where('lida', '==', False)
+        unread_count = query.count().get()[0][0].value
+    return max(unread_count, 0)
 
 def marcar_notificacao_como_lida(db: firestore.client, usuario_id: str, notificacao_id: str) -> bool:
     """Marca uma notificação específica de um usuário como lida."""
     try:
-        notificacao_ref = db.collection('usuarios').document(usuario_id).collection('notificacoes').document(notificacao_id)
-        
-        # .get() em um documento para verificar se ele existe
-        if notificacao_ref.get().exists:
-            notificacao_ref.update({'lida': True})
+        usuario_ref = db.collection('usuarios').document(usuario_id)
+        notificacao_ref = usuario_ref.collection('notificacoes').document(notificacao_id)
+
+        @firestore.transactional
+        def _marcar(transaction) -> bool:
+            snapshot = notificacao_ref.get(transaction=transaction)
+            if not snapshot.exists:
+                return False  # Notificação não encontrada
+            if not (snapshot.to_dict() or {}).get('lida', False):
+                transaction.update(notificacao_ref, {'lida': True})
+                transaction.update(usuario_ref, {'unread_count': firestore.Increment(-1)})
             return True
-        return False  # Notificação não encontrada
+
+        return _marcar(db.transaction())
     except Exception as e:
         logger.error(f"Erro ao marcar notificação {notificacao_id} como lida: {e}")
         return False
@@ -2257,23 +3659,194 @@ def agendar_notificacao(db: firestore.client, notificacao_data: schemas.Notifica
 
     return agendamento_dict
 
+# ---------------------------------------------------------------------
+# RETENÇÃO E ARQUIVO DE NOTIFICAÇÕES
+# ---------------------------------------------------------------------
+# Notificações lidas mais antigas que NOTIFICACOES_RETENCAO_DIAS saem da caixa
+# principal e viram entradas compactas em `usuarios/{id}/notificacoes_arquivo/{AAAA-MM}-{n}`.
+# Cada mês é dividido em partes de até ARQUIVO_ITENS_POR_DOCUMENTO entradas, bem
+# abaixo do limite de 1 MiB por documento; todas as partes levam o campo `mes`.
+# Documentos antigos `{AAAA-MM}` (sem parte) contam como a parte 0 do mês.
+
+NOTIFICACOES_RETENCAO_DIAS = int(os.getenv('NOTIFICACOES_RETENCAO_DIAS', '90'))
+ARQUIVO_CORPO_MAX_CARACTERES = 280
+ARQUIVO_ITENS_POR_DOCUMENTO = 500
+
+
+def _entrada_arquivo_notificacao(doc) -> Dict:
+    """Versão mínima de uma notificação para o arquivo mensal."""
+    dados = doc.to_dict() or {}
+    return {
+        "id": doc.id,
+        "title": dados.get('title') or 'Notificação',
+        "body": (dados.get('body') or '')[:ARQUIVO_CORPO_MAX_CARACTERES],
+        "tipo": dados.get('tipo'),
+        "data_criacao": dados.get('data_criacao'),
+    }
+
+
+def _partes_arquivo_do_mes(arquivo_ref, mes: str, campos: List[str]) -> List:
+    """
+    Snapshots das partes do arquivo de um mês: as que têm o campo `mes` e o
+    documento antigo `{AAAA-MM}`, buscado pelo ID porque pode não ter o campo.
+    """
+    partes = {doc.id: doc for doc in arquivo_ref.where('mes', '==', mes).select(campos).stream()}
+    if mes not in partes:
+        legado = arquivo_ref.document(mes).get(campos)
+        if legado.exists:
+            partes[mes] = legado
+    return list(partes.values())
+
+
+def _adicionar_ao_arquivo_do_mes(usuario_ref, batch, mes: str, entradas: List[Dict]) -> int:
+    """
+    Adiciona ao batch as entradas do mês, completando a última parte do arquivo e
+    abrindo partes novas quando ela atinge ARQUIVO_ITENS_POR_DOCUMENTO.
+    Entradas que já estão na última parte são descartadas antes do ArrayUnion, para
+    que `total` conte só o que realmente entra. Retorna quantas entradas foram gravadas.
+    """
+    arquivo_ref = usuario_ref.collection('notificacoes_arquivo')
+    partes = [
+        ((doc.to_dict() or {}).get('parte', 0), (doc.to_dict() or {}).get('total', 0), doc.reference)
+        for doc in _partes_arquivo_do_mes(arquivo_ref, mes, ['mes', 'parte', 'total'])
+    ]
+    parte, total, parte_ref = max(partes, key=lambda p: p[0]) if partes else (0, 0, arquivo_ref.document(f"{mes}-0"))
+
+    ids_existentes = set()
+    if partes:
+        itens = (parte_ref.get(['itens']).to_dict() or {}).get('itens', [])
+        ids_existentes = {item.get('id') for item in itens}
+    novas = []
+    for entrada in entradas:
+        if entrada['id'] not in ids_existentes:
+            ids_existentes.add(entrada['id'])
+            novas.append(entrada)
+
+    gravadas = len(novas)
+    while novas:
+        espaco = ARQUIVO_ITENS_POR_DOCUMENTO - total
+        if espaco <= 0:
+            parte, total = parte + 1, 0
+            parte_ref = arquivo_ref.document(f"{mes}-{parte}")
+            continue
+        bloco, novas = novas[:espaco], novas[espaco:]
+        # `mes`/`parte` também preenchem documentos antigos que ainda não os tinham
+        batch.set(parte_ref, {
+            "mes": mes,
+            "parte": parte,
+            "itens": firestore.ArrayUnion(bloco),
+            "total": firestore.Increment(len(bloco)),
+        }, merge=True)
+        total += len(bloco)
+    return gravadas
+
+
+def arquivar_notificacoes_antigas(db: firestore.client, now: Optional[datetime] = None) -> Dict[str, int]:
+    """
+    Job de compactação: move notificações LIDAS mais antigas que a retenção para as
+    partes do arquivo do mês e apaga os originais. Cada lote grava o arquivo e
+    apaga os originais na mesma escrita atômica, então o job pode ser reexecutado.
+    """
+    now = now or datetime.now(timezone.utc)
+    limite = now - timedelta(days=NOTIFICACOES_RETENCAO_DIAS)
+    stats = {"usuarios_verificados": 0, "notificacoes_arquivadas": 0, "erros": 0}
+
+    for usuario_doc in db.collection('usuarios').stream():
+        stats["usuarios_verificados"] += 1
+        try:
+            query = usuario_doc.reference.collection('notificacoes').where('data_criacao', '<', limite)
+            antigas = [doc for doc in query.stream() if (doc.to_dict() or {}).get('lida', False)]
+
+            for i in range(0, len(antigas), 400):
+                lote = antigas[i:i + 400]
+                por_mes: Dict[str, List[Dict]] = {}
+                for doc in lote:
+                    entrada = _entrada_arquivo_notificacao(doc)
+                    mes = entrada['data_criacao'].strftime('%Y-%m') if entrada['data_criacao'] else limite.strftime('%Y-%m')
+                    por_mes.setdefault(mes, []).append(entrada)
+
+                batch = db.batch()
+                for mes, entradas in por_mes.items():
+                    _adicionar_ao_arquivo_do_mes(usuario_doc.reference, batch, mes, entradas)
+                for doc in lote:
+                    batch.delete(doc.reference)
+                batch.commit()
+                stats["notificacoes_arquivadas"] += len(lote)
+        except Exception as e:
+            stats["erros"] += 1
+            logger.error(f"Erro ao arquivar notificações do usuário {usuario_doc.id}: {e}")
+
+    logger.info(f"🗄️ Arquivamento de notificações concluído: {stats}")
+    return stats
+
+
+def listar_meses_arquivo_notificacoes(db: firestore.client, usuario_id: str) -> List[Dict]:
+    """Lista os meses arquivados do usuário (mais recente primeiro) sem carregar os itens."""
+    query = db.collection('usuarios').document(usuario_id).collection('notificacoes_arquivo')\
+        .select(['mes', 'total'])
+    totais: Dict[str, int] = {}
+    for doc in query.stream():
+        dados = doc.to_dict() or {}
+        mes = dados.get('mes') or doc.id
+        totais[mes] = totais.get(mes, 0) + (dados.get('total', 0) or 0)
+    meses = [{"mes": mes, "total": total} for mes, total in totais.items()]
+    return sorted(meses, key=lambda m: m['mes'], reverse=True)
+
+
+def listar_notificacoes_arquivadas(db: firestore.client, usuario_id: str, mes: str) -> List[Dict]:
+    """Retorna as notificações arquivadas de um mês (AAAA-MM), da mais recente para a mais antiga."""
+    arquivo_ref = db.collection('usuarios').document(usuario_id).collection('notificacoes_arquivo')
+    partes = _partes_arquivo_do_mes(arquivo_ref, mes, ['itens'])
+    itens = [item for doc in partes for item in (doc.to_dict() or {}).get('itens', [])]
+    return sorted(itens, key=lambda item: item.get('data_criacao') or datetime.min.replace(tzinfo=timezone.utc), reverse=True)
+
+
 def marcar_todas_como_lidas(db: firestore.client, usuario_id: str) -> bool:
-    """Marca todas as notificações não lidas de um usuário como lidas."""
+    """
+    Marca todas as notificações não lidas de um usuário como lidas.
+
+    Usa BulkWriter (escritas paralelas, com limite de taxa e retry automático),
+    então não há o teto de 500 operações do WriteBatch. Só as referências dos
+    documentos são lidas. Cada update exige que o documento não tenha mudado desde
+    a leitura (`last_update_time`): se outra marcação (individual ou outro "marcar
+    todas") chegou antes, a escrita é recusada e o decremento fica com quem marcou.
+    Ao final, `unread_count` é decrementado com `Increment` pelo total efetivamente
+    atualizado.
+    """
     try:
-        notificacoes_ref = db.collection('usuarios').document(usuario_id).collection('notificacoes')
-        query = notificacoes_ref.where('lida', '==', False)
-        docs = query.stream()
+        usuario_ref = db.collection('usuarios').document(usuario_id)
+        query = usuario_ref.collection('notificacoes')\
+            .where('lida', '==', False)\
+            .select([firestore.FieldPath.document_id()])
+
+        atualizadas = 0
+        contador_lock = threading.Lock()
+
+        def _on_write_result(doc_ref, result, writer):
+            nonlocal atualizadas
+            with contador_lock:
+                atualizadas += 1
+
+        def _on_write_error(erro, writer) -> bool:
+            # Documento alterado depois da leitura: não adianta repetir com a mesma pré-condição
+            if erro.code == code_pb2.FAILED_PRECONDITION:
+                return False
+            return erro.attempts < 15
+
+        bulk_writer = db.bulk_writer()
+        bulk_writer.on_write_result(_on_write_result)
+        bulk_writer.on_write_error(_on_write_error)
+        for doc in query.stream():
+            bulk_writer.update(
+                doc.reference, {'lida': True},
+                option=db.write_option(last_update_time=doc.update_time)
+            )
+        bulk_writer.close()
+
+        if atualizadas > 0:
+            usuario_ref.update({'unread_count': firestore.Increment(-atualizadas)})
+            logger.info(f"{atualizadas} notificações marcadas como lidas para o usuário {usuario_id}.")
 
-        batch = db.batch()
-        doc_count = 0
-        for doc in docs:
-            batch.update(doc.reference, {'lida': True})
-            doc_count += 1
-        
-        if doc_count > 0:
-            batch.commit()
-            logger.info(f"{doc_count} notificações marcadas como lidas para o usuário {usuario_id}.")
-        
         return True
     except Exception as e:
         logger.error(f"Erro ao marcar todas as notificações como lidas para o usuário {usuario_id}: {e}")
@@ -2306,9 +3879,7 @@ def _notificar_cliente_cancelamento(db: firestore.client, agendamento: Dict, age
         
         # 1. Persistir a notificação no Firestore
         notificacao_id = f"AGENDAMENTO_CANCELADO:{agendamento_id}"
-        notificacao_doc_ref = cliente_doc_ref.collection('notificacoes').document(notificacao_id)
-        
-        notificacao_doc_ref.set({
+        _persistir_notificacao(db, cliente_id, {
             "title": "Agendamento Cancelado",
             "body": mensagem_body,
             "tipo": "AGENDAMENTO_CANCELADO",
@@ -2316,11 +3887,11 @@ def _notificar_cliente_cancelamento(db: firestore.client, agendamento: Dict, age
             "lida": False,
             "data_criacao": firestore.SERVER_TIMESTAMP,
             "dedupe_key": notificacao_id
-        })
+        }, notificacao_id)
         logger.info(f"Notificação de cancelamento (prof.) PERSISTIDA para o cliente {cliente_id}.")
 
         # 2. Enviar a notificação via FCM
-        fcm_tokens = cliente_data.get('fcm_tokens')
+        fcm_tokens, _ = buscar_tokens_do_usuario(db, cliente_id)
         if fcm_tokens:
             titulo = "Agendamento Cancelado"
             corpo = mensagem_body
@@ -2368,9 +3939,7 @@ def _notificar_cliente_confirmacao(db: firestore.client, agendamento: Dict, agen
 
         # 1. Persistir a notificação no Firestore
         notificacao_id = f"AGENDAMENTO_CONFIRMADO:{agendamento_id}"
-        notificacao_doc_ref = cliente_doc_ref.collection('notificacoes').document(notificacao_id)
-
-        notificacao_doc_ref.set({
+        _persistir_notificacao(db, cliente_id, {
             "title": "Agendamento Confirmado",
             "body": mensagem_body,
             "tipo": "AGENDAMENTO_CONFIRMADO",
@@ -2378,11 +3947,11 @@ def _notificar_cliente_confirmacao(db: firestore.client, agendamento: Dict, agen
             "lida": False,
             "data_criacao": firestore.SERVER_TIMESTAMP,
             "dedupe_key": notificacao_id
-        })
+        }, notificacao_id)
         logger.info(f"Notificação de confirmação (prof.) PERSISTIDA para o cliente {cliente_id}.")
 
         # 2. Enviar a notificação via FCM
-        fcm_tokens = cliente_data.get('fcm_tokens')
+        fcm_tokens, _ = buscar_tokens_do_usuario(db, cliente_id)
         if fcm_tokens:
             titulo = "Agendamento Confirmado"
             corpo = mensagem_body
@@ -5199,11 +6768,14 @@ def _notificar_avaliacao_relatorio_cascata(db: firestore.client, relatorio: Dict
 
         logger.info(f"📧 Notificação em cascata: Total de {len(destinatarios)} destinatário(s)")
 
+        # Tokens de todos os destinatários em uma consulta ao registro
+        tokens_por_destinatario = buscar_tokens_por_usuarios(db, list(destinatarios))
+
         # Enviar notificação para cada destinatário
         for destinatario_id in destinatarios:
             try:
                 # Persistir no Firestore
-                db.collection('usuarios').document(destinatario_id).collection('notificacoes').add({
+                _persistir_notificacao(db, destinatario_id, {
                     "title": titulo,
                     "body": corpo,
                     "tipo": "RELATORIO_AVALIADO",
@@ -5216,40 +6788,39 @@ def _notificar_avaliacao_relatorio_cascata(db: firestore.client, relatorio: Dict
                 })
 
                 # Enviar push notification (FCM + APNs)
-                destinatario_doc = db.collection('usuarios').document(destinatario_id).get()
-                if destinatario_doc.exists:
-                    destinatario_data = destinatario_doc.to_dict()
-                    fcm_tokens = destinatario_data.get('fcm_tokens', [])
-                    apns_tokens = destinatario_data.get('apns_tokens', [])
+                tokens = tokens_por_destinatario.get(destinatario_id) or {'fcm': [], 'apns': []}
+                fcm_tokens = tokens['fcm']
+                apns_tokens = tokens['apns']
 
-                    # Enviar FCM
-                    for token in fcm_tokens:
-                        try:
-                            message = messaging.Message(
-                                notification=messaging.Notification(title=titulo, body=corpo),
-                                data=data_payload,
-                                token=token,
-                                webpush=messaging.WebpushConfig(
-                                    notification=messaging.WebpushNotification(tag=webpush_tag)
-                                )
+                # Enviar FCM
+                for token in fcm_tokens:
+                    try:
+                        message = messaging.Message(
+                            notification=messaging.Notification(title=titulo, body=corpo),
+                            data=data_payload,
+                            token=token,
+                            webpush=messaging.WebpushConfig(
+                                notification=messaging.WebpushNotification(tag=webpush_tag)
                             )
-                            messaging.send(message)
-                        except Exception as e:
-                            logger.error(f"Erro ao enviar FCM para {destinatario_id}: {e}")
+                        )
+                        messaging.send(message)
+                    except Exception as e:
+                        logger.error(f"Erro ao enviar FCM para {destinatario_id}: {e}")
 
-                    # Enviar APNs
-                    if apns_tokens:
-                        from notification_helper import enviar_notificacao_para_usuario
-                        try:
-                            enviar_notificacao_para_usuario(
-                                destinatario_data,
-                                titulo,
-                                corpo,
-                                data_payload,
-                                webpush_tag
-                            )
-                        except Exception as e:
-                            logger.error(f"Erro ao enviar APNs para {destinatario_id}: {e}")
+                # Enviar APNs
+                if apns_tokens:
+                    from notification_helper import enviar_notificacao_hibrida
+                    try:
+                        enviar_notificacao_hibrida(
+                            fcm_tokens=[],
+                            apns_tokens=apns_tokens,
+                            titulo=titulo,
+                            corpo=corpo,
+                            data_payload=data_payload,
+                            webpush_tag=webpush_tag
+                        )
+                    except Exception as e:
+                        logger.error(f"Erro ao enviar APNs para {destinatario_id}: {e}")
 
                 logger.info(f"✅ Notificação enviada para: {destinatario_id}")
 
@@ -5293,7 +6864,7 @@ def _notificar_criador_relatorio_avaliado(db: firestore.client, relatorio: Dict,
             logger.error(f"Criador do relatório {criado_por_id} não encontrado.")
             return
         criador_data = criador_doc.to_dict()
-        tokens_fcm = criador_data.get('fcm_tokens', [])
+        tokens_fcm, _ = buscar_tokens_do_usuario(db, criado_por_id)
         
         titulo = "Relatório Avaliado"
         if status == "aprovado":
@@ -5320,7 +6891,7 @@ def _notificar_criador_relatorio_avaliado(db: firestore.client, relatorio: Dict,
             "data_criacao": datetime.utcnow()
         }
         
-        db.collection('usuarios').document(criado_por_id).collection('notificacoes').add(notificacao_data)
+        _persistir_notificacao(db, criado_por_id, notificacao_data)
         
         if tokens_fcm:
             _send_data_push_to_tokens(
@@ -5361,6 +6932,7 @@ def _notificar_tecnicos_plano_atualizado(db: firestore.client, paciente_id: str,
             return
         
         print(f"[PASSO A] Notificação será enviada para {len(tecnicos_ids)} técnico(s).")
+        tokens_por_tecnico = buscar_tokens_por_usuarios(db, tecnicos_ids)
 
         # PASSO 3: Construir a mensagem visual
         titulo = "Plano de Cuidado Atualizado"
@@ -5376,18 +6948,11 @@ def _notificar_tecnicos_plano_atualizado(db: firestore.client, paciente_id: str,
         # Itera sobre cada técnico para enviar a notificação individualmente
         for tecnico_id in tecnicos_ids:
             try:
-                tecnico_doc = db.collection('usuarios').document(tecnico_id).get()
-                if not tecnico_doc.exists:
-                    print(f"[AVISO] Técnico com ID {tecnico_id} não foi encontrado. Pulando.")
-                    continue
-                    
-                tecnico_data = tecnico_doc.to_dict()
-                tokens_fcm = tecnico_data.get('fcm_tokens', [])
-                
-                print(f"[PASSO B - Técnico {tecnico_id}] Destinatário: {tecnico_data.get('email')}. Tokens: {len(tokens_fcm)}")
+                tokens_fcm = tokens_por_tecnico[tecnico_id]['fcm']
+                print(f"[PASSO B - Técnico {tecnico_id}] Tokens: {len(tokens_fcm)}")
 
                 # PASSO 5: Persistir a notificação no histórico
-                db.collection('usuarios').document(tecnico_id).collection('notificacoes').add({
+                _persistir_notificacao(db, tecnico_id, {
                     "title": titulo, "body": corpo, "tipo": "PLANO_CUIDADO_ATUALIZADO",
                     "relacionado": { "paciente_id": paciente_id, "consulta_id": consulta_id },
                     "lida": False, "data_criacao": firestore.SERVER_TIMESTAMP
@@ -5448,7 +7013,7 @@ def _notificar_profissional_associacao(db: firestore.client, profissional_id: st
             print(f"[ERRO DE NOTIFICAÇÃO] Profissional {profissional_id} não encontrado.")
             return
         profissional_data = profissional_doc.to_dict()
-        tokens_fcm = profissional_data.get('fcm_tokens', [])
+        tokens_fcm, _ = buscar_tokens_do_usuario(db, profissional_id)
         
         print(f"[PASSO A] Destinatário: {profissional_data.get('email')}. Tokens encontrados: {len(tokens_fcm)}")
 
@@ -5468,7 +7033,7 @@ def _notificar_profissional_associacao(db: firestore.client, profissional_id: st
         print(f"[PASSO B] Payload montado. Título: '{titulo}', Corpo: '{corpo}'")
 
         # PASSO 5: Persistir a Notificação no Histórico
-        db.collection('usuarios').document(profissional_id).collection('notificacoes').add({
+        _persistir_notificacao(db, profissional_id, {
             "title": titulo, "body": corpo, "tipo": "ASSOCIACAO_PACIENTE",
             "relacionado": { "paciente_id": paciente_id },
             "lida": False, "data_criacao": firestore.SERVER_TIMESTAMP
@@ -5543,6 +7108,10 @@ def _notificar_checklist_concluido(db: firestore.client, paciente_id: str, dia_d
         # PASSO 3: Construir a Mensagem Visual
         titulo = "Checklist Concluído"
         corpo = f"O checklist diário do paciente {nome_paciente} para o dia {dia_do_checklist.strftime('%d/%m/%Y')} foi 100% concluído."
+        corpo_resumo = (
+            f"O checklist diário do paciente {nome_paciente} para o dia {dia_do_checklist.strftime('%d/%m/%Y')} "
+            "foi concluído {total} vezes."
+        )
 
         # PASSO 4: Construir os Dados de Lógica
         data_payload = {
@@ -5560,24 +7129,34 @@ def _notificar_checklist_concluido(db: firestore.client, paciente_id: str, dia_d
                     continue
 
                 dest_data = dest_doc.to_dict()
-                tokens_fcm = dest_data.get('fcm_tokens', [])
+                tokens_fcm, _ = buscar_tokens_do_usuario(db, dest_id)
                 print(f"[PASSO B - Destinatário {dest_id}] E-mail: {dest_data.get('email')}. Tokens: {len(tokens_fcm)}")
 
-                # PASSO 5: Persistir a Notificação no Histórico
-                db.collection('usuarios').document(dest_id).collection('notificacoes').add({
-                    "title": titulo, "body": corpo, "tipo": "CHECKLIST_CONCLUIDO",
-                    "relacionado": { "paciente_id": paciente_id, "data_checklist": dia_do_checklist.isoformat() },
-                    "lida": False, "data_criacao": firestore.SERVER_TIMESTAMP
-                })
+                # Gera tag webpush única
+                webpush_tag = f"CHECKLIST_CONCLUIDO-paciente-{paciente_id}-data-{dia_do_checklist.isoformat()}"
+
+                # PASSO 5: Persistir a Notificação no Histórico (itens desmarcados e
+                # remarcados em sequência não geram uma nova notificação por conclusão)
+                resultado = _registrar_notificacao_coalescida(
+                    db, dest_id, "CHECKLIST_CONCLUIDO", f"{paciente_id}:{dia_do_checklist.isoformat()}",
+                    titulo=titulo,
+                    corpo=corpo,
+                    titulo_resumo=titulo,
+                    corpo_resumo=corpo_resumo,
+                    relacionado={ "paciente_id": paciente_id, "data_checklist": dia_do_checklist.isoformat() },
+                    data_payload=data_payload,
+                    webpush_tag=webpush_tag
+                )
                 print(f"[PASSO C - Destinatário {dest_id}] Notificação persistida no Firestore.")
 
+                if not resultado["enviar_push"]:
+                    print(f"[PASSO D - Destinatário {dest_id}] Conclusão agrupada na notificação existente. Push adiado para o resumo.")
+                    continue
+
                 # PASSO 6: Enviar o Push em Loop
                 if tokens_fcm:
                     print(f"[PASSO D - Destinatário {dest_id}] Enviando notificação para {len(tokens_fcm)} token(s)...")
 
-                    # Gera tag webpush única
-                    webpush_tag = f"CHECKLIST_CONCLUIDO-paciente-{paciente_id}-data-{dia_do_checklist.isoformat()}"
-
                     sucessos = 0
                     for token in tokens_fcm:
                         try:
@@ -6394,7 +7973,7 @@ def _notificar_medico_novo_relatorio(db: firestore.client, relatorio: Dict):
             logger.error(f"Médico {medico_id} não encontrado para notificação.")
             return
         medico_data = medico_doc.to_dict()
-        tokens_fcm = medico_data.get('fcm_tokens', [])
+        tokens_fcm, _ = buscar_tokens_do_usuario(db, medico_id)
 
         paciente_doc = db.collection('usuarios').document(paciente_id).get()
         nome_paciente = decrypt_data(paciente_doc.to_dict().get('nome', '')) if paciente_doc.exists else "Paciente"
@@ -6412,7 +7991,7 @@ def _notificar_medico_novo_relatorio(db: firestore.client, relatorio: Dict):
             "paciente_id": str(paciente_id),
         }
 
-        db.collection('usuarios').document(medico_id).collection('notificacoes').add({
+        _persistir_notificacao(db, medico_id, {
             "title": titulo, "body": corpo, "tipo": "NOVO_RELATORIO_MEDICO",
             "relacionado": { "relatorio_id": relatorio.get('id'), "paciente_id": paciente_id },
             "lida": False, "data_criacao": firestore.SERVER_TIMESTAMP
@@ -6443,6 +8022,184 @@ def _notificar_medico_novo_relatorio(db: firestore.client, relatorio: Dict):
         logger.error(f"Erro ao notificar médico sobre novo relatório: {e}")
 
 
+# =================================================================================
+# FUNÇÕES DE COALESCÊNCIA DE NOTIFICAÇÕES
+# =================================================================================
+# Rajadas de eventos do mesmo tipo para o mesmo destinatário (ex.: vários registros
+# no diário em poucos minutos) viram UMA entrada no histórico e UM push de resumo.
+# A janela padrão vem de NOTIFICACAO_COALESCENCIA_SEGUNDOS e pode ser sobrescrita
+# por tipo com NOTIFICACAO_COALESCENCIA_<TIPO> (0 desativa a coalescência).
+
+NOTIFICACAO_COALESCENCIA_PADRAO_SEGUNDOS = int(os.getenv('NOTIFICACAO_COALESCENCIA_SEGUNDOS', '300'))
+# A janela desliza: cada evento a estende por mais uma janela, até este múltiplo
+# da janela contado do primeiro evento (senão uma rajada contínua nunca teria resumo).
+NOTIFICACAO_COALESCENCIA_EXTENSAO_MAXIMA = int(os.getenv('NOTIFICACAO_COALESCENCIA_EXTENSAO_MAXIMA', '4'))
+# Em 'usuarios/{id}/coalescencias/{tipo}:{chave}' fica a janela aberta de cada grupo
+COALESCENCIAS_COLLECTION = 'coalescencias'
+
+
+def _janela_coalescencia(tipo: str) -> int:
+    """Retorna a janela de coalescência (em segundos) configurada para o tipo de notificação."""
+    valor = os.getenv(f'NOTIFICACAO_COALESCENCIA_{tipo}')
+    if valor is None:
+        return NOTIFICACAO_COALESCENCIA_PADRAO_SEGUNDOS
+    try:
+        return int(valor)
+    except ValueError:
+        logger.warning(f"Valor inválido para NOTIFICACAO_COALESCENCIA_{tipo}: {valor}. Usando padrão.")
+        return NOTIFICACAO_COALESCENCIA_PADRAO_SEGUNDOS
+
+
+def _registrar_notificacao_coalescida(
+    db: firestore.client,
+    usuario_id: str,
+    tipo: str,
+    chave: str,
+    titulo: str,
+    corpo: str,
+    titulo_resumo: str,
+    corpo_resumo: str,
+    relacionado: Dict,
+    data_payload: Dict[str, str],
+    webpush_tag: str
+) -> Dict:
+    """
+    Persiste a notificação no histórico agrupando eventos da mesma janela.
+
+    A janela começa no primeiro evento pendente do grupo `{tipo}:{chave}`, que cria a
+    entrada `{tipo}:{chave}:{timestamp do primeiro evento}` e deve disparar o push
+    imediatamente. Enquanto a janela está aberta, cada evento seguinte a estende por
+    mais uma janela (limitado a NOTIFICACAO_COALESCENCIA_EXTENSAO_MAXIMA janelas desde
+    o primeiro evento), incrementa o total, reescreve título/corpo com o resumo (o
+    marcador literal `{total}` é substituído pela contagem) e marca o push de resumo
+    como pendente, que é enviado por `processar_notificacoes_coalescidas` ao fim da
+    janela com a mesma `webpush_tag`.
+
+    Retorna {"notificacao_id": str, "total": int, "enviar_push": bool}.
+    """
+    usuario_ref = db.collection('usuarios').document(usuario_id)
+    notificacoes_ref = usuario_ref.collection('notificacoes')
+    janela = _janela_coalescencia(tipo)
+
+    if janela <= 0:
+        notificacao_id = _persistir_notificacao(db, usuario_id, {
+            "title": titulo, "body": corpo, "tipo": tipo,
+            "relacionado": relacionado,
+            "lida": False, "data_criacao": firestore.SERVER_TIMESTAMP
+        })
+        return {"notificacao_id": notificacao_id, "total": 1, "enviar_push": True}
+
+    agora = datetime.now(timezone.utc)
+    aberta_ref = usuario_ref.collection(COALESCENCIAS_COLLECTION).document(f"{tipo}:{chave}")
+
+    @firestore.transactional
+    def _registrar(transaction):
+        aberta_doc = aberta_ref.get(transaction=transaction)
+        aberta = aberta_doc.to_dict() if aberta_doc.exists else None
+        snapshot = None
+        if aberta and aberta.get('janela_fim') and aberta['janela_fim'] > agora:
+            snapshot = notificacoes_ref.document(aberta['notificacao_id']).get(transaction=transaction)
+
+        if snapshot is None or not snapshot.exists:
+            # Nenhuma janela aberta: este evento abre uma nova
+            doc_ref = notificacoes_ref.document(f"{tipo}:{chave}:{int(agora.timestamp())}")
+            janela_fim = agora + timedelta(seconds=janela)
+            transaction.update(usuario_ref, {'unread_count': firestore.Increment(1)})
+            transaction.set(doc_ref, {
+                "title": titulo, "body": corpo, "tipo": tipo,
+                "relacionado": relacionado,
+                "lida": False, "data_criacao": firestore.SERVER_TIMESTAMP,
+                "coalescencia": {
+                    "total": 1,
+                    "janela_inicio": agora,
+                    "janela_fim": janela_fim,
+                    "push_pendente": False,
+                    "webpush_tag": webpush_tag,
+                    "data_payload": data_payload,
+                }
+            })
+            transaction.set(aberta_ref, {"notificacao_id": doc_ref.id, "janela_inicio": agora, "janela_fim": janela_fim})
+            return doc_ref.id, 1
+
+        dados_atuais = snapshot.to_dict()
+        coalescencia = dados_atuais.get('coalescencia', {}) or {}
+        total = coalescencia.get('total', 1) + 1
+        janela_inicio = coalescencia.get('janela_inicio') or aberta.get('janela_inicio') or agora
+        janela_fim = min(
+            agora + timedelta(seconds=janela),
+            janela_inicio + timedelta(seconds=janela * NOTIFICACAO_COALESCENCIA_EXTENSAO_MAXIMA)
+        )
+        if dados_atuais.get('lida', False):
+            transaction.update(usuario_ref, {'unread_count': firestore.Increment(1)})
+        transaction.update(snapshot.reference, {
+            # replace em vez de format: o texto traz nomes digitados por usuários
+            "title": titulo_resumo.replace('{total}', str(total)),
+            "body": corpo_resumo.replace('{total}', str(total)),
+            "relacionado": relacionado,
+            "lida": False,
+            "data_criacao": firestore.SERVER_TIMESTAMP,
+            "coalescencia.total": total,
+            "coalescencia.janela_fim": janela_fim,
+            "coalescencia.push_pendente": True,
+            "coalescencia.data_payload": data_payload,
+        })
+        transaction.update(aberta_ref, {"janela_fim": janela_fim})
+        return snapshot.id, total
+
+    notificacao_id, total = _registrar(db.transaction())
+    return {"notificacao_id": notificacao_id, "total": total, "enviar_push": total == 1}
+
+
+def processar_notificacoes_coalescidas(db: firestore.client, now: Optional[datetime] = None) -> Dict:
+    """
+    Envia o push de resumo das janelas de coalescência já encerradas.
+    Chamado pelo job agendado; usa a mesma `webpush_tag` do primeiro push para
+    que o dispositivo substitua a notificação anterior em vez de empilhar.
+    """
+    from notification_helper import enviar_notificacao_hibrida
+
+    now = now or datetime.now(timezone.utc)
+    stats = {"resumos_enviados": 0, "resumos_erros": 0}
+
+    query = db.collection_group('notificacoes').where('coalescencia.push_pendente', '==', True)
+    encerradas = []
+    for doc in query.stream():
+        dados = doc.to_dict()
+        janela_fim = (dados.get('coalescencia', {}) or {}).get('janela_fim')
+        if janela_fim and janela_fim > now:
+            continue
+        encerradas.append((doc, dados))
+
+    # Tokens de todos os destinatários em consultas `in` ao registro
+    tokens_por_usuario = buscar_tokens_por_usuarios(
+        db, list({doc.reference.parent.parent.id for doc, _ in encerradas})
+    ) if encerradas else {}
+
+    for doc, dados in encerradas:
+        try:
+            coalescencia = dados.get('coalescencia', {}) or {}
+            tokens = tokens_por_usuario.get(doc.reference.parent.parent.id) or {'fcm': [], 'apns': []}
+            if tokens['fcm'] or tokens['apns']:
+                enviar_notificacao_hibrida(
+                    fcm_tokens=tokens['fcm'],
+                    apns_tokens=tokens['apns'],
+                    titulo=dados.get('title', ''),
+                    corpo=dados.get('body', ''),
+                    data_payload={**coalescencia.get('data_payload', {}), "total": str(coalescencia.get('total', 1))},
+                    webpush_tag=coalescencia.get('webpush_tag')
+                )
+                stats["resumos_enviados"] += 1
+
+            doc.reference.update({"coalescencia.push_pendente": False})
+        except Exception as e:
+            stats["resumos_erros"] += 1
+            logger.error(f"Erro ao enviar resumo da notificação coalescida {doc.id}: {e}")
+
+    if stats["resumos_enviados"]:
+        logger.info(f"📦 Resumos de notificações coalescidas enviados: {stats['resumos_enviados']}")
+    return stats
+
+
 def _notificar_enfermeiro_novo_registro_diario(db: firestore.client, registro: Dict):
     """Notifica o enfermeiro responsável sobre um novo registro diário feito por um técnico."""
     try:
@@ -6463,7 +8220,7 @@ def _notificar_enfermeiro_novo_registro_diario(db: firestore.client, registro: D
         enfermeiro_doc = db.collection('usuarios').document(enfermeiro_id).get()
         if not enfermeiro_doc.exists: return
         enfermeiro_data = enfermeiro_doc.to_dict()
-        tokens_fcm = enfermeiro_data.get('fcm_tokens', [])
+        tokens_fcm, _ = buscar_tokens_do_usuario(db, enfermeiro_id)
         
         nome_tecnico = tecnico_info.get('nome', 'Um técnico')
 
@@ -6476,15 +8233,25 @@ def _notificar_enfermeiro_novo_registro_diario(db: firestore.client, registro: D
             "paciente_id": paciente_id,
         }
 
-        db.collection('usuarios').document(enfermeiro_id).collection('notificacoes').add({
-            "title": titulo, "body": corpo, "tipo": "NOVO_REGISTRO_DIARIO",
-            "relacionado": { "registro_id": registro.get('id'), "paciente_id": paciente_id },
-            "lida": False, "data_criacao": firestore.SERVER_TIMESTAMP
-        })
+        # Tag estável por paciente: o push de resumo substitui o anterior no dispositivo
+        webpush_tag = f"NOVO_REGISTRO_DIARIO-paciente-{paciente_id}"
+
+        resultado = _registrar_notificacao_coalescida(
+            db, enfermeiro_id, "NOVO_REGISTRO_DIARIO", paciente_id,
+            titulo=titulo,
+            corpo=corpo,
+            titulo_resumo="Novos Registros no Diário",
+            corpo_resumo=f"{{total}} novos registros no diário do paciente {nome_paciente}.",
+            relacionado={ "registro_id": registro.get('id'), "paciente_id": paciente_id },
+            data_payload=data_payload,
+            webpush_tag=webpush_tag
+        )
+
+        if not resultado["enviar_push"]:
+            logger.info(f"Registro diário agrupado na notificação {resultado['notificacao_id']} (total: {resultado['total']}).")
+            return
 
         if tokens_fcm:
-            # Gera tag webpush única
-            webpush_tag = f"NOVO_REGISTRO_DIARIO-registro-{registro.get('id', '')}-paciente-{paciente_id}"
 
             # PASSO 6: Enviar o push em loop
             sucessos = 0
@@ -6587,11 +8354,14 @@ def _notificar_tarefa_concluida(db: firestore.client, tarefa: Dict):
 
         logger.info(f"📧 TAREFA_CONCLUIDA: Total de {len(destinatarios)} destinatário(s)")
 
+        # Tokens de todos os destinatários em uma consulta ao registro
+        tokens_por_destinatario = buscar_tokens_por_usuarios(db, list(destinatarios))
+
         # Enviar notificação para cada destinatário
         for destinatario_id in destinatarios:
             try:
                 # Persistir no Firestore
-                db.collection('usuarios').document(destinatario_id).collection('notificacoes').add({
+                _persistir_notificacao(db, destinatario_id, {
                     "title": titulo,
                     "body": corpo,
                     "tipo": "TAREFA_CONCLUIDA",
@@ -6604,44 +8374,43 @@ def _notificar_tarefa_concluida(db: firestore.client, tarefa: Dict):
                 })
 
                 # Enviar push notification (FCM + APNs)
-                destinatario_doc = db.collection('usuarios').document(destinatario_id).get()
-                if destinatario_doc.exists:
-                    destinatario_data = destinatario_doc.to_dict()
-                    fcm_tokens = destinatario_data.get('fcm_tokens', [])
-                    apns_tokens = destinatario_data.get('apns_tokens', [])
+                tokens = tokens_por_destinatario.get(destinatario_id) or {'fcm': [], 'apns': []}
+                fcm_tokens = tokens['fcm']
+                apns_tokens = tokens['apns']
 
-                    # Enviar FCM
-                    sucessos = 0
-                    for token in fcm_tokens:
-                        try:
-                            message = messaging.Message(
-                                notification=messaging.Notification(title=titulo, body=corpo),
-                                data=data_payload,
-                                token=token,
-                                webpush=messaging.WebpushConfig(
-                                    notification=messaging.WebpushNotification(tag=webpush_tag)
-                                )
+                # Enviar FCM
+                sucessos = 0
+                for token in fcm_tokens:
+                    try:
+                        message = messaging.Message(
+                            notification=messaging.Notification(title=titulo, body=corpo),
+                            data=data_payload,
+                            token=token,
+                            webpush=messaging.WebpushConfig(
+                                notification=messaging.WebpushNotification(tag=webpush_tag)
                             )
-                            messaging.send(message)
-                            sucessos += 1
-                        except Exception as e:
-                            logger.error(f"Erro ao enviar FCM para {destinatario_id}: {e}")
+                        )
+                        messaging.send(message)
+                        sucessos += 1
+                    except Exception as e:
+                        logger.error(f"Erro ao enviar FCM para {destinatario_id}: {e}")
 
-                    # Enviar APNs se houver tokens
-                    if apns_tokens:
-                        from notification_helper import enviar_notificacao_para_usuario
-                        try:
-                            enviar_notificacao_para_usuario(
-                                destinatario_data,
-                                titulo,
-                                corpo,
-                                data_payload,
-                                webpush_tag
-                            )
-                        except Exception as e:
-                            logger.error(f"Erro ao enviar APNs para {destinatario_id}: {e}")
+                # Enviar APNs se houver tokens
+                if apns_tokens:
+                    from notification_helper import enviar_notificacao_hibrida
+                    try:
+                        enviar_notificacao_hibrida(
+                            fcm_tokens=[],
+                            apns_tokens=apns_tokens,
+                            titulo=titulo,
+                            corpo=corpo,
+                            data_payload=data_payload,
+                            webpush_tag=webpush_tag
+                        )
+                    except Exception as e:
+                        logger.error(f"Erro ao enviar APNs para {destinatario_id}: {e}")
 
-                    logger.info(f"✅ Notificação TAREFA_CONCLUIDA enviada para: {destinatario_id} (FCM: {sucessos})")
+                logger.info(f"✅ Notificação TAREFA_CONCLUIDA enviada para: {destinatario_id} (FCM: {sucessos})")
 
             except Exception as e:
                 logger.error(f"❌ Erro ao notificar {destinatario_id} sobre tarefa concluída: {e}")
@@ -6708,6 +8477,9 @@ def _notificar_tarefa_atrasada(db: firestore.client, tarefa_a_verificar: Dict):
         
         webpush_tag = f"TAREFA_ATRASADA-tarefa-{tarefa_id}-paciente-{paciente_id}"
 
+        # Tokens de todos os destinatários em uma consulta ao registro
+        tokens_por_destinatario = buscar_tokens_por_usuarios(db, list(destinatarios))
+
         # Loop principal para cada destinatário
         for destinatario_id in destinatarios:
             try:
@@ -6716,12 +8488,12 @@ def _notificar_tarefa_atrasada(db: firestore.client, tarefa_a_verificar: Dict):
                     logger.warning(f"Destinatário {destinatario_id} não encontrado. Pulando.")
                     continue
                 
-                destinatario_data = destinatario_doc.to_dict()
-                fcm_tokens = destinatario_data.get('fcm_tokens', [])
-                apns_tokens = destinatario_data.get('apns_tokens', [])
+                tokens = tokens_por_destinatario.get(destinatario_id) or {'fcm': [], 'apns': []}
+                fcm_tokens = tokens['fcm']
+                apns_tokens = tokens['apns']
 
                 # PASSO 5: Persistir a Notificação no Histórico
-                db.collection('usuarios').document(destinatario_id).collection('notificacoes').add({
+                _persistir_notificacao(db, destinatario_id, {
                     "title": titulo,
                     "body": corpo,
                     "tipo": "TAREFA_ATRASADA",
@@ -6835,9 +8607,7 @@ def _notificar_paciente_exame_criado(db: firestore.client, paciente_id: str, exa
             logger.warning(f"Paciente {paciente_id} não encontrado para notificar exame criado.")
             return
 
-        paciente_data = paciente_doc.to_dict()
-        fcm_tokens = paciente_data.get('fcm_tokens', [])
-        apns_tokens = paciente_data.get('apns_tokens', [])
+        fcm_tokens, apns_tokens = buscar_tokens_do_usuario(db, paciente_id)
         nome_exame = exame_data.get('nome_exame', 'exame')
 
         titulo = "Novo Exame Agendado"
@@ -6846,7 +8616,7 @@ def _notificar_paciente_exame_criado(db: firestore.client, paciente_id: str, exa
         exame_id = exame_data.get('id', 'novo_exame')
 
         # Persistir no Firestore
-        paciente_doc_ref.collection('notificacoes').add({
+        _persistir_notificacao(db, paciente_id, {
             "title": titulo,
             "body": corpo,
             "tipo": "EXAME_CRIADO",
@@ -6883,14 +8653,15 @@ def _notificar_paciente_exame_criado(db: firestore.client, paciente_id: str, exa
 
         # Enviar APNs se houver tokens
         if apns_tokens:
-            from notification_helper import enviar_notificacao_para_usuario
+            from notification_helper import enviar_notificacao_hibrida
             try:
-                enviar_notificacao_para_usuario(
-                    paciente_data,
-                    titulo,
-                    corpo,
-                    data_payload,
-                    webpush_tag
+                enviar_notificacao_hibrida(
+                    fcm_tokens=[],
+                    apns_tokens=apns_tokens,
+                    titulo=titulo,
+                    corpo=corpo,
+                    data_payload=data_payload,
+                    webpush_tag=webpush_tag
                 )
                 logger.info(f"APNs enviado para paciente {paciente_id} (EXAME_CRIADO)")
             except Exception as e:
@@ -6926,14 +8697,14 @@ def _notificar_paciente_suporte_adicionado(db: firestore.client, paciente_id: st
         if not paciente_doc.exists: return
 
         paciente_data = paciente_doc.to_dict()
-        tokens_fcm = paciente_data.get('fcm_tokens', [])
+        tokens_fcm, _ = buscar_tokens_do_usuario(db, paciente_id)
 
         titulo = "Novo Suporte Psicológico"
         mensagem_body = "Um novo suporte psicológico foi postado para você."
 
         suporte_id = suporte_data.get('id', 'novo_suporte')
 
-        paciente_doc_ref.collection('notificacoes').add({
+        _persistir_notificacao(db, paciente_id, {
             "title": titulo,
             "body": mensagem_body,
             "tipo": "SUPORTE_ADICIONADO",
@@ -6980,9 +8751,15 @@ def processar_lembretes_exames(db: firestore.client) -> Dict:
     - COM horário: 1h antes do horário marcado
     - SEM horário: às 09:00 do dia do exame
 
-    Sistema roda a cada 15 minutos.
+    Sistema roda a cada 15 minutos. Os lembretes da rodada são preparados primeiro,
+    enviados por Web Push VAPID em paralelo (`send_batch`) e, para quem não recebeu,
+    por FCM; subscriptions inválidas são removidas em lote no final.
     """
+    from webpush_service import get_webpush_service
+
     stats = {"total_exames_verificados": 0, "total_lembretes_enviados": 0, "erros": 0}
+    preparados: List[Dict] = []
+    envios_vapid: Dict[str, Tuple[Dict, Dict]] = {}
 
     agora = datetime.now(timezone.utc)
 
@@ -7044,8 +8821,6 @@ def processar_lembretes_exames(db: firestore.client) -> Dict:
             if exames:
                 nome_paciente_raw = usuario_data.get('nome', '')
                 nome_paciente = decrypt_data(nome_paciente_raw) if nome_paciente_raw else "Paciente"
-                fcm_tokens = usuario_data.get('fcm_tokens', [])
-                apns_tokens = usuario_data.get('apns_tokens', [])
 
                 for exame_doc in exames:
                     try:
@@ -7127,98 +8902,79 @@ def processar_lembretes_exames(db: firestore.client) -> Dict:
                                 webpush_tag = f"LEMBRETE_EXAME-exame-{exame_doc.id}-paciente-{usuario_id}"
 
                                 # Persistir no Firestore
-                                notificacao_doc_ref.set({
+                                _persistir_notificacao(db, usuario_id, {
                                     "title": titulo,
                                     "body": corpo,
                                     "tipo": "LEMBRETE_EXAME",
                                     "relacionado": {"exame_id": exame_doc.id, "paciente_id": usuario_id},
                                     "lida": False,
                                     "data_criacao": firestore.SERVER_TIMESTAMP
-                                })
+                                }, notificacao_id)
 
-                                # Sistema híbrido com retry: VAPID → FCM fallback
-                                enviado_com_sucesso = False
                                 webpush_subscription = usuario_data.get('webpush_subscription_exames')
-
-                                # 1. Tentar VAPID primeiro
                                 if webpush_subscription:
-                                    try:
-                                        from pywebpush import webpush, WebPushException
-                                        from vapid_config import VAPID_PRIVATE_KEY, VAPID_CLAIMS_EMAIL
-                                        import json
-
-                                        # Montar payload da notificação
-                                        payload = json.dumps({
-                                            "title": titulo,
-                                            "body": corpo,
-                                            "data": data_payload,
-                                            "tag": webpush_tag
-                                        })
-
-                                        # Enviar Web Push
-                                        webpush(
-                                            subscription_info={
-                                                "endpoint": webpush_subscription["endpoint"],
-                                                "keys": webpush_subscription["keys"]
-                                            },
-                                            data=payload,
-                                            vapid_private_key=VAPID_PRIVATE_KEY,
-                                            vapid_claims={"sub": VAPID_CLAIMS_EMAIL}
-                                        )
-
-                                        enviado_com_sucesso = True
-                                        stats["total_lembretes_enviados"] += 1
-                                        logger.info(f"✅ LEMBRETE_EXAME enviado via VAPID para {usuario_id}")
-
-                                    except WebPushException as e:
-                                        logger.warning(f"⚠️ Falha VAPID para {usuario_id}: {e}")
-                                        # Se erro 403/410, subscription inválida - remover e tentar FCM
-                                        if e.response and e.response.status_code in [403, 410]:
-                                            logger.warning(f"⚠️ Subscription VAPID inválida/expirada, removendo e tentando FCM...")
-                                            usuario_doc.reference.update({
-                                                "webpush_subscription_exames": firestore.DELETE_FIELD
-                                            })
-                                    except Exception as e:
-                                        logger.warning(f"⚠️ Erro Web Push para {usuario_id}: {e}, tentando FCM...")
-
-                                # 2. Fallback para FCM se VAPID falhou ou não existe
-                                if not enviado_com_sucesso:
-                                    if fcm_tokens:
-                                        try:
-                                            from firebase_admin import messaging
-
-                                            for token in fcm_tokens:
-                                                try:
-                                                    message = messaging.Message(
-                                                        notification=messaging.Notification(
-                                                            title=titulo,
-                                                            body=corpo
-                                                        ),
-                                                        data=data_payload,
-                                                        token=token
-                                                    )
-                                                    messaging.send(message)
-                                                    enviado_com_sucesso = True
-                                                    logger.info(f"✅ LEMBRETE_EXAME enviado via FCM para {usuario_id}")
-                                                    break  # Sucesso, não precisa tentar outros tokens
-                                                except Exception as token_error:
-                                                    logger.warning(f"⚠️ Falha FCM token {token[:10]}... : {token_error}")
-                                                    continue
-
-                                            if enviado_com_sucesso:
-                                                stats["total_lembretes_enviados"] += 1
-                                        except Exception as e:
-                                            logger.error(f"❌ Erro FCM para {usuario_id}: {e}")
-                                    else:
-                                        logger.warning(f"⚠️ Usuário {usuario_id} sem VAPID e sem FCM tokens")
-
-                                if not enviado_com_sucesso:
-                                    logger.error(f"❌ FALHA TOTAL: Não foi possível enviar LEMBRETE_EXAME para {usuario_id}")
+                                    envios_vapid[notificacao_id] = (webpush_subscription, {
+                                        "title": titulo,
+                                        "body": corpo,
+                                        "data": data_payload,
+                                        "tag": webpush_tag
+                                    })
+                                preparados.append({
+                                    "notificacao_id": notificacao_id,
+                                    "usuario_id": usuario_id,
+                                    "titulo": titulo,
+                                    "corpo": corpo,
+                                    "data_payload": data_payload,
+                                })
 
                     except Exception as e:
                         stats["erros"] += 1
                         logger.error(f"❌ Erro ao processar lembrete para exame {exame_doc.id}: {e}")
 
+        # Sistema híbrido: VAPID em paralelo → FCM como fallback
+        webpush_service = get_webpush_service() if envios_vapid else None
+        status_vapid = webpush_service.send_batch(envios_vapid) if envios_vapid else {}
+        tokens_por_usuario = buscar_tokens_por_usuarios(
+            db, list({item["usuario_id"] for item in preparados})
+        ) if preparados else {}
+
+        subscriptions_invalidas = []
+        for item in preparados:
+            usuario_id = item["usuario_id"]
+            status_envio = status_vapid.get(item["notificacao_id"])
+            enviado_com_sucesso = status_envio is not None and webpush_service.sucesso(status_envio)
+
+            if enviado_com_sucesso:
+                logger.info(f"✅ LEMBRETE_EXAME enviado via VAPID para {usuario_id}")
+            elif status_envio is not None:
+                logger.warning(f"⚠️ Falha VAPID para {usuario_id} (status {status_envio}), tentando FCM...")
+                if webpush_service.subscription_invalida(status_envio):
+                    subscriptions_invalidas.append(usuario_id)
+
+            if not enviado_com_sucesso:
+                fcm_tokens = (tokens_por_usuario.get(usuario_id) or {}).get('fcm', [])
+                for token in fcm_tokens:
+                    try:
+                        messaging.send(messaging.Message(
+                            notification=messaging.Notification(title=item["titulo"], body=item["corpo"]),
+                            data=item["data_payload"],
+                            token=token
+                        ))
+                        enviado_com_sucesso = True
+                        logger.info(f"✅ LEMBRETE_EXAME enviado via FCM para {usuario_id}")
+                        break  # Sucesso, não precisa tentar outros tokens
+                    except Exception as token_error:
+                        logger.warning(f"⚠️ Falha FCM token {token[:10]}... : {token_error}")
+                if not fcm_tokens:
+                    logger.warning(f"⚠️ Usuário {usuario_id} sem VAPID e sem FCM tokens")
+
+            if enviado_com_sucesso:
+                stats["total_lembretes_enviados"] += 1
+            else:
+                logger.error(f"❌ FALHA TOTAL: Não foi possível enviar LEMBRETE_EXAME para {usuario_id}")
+
+        _remover_webpush_subscriptions_invalidas(db, list(dict.fromkeys(subscriptions_invalidas)))
+
     except Exception as e:
         stats["erros"] += 1
         logger.error(f"❌ Erro geral ao processar lembretes de exames: {e}")
@@ -7227,10 +8983,33 @@ def processar_lembretes_exames(db: firestore.client) -> Dict:
     return stats
 
 
+def _remover_webpush_subscriptions_invalidas(db: firestore.client, usuario_ids: List[str]):
+    """Remove, em lote, as subscriptions VAPID que o push service informou não existirem mais."""
+    if not usuario_ids:
+        return
+    try:
+        batch = db.batch()
+        for i, usuario_id in enumerate(usuario_ids, start=1):
+            batch.update(db.collection('usuarios').document(usuario_id), {
+                "webpush_subscription_exames": firestore.DELETE_FIELD
+            })
+            if i % 400 == 0:
+                batch.commit()
+                batch = db.batch()
+        batch.commit()
+        logger.info(f"🧹 {len(usuario_ids)} subscription(s) VAPID inválida(s) removida(s)")
+    except Exception as e:
+        logger.error(f"Erro ao remover subscriptions VAPID inválidas: {e}")
+
+
 def processar_notificacoes_agendadas(db: firestore.client, now: datetime) -> dict:
     """
     Processa notificações agendadas que estão prontas para serem enviadas.
+    Os Web Push VAPID de todas as notificações pendentes são enviados em paralelo;
+    quem não recebeu por VAPID cai no fallback FCM.
     """
+    from webpush_service import get_webpush_service
+
     stats = {
         "notificacoes_verificadas": 0,
         "notificacoes_enviadas": 0,
@@ -7242,6 +9021,9 @@ def processar_notificacoes_agendadas(db: firestore.client, now: datetime) -> dic
         notificacoes_pendentes = list(query.stream())
         stats["notificacoes_verificadas"] = len(notificacoes_pendentes)
 
+        # 1. Persistir no histórico e preparar os envios
+        preparadas = []
+        envios_vapid = {}
         for doc_notificacao in notificacoes_pendentes:
             try:
                 notif_data = doc_notificacao.to_dict()
@@ -7259,9 +9041,8 @@ def processar_notificacoes_agendadas(db: firestore.client, now: datetime) -> dic
                     continue
 
                 paciente_data = paciente_doc.to_dict()
-                tokens_fcm = paciente_data.get('fcm_tokens', [])
 
-                db.collection('usuarios').document(paciente_id).collection('notificacoes').add({
+                _persistir_notificacao(db, paciente_id, {
                     "title": titulo,
                     "body": mensagem,
                     "tipo": "LEMBRETE_AGENDADO",
@@ -7273,54 +9054,61 @@ def processar_notificacoes_agendadas(db: firestore.client, now: datetime) -> dic
                 # HÍBRIDO: Tenta Web Push VAPID primeiro, depois FCM como fallback
                 data_payload = {"tipo": "LEMBRETE_AGENDADO", "notificacao_agendada_id": doc_notificacao.id}
                 webpush_tag = f"LEMBRETE_AGENDADO-notificacao-{doc_notificacao.id}-paciente-{paciente_id}"
-                enviado_vapid = False
 
-                # 1. Tentar Web Push VAPID
                 webpush_subscription = paciente_data.get('webpush_subscription_exames')
                 if webpush_subscription:
-                    try:
-                        from pywebpush import webpush, WebPushException
-                        from vapid_config import VAPID_PRIVATE_KEY, VAPID_CLAIMS_EMAIL
-                        import json
-
-                        payload = json.dumps({
-                            "title": titulo,
-                            "body": mensagem,
-                            "data": data_payload,
-                            "tag": webpush_tag
-                        })
-
-                        webpush(
-                            subscription_info={
-                                "endpoint": webpush_subscription["endpoint"],
-                                "keys": webpush_subscription["keys"]
-                            },
-                            data=payload,
-                            vapid_private_key=VAPID_PRIVATE_KEY,
-                            vapid_claims={"sub": VAPID_CLAIMS_EMAIL}
-                        )
-
-                        enviado_vapid = True
-                        logger.info(f"✅ LEMBRETE_AGENDADO enviado via Web Push para {paciente_id}")
-
-                    except WebPushException as e:
-                        logger.warning(f"⚠️ Falha VAPID para {paciente_id}: {e}, tentando FCM...")
-                        if e.response and e.response.status_code in [403, 410]:
-                            logger.warning(f"⚠️ Subscription VAPID inválida/expirada, removendo...")
-                            paciente_doc.reference.update({"webpush_subscription_exames": firestore.DELETE_FIELD})
-                    except Exception as e:
-                        logger.warning(f"⚠️ Erro Web Push para {paciente_id}: {e}, tentando FCM...")
+                    envios_vapid[doc_notificacao.id] = (webpush_subscription, {
+                        "title": titulo,
+                        "body": mensagem,
+                        "data": data_payload,
+                        "tag": webpush_tag
+                    })
+
+                preparadas.append({
+                    "doc": doc_notificacao,
+                    "paciente_id": paciente_id,
+                    "titulo": titulo,
+                    "mensagem": mensagem,
+                    "data_payload": data_payload,
+                    "webpush_tag": webpush_tag,
+                })
+            except Exception as e:
+                stats["notificacoes_erro"] += 1
+                doc_notificacao.reference.update({"status": "erro", "erro": str(e)})
 
-                # 2. Fallback: FCM (se VAPID não enviou)
-                if not enviado_vapid and tokens_fcm:
-                    for token in tokens_fcm:
+        # 2. Web Push VAPID em paralelo
+        webpush_service = get_webpush_service() if envios_vapid else None
+        status_vapid = webpush_service.send_batch(envios_vapid) if envios_vapid else {}
+
+        # 3. Fallback FCM para quem não recebeu por VAPID e atualização do status
+        tokens_por_paciente = buscar_tokens_por_usuarios(
+            db, list({item["paciente_id"] for item in preparadas})
+        ) if preparadas else {}
+        subscriptions_invalidas = []
+        for item in preparadas:
+            doc_notificacao = item["doc"]
+            paciente_id = item["paciente_id"]
+            item["tokens_fcm"] = (tokens_por_paciente.get(paciente_id) or {}).get('fcm', [])
+            try:
+                status_envio = status_vapid.get(doc_notificacao.id)
+                enviado_vapid = status_envio is not None and webpush_service.sucesso(status_envio)
+
+                if enviado_vapid:
+                    logger.info(f"✅ LEMBRETE_AGENDADO enviado via Web Push para {paciente_id}")
+                elif status_envio is not None:
+                    logger.warning(f"⚠️ Falha VAPID para {paciente_id} (status {status_envio}), tentando FCM...")
+                    if webpush_service.subscription_invalida(status_envio):
+                        subscriptions_invalidas.append(paciente_id)
+
+                if not enviado_vapid and item["tokens_fcm"]:
+                    for token in item["tokens_fcm"]:
                         try:
                             message = messaging.Message(
-                                notification=messaging.Notification(title=titulo, body=mensagem),
-                                data=data_payload,
+                                notification=messaging.Notification(title=item["titulo"], body=item["mensagem"]),
+                                data=item["data_payload"],
                                 token=token,
                                 webpush=messaging.WebpushConfig(
-                                    notification=messaging.WebpushNotification(tag=webpush_tag)
+                                    notification=messaging.WebpushNotification(tag=item["webpush_tag"])
                                 )
                             )
                             messaging.send(message)
@@ -7334,6 +9122,8 @@ def processar_notificacoes_agendadas(db: firestore.client, now: datetime) -> dic
             except Exception as e:
                 stats["notificacoes_erro"] += 1
                 doc_notificacao.reference.update({"status": "erro", "erro": str(e)})
+
+        _remover_webpush_subscriptions_invalidas(db, list(dict.fromkeys(subscriptions_invalidas)))
     except Exception as e:
         stats["notificacoes_erro"] += 1
         logger.error(f"Erro geral no processamento de notificações agendadas: {e}")
@@ -7404,7 +9194,6 @@ def get_usuario_por_id(db: firestore.client, usuario_id: str) -> Optional[Dict]:
 
 from google.cloud import tasks_v2
 from google.protobuf import timestamp_pb2
-import json
 import os
 
 def _get_cloud_tasks_client():
@@ -7682,13 +9471,15 @@ def enviar_notificacoes_tarefa_atrasada(
         # Envia para cada destinatário
         total_enviadas = 0
         total_falhas = 0
+        tokens_por_destinatario = buscar_tokens_por_usuarios(db, [d['id'] for d in destinatarios])
 
         for destinatario in destinatarios:
             usuario_id = destinatario['id']
             usuario_nome = destinatario.get('nome', 'Usuário')
 
-            fcm_tokens = destinatario.get('fcm_tokens', [])
-            apns_tokens = destinatario.get('apns_tokens', [])
+            tokens = tokens_por_destinatario.get(usuario_id) or {'fcm': [], 'apns': []}
+            fcm_tokens = tokens['fcm']
+            apns_tokens = tokens['apns']
 
             if not fcm_tokens and not apns_tokens:
                 logger.warning(f"⚠️ Usuário {usuario_nome} sem tokens")
@@ -7990,26 +9781,52 @@ def enviar_lembrete_exame(
         }
 
         # Busca tokens do paciente
-        fcm_tokens = paciente_data.get('fcm_tokens', [])
-        apns_tokens = paciente_data.get('apns_tokens', [])
+        fcm_tokens, apns_tokens = buscar_tokens_do_usuario(db, paciente_id)
+        webpush_subscription = paciente_data.get('webpush_subscription_exames')
+        webpush_tag = f"lembrete-exame-{exame_id}"
 
-        if not fcm_tokens and not apns_tokens:
+        if not fcm_tokens and not apns_tokens and not webpush_subscription:
             logger.warning(f"⚠️ Paciente sem tokens de notificação")
             return
 
-        logger.info(f"📤 Enviando para paciente: {len(fcm_tokens)} FCM + {len(apns_tokens)} APNs")
+        total_enviadas = 0
+        total_falhas = 0
 
-        resultado = enviar_notificacao_hibrida(
-            fcm_tokens=fcm_tokens,
-            apns_tokens=apns_tokens,
-            titulo=titulo,
-            corpo=corpo,
-            data_payload=data_payload,
-            webpush_tag=f"lembrete-exame-{exame_id}"
-        )
+        # 1. Web Push VAPID (subscription dedicada aos lembretes de exames)
+        if webpush_subscription:
+            from webpush_service import get_webpush_service
+
+            webpush_service = get_webpush_service()
+            status_envio = webpush_service.send_notification(webpush_subscription, {
+                "title": titulo,
+                "body": corpo,
+                "data": data_payload,
+                "tag": webpush_tag
+            })
+            if webpush_service.sucesso(status_envio):
+                total_enviadas += 1
+                logger.info(f"✅ Lembrete de exame enviado via VAPID para {paciente_id}")
+            else:
+                total_falhas += 1
+                if webpush_service.subscription_invalida(status_envio):
+                    logger.warning(f"⚠️ Subscription VAPID inválida/expirada, removendo...")
+                    usuario_ref.update({"webpush_subscription_exames": firestore.DELETE_FIELD})
+
+        # 2. FCM + APNs quando o VAPID não entregou
+        if total_enviadas == 0 and (fcm_tokens or apns_tokens):
+            logger.info(f"📤 Enviando para paciente: {len(fcm_tokens)} FCM + {len(apns_tokens)} APNs")
+
+            resultado = enviar_notificacao_hibrida(
+                fcm_tokens=fcm_tokens,
+                apns_tokens=apns_tokens,
+                titulo=titulo,
+                corpo=corpo,
+                data_payload=data_payload,
+                webpush_tag=webpush_tag
+            )
 
-        total_enviadas = resultado['fcm_sucessos'] + resultado['apns_sucessos']
-        total_falhas = resultado['fcm_falhas'] + resultado['apns_falhas']
+            total_enviadas += resultado['fcm_sucessos'] + resultado['apns_sucessos']
+            total_falhas += resultado['fcm_falhas'] + resultado['apns_falhas']
 
         logger.info(f"✅ Notificações: {total_enviadas} sucessos, {total_falhas} falhas")
 
@@ -8084,8 +9901,7 @@ def salvar_notificacao_firestore(
         logger.info(f"🔍 DEBUG salvar_notificacao - Dados: tipo={tipo}, title={titulo}, body_len={len(mensagem) if mensagem else 0}, lida=False, usuario_id={usuario_id}")
 
         # Salva na SUBCOLEÇÃO /usuarios/{id}/notificacoes/
-        doc_ref = db.collection('usuarios').document(usuario_id).collection('notificacoes').add(notificacao_data)
-        notificacao_id = doc_ref[1].id
+        notificacao_id = _persistir_notificacao(db, usuario_id, notificacao_data)
 
         logger.info(f"✅ Notificação salva no Firestore: {notificacao_id} (tipo: {tipo}, usuário: {usuario_id}, title: {titulo}, lida: False)")
         return notificacao_id
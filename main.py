@@ -1,13 +1,14 @@
 # barbearia-backend/main.py (Versão estável com Checklist do Técnico)
 
-from fastapi import FastAPI, Depends, HTTPException, status, Header, Path, Query, UploadFile, File, Request
-from fastapi.responses import FileResponse, RedirectResponse
+from fastapi import FastAPI, Depends, HTTPException, status, Header, Path, Query, UploadFile, File, Request, Response, BackgroundTasks
+from fastapi.responses import FileResponse, RedirectResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from typing import List, Optional, Union, Dict
 import os
 import schemas
 import crud
+import notification_stream
 import logging
 from datetime import date, timedelta, datetime
 from crypto_utils import decrypt_data
@@ -125,6 +126,14 @@ def get_profile_image(filename: str):
 def root():
     return {"mensagem": "API de Agendamento Multi-Tenant funcionando", "versao": "2.2.0-FINAL"}
 
+def _resposta_catalogo(response: Response, if_none_match: Optional[str], itens: List[Dict], etag: str, cache_control: str):
+    """Devolve 304 quando o If-None-Match do cliente bate com o ETag do catálogo; senão, a lista com o ETag."""
+    cabecalhos = {"ETag": etag, "Cache-Control": cache_control}
+    if if_none_match and etag in [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=cabecalhos)
+    response.headers.update(cabecalhos)
+    return itens
+
 # =================================================================================
 # ENDPOINTS DE ADMINISTRAÇÃO DA PLATAFORMA (SUPER-ADMIN)
 # =================================================================================
@@ -149,6 +158,13 @@ def admin_listar_negocios(
     """(Super-Admin) Lista todos os negócios cadastrados na plataforma."""
     return crud.admin_listar_negocios(db)
 
+@app.get("/admin/metricas/cache-disponibilidade", tags=["Admin - Plataforma"])
+def admin_metricas_cache_disponibilidade(
+    admin: schemas.UsuarioProfile = Depends(get_super_admin_user)
+):
+    """(Super-Admin) Hits, misses e taxa de acerto do cache de horários disponíveis desta instância."""
+    return crud.estatisticas_cache_disponibilidade()
+
 # =================================================================================
 # ENDPOINTS DE GERENCIAMENTO DO NEGÓCIO (ADMIN DE NEGÓCIO)
 # =================================================================================
@@ -248,6 +264,23 @@ def atualizar_role_usuario(
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+@app.post("/negocios/{negocio_id}/avisos", response_model=schemas.AvisoNegocioResponse, tags=["Admin - Gestão do Negócio"])
+def enviar_aviso_negocio(
+    aviso: schemas.AvisoNegocioCreate,
+    background_tasks: BackgroundTasks,
+    negocio_id: str = Depends(validate_path_negocio_id),
+    admin: schemas.UsuarioProfile = Depends(get_current_admin_user),
+    db: firestore.client = Depends(get_db)
+):
+    """
+    (Admin de Negócio) Envia um aviso para toda a clínica ou para roles específicas.
+    O push sai uma vez por tópico FCM; o histórico de cada destinatário é preenchido em segundo plano após a resposta.
+    """
+    try:
+        return crud.enviar_aviso_negocio(db, negocio_id, aviso.titulo, aviso.corpo, aviso.roles, admin.id, background_tasks)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 @app.post("/negocios/{negocio_id}/medicos", response_model=schemas.MedicoResponse, tags=["Admin - Gestão do Negócio"])
 def criar_medico(
     medico_data: schemas.MedicoBase,
@@ -261,12 +294,15 @@ def criar_medico(
 
 @app.get("/negocios/{negocio_id}/medicos", response_model=List[schemas.MedicoResponse], tags=["Admin - Gestão do Negócio"])
 def listar_medicos(
+    response: Response,
     negocio_id: str = Depends(validate_path_negocio_id),
+    if_none_match: Optional[str] = Header(None),
     admin: schemas.UsuarioProfile = Depends(get_current_admin_user),
     db: firestore.client = Depends(get_db)
 ):
-    """(Admin de Negócio) Lista todos os médicos de referência da clínica."""
-    return crud.listar_medicos_por_negocio(db, negocio_id)
+    """(Admin de Negócio) Lista todos os médicos de referência da clínica. Suporta If-None-Match (304)."""
+    medicos, etag = crud.obter_catalogo(db, 'medicos', negocio_id)
+    return _resposta_catalogo(response, if_none_match, medicos, etag, "private, no-cache")
 
 @app.patch("/negocios/{negocio_id}/medicos/{medico_id}", response_model=schemas.MedicoResponse, tags=["Admin - Gestão do Negócio"])
 def update_medico_endpoint(
@@ -1064,16 +1100,19 @@ def criar_meu_servico(
 
 @app.get("/me/servicos", response_model=List[schemas.ServicoResponse], tags=["Profissional - Autogestão"])
 def listar_meus_servicos(
+    response: Response,
     negocio_id: str = Depends(validate_negocio_id),
+    if_none_match: Optional[str] = Header(None),
     profissional_user: schemas.UsuarioProfile = Depends(get_current_profissional_user),
     db: firestore.client = Depends(get_db)
 ):
-    """(Profissional) Lista todos os serviços associados ao seu perfil."""
+    """(Profissional) Lista todos os serviços associados ao seu perfil. Suporta If-None-Match (304)."""
     perfil_profissional = crud.buscar_profissional_por_uid(db, negocio_id, profissional_user.firebase_uid)
     if not perfil_profissional:
         raise HTTPException(status_code=404, detail="Perfil profissional não encontrado.")
-        
-    return crud.listar_servicos_por_profissional(db, perfil_profissional['id'])
+
+    servicos, etag = crud.obter_catalogo(db, 'servicos', perfil_profissional['id'])
+    return _resposta_catalogo(response, if_none_match, servicos, etag, "private, no-cache")
 
 @app.put("/me/servicos/{servico_id}", response_model=schemas.ServicoResponse, tags=["Profissional - Autogestão"])
 def atualizar_meu_servico(
@@ -1220,12 +1259,32 @@ def criar_postagem(
 @app.get("/feed", response_model=List[schemas.PostagemResponse], tags=["Feed e Interações"])
 def get_feed(
     negocio_id: str,
+    response: Response,
+    limit: int = Query(crud.FEED_PAGINA_PADRAO, ge=1, le=crud.FEED_PAGINA_MAXIMA, description="Quantidade de postagens por página."),
+    after: Optional[str] = Query(None, description="ID da última postagem da página anterior."),
+    preview_comentarios: int = Query(0, ge=0, le=crud.COMENTARIOS_PREVIEW_MAXIMO, description="Quantos comentários recentes embutir em cada postagem."),
+    if_none_match: Optional[str] = Header(None),
     db: firestore.client = Depends(get_db),
     current_user: Optional[schemas.UsuarioProfile] = Depends(get_optional_current_user_firebase)
 ):
-    """(Público) Retorna o feed de postagens de um negócio específico."""
+    """
+    (Público) Retorna o feed de postagens de um negócio específico, paginado da mais recente para a mais antiga.
+    Responde com ETag; um If-None-Match ainda válido recebe 304 sem corpo.
+    """
     user_id = current_user.id if current_user else None
-    return crud.listar_feed_por_negocio(db, negocio_id, user_id)
+    try:
+        postagens, etag = crud.obter_feed_por_negocio(
+            db, negocio_id, user_id, limit=limit, after=after,
+            if_none_match=if_none_match, preview_comentarios=preview_comentarios
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    cabecalhos = {"ETag": etag, "Cache-Control": "private, no-cache", "Vary": "Authorization"}
+    if postagens is None:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=cabecalhos)
+    response.headers.update(cabecalhos)
+    return postagens
 
 @app.post("/postagens/{postagem_id}/curtir", tags=["Feed e Interações"])
 def curtir_postagem(
@@ -1234,7 +1293,10 @@ def curtir_postagem(
     db: firestore.client = Depends(get_db)
 ):
     """(Autenticado) Curte ou descurte uma postagem."""
-    resultado = crud.toggle_curtida(db, postagem_id, current_user.id)
+    try:
+        resultado = crud.toggle_curtida(db, postagem_id, current_user.id)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
     return {"curtido": resultado}
 
 @app.post("/comentarios", response_model=schemas.ComentarioResponse, tags=["Feed e Interações"])
@@ -1249,24 +1311,34 @@ def criar_comentario(
 @app.get("/comentarios/{postagem_id}", response_model=List[schemas.ComentarioResponse], tags=["Feed e Interações"])
 def get_comentarios(
     postagem_id: str,
+    limit: int = Query(crud.COMENTARIOS_PAGINA_PADRAO, ge=1, le=crud.COMENTARIOS_PAGINA_MAXIMA, description="Quantidade de comentários por página."),
+    after: Optional[str] = Query(None, description="Traz os comentários seguintes (mais novos) a este ID."),
+    before: Optional[str] = Query(None, description="Traz os comentários anteriores (mais antigos) a este ID."),
+    recentes: bool = Query(False, description="Se verdadeiro, retorna só os últimos `limit` comentários (prévia)."),
     db: firestore.client = Depends(get_db)
 ):
-    """(Público) Lista todos os comentários de uma postagem."""
-    return crud.listar_comentarios(db, postagem_id)
+    """(Público) Lista os comentários de uma postagem em ordem cronológica, paginados por cursor."""
+    if recentes:
+        return crud.listar_comentarios_recentes(db, postagem_id, limit)
+    try:
+        return crud.listar_comentarios(db, postagem_id, limit=limit, after=after, before=before)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 @app.delete("/postagens/{postagem_id}", status_code=status.HTTP_204_NO_CONTENT, tags=["Feed e Interações"])
 def deletar_postagem(
     postagem_id: str,
+    background_tasks: BackgroundTasks,
     negocio_id: str = Depends(validate_negocio_id),
     profissional_user: schemas.UsuarioProfile = Depends(get_current_profissional_user),
     db: firestore.client = Depends(get_db)
 ):
-    """(Profissional) Deleta uma de suas postagens."""
+    """(Profissional) Deleta uma de suas postagens. Curtidas e comentários são apagados em segundo plano."""
     perfil_profissional = crud.buscar_profissional_por_uid(db, negocio_id, profissional_user.firebase_uid)
     if not perfil_profissional:
         raise HTTPException(status_code=404, detail="Perfil profissional não encontrado.")
         
-    if not crud.deletar_postagem(db, postagem_id, perfil_profissional['id']):
+    if not crud.deletar_postagem(db, postagem_id, perfil_profissional['id'], background_tasks):
         raise HTTPException(status_code=403, detail="Postagem não encontrada ou não pertence a este profissional.")
     
     return
@@ -1295,15 +1367,34 @@ def criar_avaliacao(
     db: firestore.client = Depends(get_db)
 ):
     """(Cliente) Cria uma nova avaliação para um profissional."""
-    return crud.criar_avaliacao(db, avaliacao_data, current_user)
+    try:
+        return crud.criar_avaliacao(db, avaliacao_data, current_user)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
 
 @app.get("/avaliacoes/{profissional_id}", response_model=List[schemas.AvaliacaoResponse], tags=["Avaliações"])
 def listar_avaliacoes(
     profissional_id: str,
+    limit: int = Query(crud.AVALIACOES_PAGINA_PADRAO, ge=1, le=crud.AVALIACOES_PAGINA_MAXIMA, description="Quantidade de avaliações por página."),
+    after: Optional[str] = Query(None, description="ID da última avaliação da página anterior."),
     db: firestore.client = Depends(get_db)
 ):
-    """(Público) Lista todas as avaliações de um profissional."""
-    return crud.listar_avaliacoes_por_profissional(db, profissional_id)
+    """(Público) Lista as avaliações de um profissional, paginadas da mais recente para a mais antiga."""
+    try:
+        return crud.listar_avaliacoes_por_profissional(db, profissional_id, limit=limit, after=after)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/avaliacoes/{profissional_id}/resumo", response_model=schemas.AvaliacoesResumo, tags=["Avaliações"])
+def resumo_avaliacoes(
+    profissional_id: str,
+    db: firestore.client = Depends(get_db)
+):
+    """(Público) Total, média e histograma por nota das avaliações de um profissional."""
+    try:
+        return crud.obter_resumo_avaliacoes(db, profissional_id)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
 
 # =================================================================================
 # ENDPOINTS DE NOTIFICAÇÕES
@@ -1311,11 +1402,16 @@ def listar_avaliacoes(
 
 @app.get("/notificacoes", response_model=List[schemas.NotificacaoResponse], tags=["Notificações"])
 def get_notificacoes(
+    limit: int = Query(crud.NOTIFICACOES_PAGINA_PADRAO, ge=1, le=crud.NOTIFICACOES_PAGINA_MAXIMA, description="Quantidade de notificações por página."),
+    after: Optional[str] = Query(None, description="ID da última notificação da página anterior."),
     current_user: schemas.UsuarioProfile = Depends(get_current_user_firebase),
     db: firestore.client = Depends(get_db)
 ):
-    """(Autenticado) Retorna o histórico de notificações do usuário."""
-    return crud.listar_notificacoes(db, current_user.id)
+    """(Autenticado) Retorna o histórico de notificações do usuário, paginado da mais recente para a mais antiga."""
+    try:
+        return crud.listar_notificacoes(db, current_user.id, limit=limit, after=after)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 @app.get("/notificacoes/nao-lidas/contagem", response_model=schemas.NotificacaoContagemResponse, tags=["Notificações"])
 def get_contagem_notificacoes_nao_lidas(
@@ -1326,13 +1422,58 @@ def get_contagem_notificacoes_nao_lidas(
     count = crud.contar_notificacoes_nao_lidas(db, current_user.id)
     return {"count": count}
 
+@app.get("/notificacoes/arquivo", response_model=List[schemas.ArquivoNotificacoesMesResponse], tags=["Notificações"])
+def get_meses_arquivo_notificacoes(
+    current_user: schemas.UsuarioProfile = Depends(get_current_user_firebase),
+    db: firestore.client = Depends(get_db)
+):
+    """(Autenticado) Lista os meses com notificações antigas arquivadas."""
+    return crud.listar_meses_arquivo_notificacoes(db, current_user.id)
+
+@app.get("/notificacoes/arquivo/{mes}", response_model=List[schemas.NotificacaoArquivadaResponse], tags=["Notificações"])
+def get_notificacoes_arquivadas(
+    mes: str = Path(..., pattern=r"^\d{4}-\d{2}$", description="Mês no formato AAAA-MM."),
+    current_user: schemas.UsuarioProfile = Depends(get_current_user_firebase),
+    db: firestore.client = Depends(get_db)
+):
+    """(Autenticado) Retorna as notificações arquivadas de um mês."""
+    return crud.listar_notificacoes_arquivadas(db, current_user.id, mes)
+
+@app.get("/notificacoes/stream", tags=["Notificações"])
+async def stream_notificacoes(
+    request: Request,
+    current_user: schemas.UsuarioProfile = Depends(get_current_user_firebase),
+    db: firestore.client = Depends(get_db)
+):
+    """
+    (Autenticado) Stream SSE com novas notificações e a contagem de não lidas.
+    Substitui o polling de /notificacoes e /notificacoes/nao-lidas/contagem.
+    """
+    try:
+        gerador = notification_stream.abrir_stream(db, current_user.id, request)
+    except notification_stream.LimiteOuvintesAtingido:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Limite de conexões de notificações atingido. Tente novamente em instantes.",
+            headers={"Retry-After": "30"}
+        )
+    return StreamingResponse(
+        gerador,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.post("/notificacoes/ler-todas", status_code=status.HTTP_204_NO_CONTENT, tags=["Notificações"])
 def marcar_todas_como_lidas(
+    background_tasks: BackgroundTasks,
     current_user: schemas.UsuarioProfile = Depends(get_current_user_firebase),
     db: firestore.client = Depends(get_db)
 ):
-    """(Autenticado) Marca todas as notificações do usuário como lidas."""
-    crud.marcar_todas_como_lidas(db, current_user.id)
+    """
+    (Autenticado) Marca todas as notificações do usuário como lidas.
+    Responde 204 na hora; a marcação roda em segundo plano, sem segurar a requisição.
+    """
+    background_tasks.add_task(crud.marcar_todas_como_lidas, db, current_user.id)
     return
 
 @app.post("/notificacoes/agendar", response_model=schemas.NotificacaoAgendadaResponse, tags=["Notificações"])
@@ -1488,7 +1629,9 @@ def register_fcm_token_endpoint(
     db: firestore.client = Depends(get_db)
 ):
     """Registra ou atualiza o token de notificação (FCM) para o dispositivo do usuário."""
-    crud.adicionar_fcm_token(db, current_user.firebase_uid, request.fcm_token)
+    crud.adicionar_fcm_token(
+        db, current_user.firebase_uid, request.fcm_token, current_user.id, current_user.roles, current_user.status_por_negocio
+    )
     return {"message": "FCM token registrado com sucesso."}
 
 @app.post("/me/register-apns-token", status_code=status.HTTP_200_OK, tags=["Usuários"])
@@ -1498,7 +1641,7 @@ def register_apns_token_endpoint(
     db: firestore.client = Depends(get_db)
 ):
     """Registra ou atualiza o token de notificação APNs (Safari/iOS Web Push) para o dispositivo do usuário."""
-    crud.adicionar_apns_token(db, current_user.firebase_uid, request.apns_token)
+    crud.adicionar_apns_token(db, current_user.firebase_uid, request.apns_token, current_user.id, current_user.roles)
     return {"message": "APNs token registrado com sucesso."}
 
 @app.delete("/me/remove-apns-token", status_code=status.HTTP_200_OK, tags=["Usuários"])
@@ -1746,10 +1889,13 @@ def get_admin_status(
 @app.get("/profissionais", response_model=List[schemas.ProfissionalResponse], tags=["Profissionais"])
 def listar_profissionais(
     negocio_id: str,
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
     db: firestore.client = Depends(get_db)
 ):
-    """Lista todos os profissionais ativos de um negócio específico."""
-    return crud.listar_profissionais_por_negocio(db, negocio_id)
+    """Lista todos os profissionais ativos de um negócio específico. Suporta If-None-Match (304)."""
+    profissionais, etag = crud.obter_catalogo(db, 'profissionais', negocio_id)
+    return _resposta_catalogo(response, if_none_match, profissionais, etag, "public, no-cache")
 
 # Em main.py
 
@@ -1802,6 +1948,7 @@ def get_profissional_details(
     postagens = crud.listar_postagens_por_profissional(db, profissional_id)
     profissional['postagens'] = postagens
     
+    # Só a primeira página; o resumo (média/histograma) já vem no documento do profissional
     avaliacoes = crud.listar_avaliacoes_por_profissional(db, profissional_id)
     profissional['avaliacoes'] = avaliacoes
     
@@ -1825,16 +1972,33 @@ def get_horarios_disponiveis(
     """(Público) Calcula e retorna os horários livres de um profissional em um dia específico."""
     return crud.calcular_horarios_disponiveis(db, profissional_id, dia, duracao_servico)
 
+@app.get("/disponibilidade", response_model=schemas.DisponibilidadePeriodoResponse, tags=["Agendamentos"])
+def get_disponibilidade_periodo(
+    profissional_ids: List[str] = Query(..., description="IDs dos profissionais (repita o parâmetro para vários)."),
+    data_inicio: date = Query(..., description="Primeiro dia do período (AAAA-MM-DD)."),
+    data_fim: date = Query(..., description="Último dia do período (AAAA-MM-DD)."),
+    duracao_servico: int = Query(60, ge=5, le=480, description="Duração do serviço em minutos para calcular os slots."),
+    db: firestore.client = Depends(get_db)
+):
+    """(Público) Disponibilidade de vários profissionais em um intervalo de dias, em formato compacto (bitset por dia)."""
+    try:
+        return crud.calcular_disponibilidade_periodo(db, profissional_ids, data_inicio, data_fim, duracao_servico)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 @app.post("/agendamentos", response_model=schemas.AgendamentoResponse, tags=["Agendamentos"])
 def agendar(
     agendamento: schemas.AgendamentoCreate,
+    background_tasks: BackgroundTasks,
     current_user: schemas.UsuarioProfile = Depends(get_current_user_firebase),
     db: firestore.client = Depends(get_db)
 ):
-    """(Cliente) Cria um novo agendamento para o usuário autenticado."""
+    """(Cliente) Cria um novo agendamento para o usuário autenticado. O profissional é notificado após a resposta."""
     try:
-        novo_agendamento = crud.criar_agendamento(db, agendamento, current_user)
+        novo_agendamento = crud.criar_agendamento(db, agendamento, current_user, background_tasks)
         return novo_agendamento
+    except crud.HorarioIndisponivel as e:
+        raise HTTPException(status_code=409, detail=str(e))
     except ValueError as e:
         raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
@@ -1844,11 +2008,18 @@ def agendar(
 @app.get("/agendamentos/me", response_model=List[schemas.AgendamentoResponse], tags=["Agendamentos"])
 def listar_meus_agendamentos_cliente(
     negocio_id: str = Header(..., description="ID do Negócio para filtrar os agendamentos."),
+    desde: Optional[datetime] = Query(None, description="Início da janela (padrão: 30 dias atrás)."),
+    ate: Optional[datetime] = Query(None, description="Fim da janela (padrão: sem limite, inclui os próximos)."),
+    limit: int = Query(crud.AGENDAMENTOS_PAGINA_PADRAO, ge=1, le=crud.AGENDAMENTOS_PAGINA_MAXIMA, description="Quantidade de agendamentos por página."),
+    after: Optional[str] = Query(None, description="ID do último agendamento da página anterior."),
     current_user: schemas.UsuarioProfile = Depends(get_current_user_firebase),
     db: firestore.client = Depends(get_db)
 ):
-    """(Cliente) Lista todos os agendamentos do cliente autenticado em um negócio específico."""
-    return crud.listar_agendamentos_por_cliente(db, negocio_id, current_user.id)
+    """(Cliente) Lista os agendamentos do cliente autenticado em um negócio, do mais recente para o mais antigo."""
+    try:
+        return crud.listar_agendamentos_por_cliente(db, negocio_id, current_user.id, desde, ate, limit, after)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 @app.delete("/agendamentos/{agendamento_id}", status_code=status.HTTP_200_OK, tags=["Agendamentos"])
 def cancelar_agendamento_endpoint(
@@ -1870,15 +2041,22 @@ def cancelar_agendamento_endpoint(
 @app.get("/me/agendamentos", response_model=List[schemas.AgendamentoResponse], tags=["Profissional - Autogestão"])
 def listar_meus_agendamentos_profissional(
     negocio_id: str = Header(..., description="ID do Negócio no qual o profissional está atuando."),
+    desde: Optional[datetime] = Query(None, description="Início da janela (padrão: 30 dias atrás)."),
+    ate: Optional[datetime] = Query(None, description="Fim da janela (padrão: sem limite, inclui os próximos)."),
+    limit: int = Query(crud.AGENDAMENTOS_PAGINA_PADRAO, ge=1, le=crud.AGENDAMENTOS_PAGINA_MAXIMA, description="Quantidade de agendamentos por página."),
+    after: Optional[str] = Query(None, description="ID do último agendamento da página anterior."),
     profissional_user: schemas.UsuarioProfile = Depends(get_current_profissional_user),
     db: firestore.client = Depends(get_db)
 ):
-    """(Profissional) Lista todos os agendamentos recebidos."""
+    """(Profissional) Lista os agendamentos recebidos, do mais recente para o mais antigo."""
     perfil_profissional = crud.buscar_profissional_por_uid(db, negocio_id, profissional_user.firebase_uid)
     if not perfil_profissional:
         raise HTTPException(status_code=404, detail="Perfil profissional não encontrado.")
     
-    return crud.listar_agendamentos_por_profissional(db, negocio_id, perfil_profissional['id'])
+    try:
+        return crud.listar_agendamentos_por_profissional(db, negocio_id, perfil_profissional['id'], desde, ate, limit, after)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 @app.patch("/me/agendamentos/{agendamento_id}/cancelar", response_model=schemas.AgendamentoResponse, tags=["Profissional - Autogestão"])
 def cancelar_agendamento_pelo_profissional_endpoint(
@@ -2684,162 +2862,6 @@ def process_overdue_tasks_debug():
         }
 
 
-def processar_notificacoes_agendadas(db: firestore.client, now: datetime) -> dict:
-    """
-    Processa notificações agendadas que estão prontas para serem enviadas.
-    """
-    stats = {
-        "notificacoes_verificadas": 0,
-        "notificacoes_enviadas": 0,
-        "notificacoes_erro": 0
-    }
-
-    try:
-        # Buscar notificações agendadas que devem ser enviadas agora
-        notificacoes_ref = db.collection('notificacoes_agendadas')
-        query = notificacoes_ref.where('status', '==', 'agendada').where('data_agendamento', '<=', now)
-
-        notificacoes_pendentes = list(query.stream())
-        stats["notificacoes_verificadas"] = len(notificacoes_pendentes)
-
-        logger.info(f"Encontradas {len(notificacoes_pendentes)} notificações para processar")
-
-        for doc_notificacao in notificacoes_pendentes:
-            try:
-                notif_data = doc_notificacao.to_dict()
-                paciente_id = notif_data.get('paciente_id')
-                titulo = notif_data.get('titulo')
-                mensagem = notif_data.get('mensagem')
-
-                if not paciente_id:
-                    logger.warning(f"Notificação {doc_notificacao.id} sem paciente_id")
-                    continue
-
-                # Buscar dados do paciente
-                paciente_doc = db.collection('usuarios').document(paciente_id).get()
-                if not paciente_doc.exists:
-                    logger.warning(f"Paciente {paciente_id} não encontrado")
-                    doc_notificacao.reference.update({"status": "erro", "erro": "Paciente não encontrado"})
-                    stats["notificacoes_erro"] += 1
-                    continue
-
-                paciente_data = paciente_doc.to_dict()
-                tokens_fcm = paciente_data.get('fcm_tokens', [])
-
-                # Persistir notificação no banco do paciente
-                db.collection('usuarios').document(paciente_id).collection('notificacoes').add({
-                    "title": titulo,
-                    "body": mensagem,
-                    "tipo": "LEMBRETE_AGENDADO",
-                    "relacionado": {"notificacao_agendada_id": doc_notificacao.id},
-                    "lida": False,
-                    "data_criacao": firestore.SERVER_TIMESTAMP,
-                    "dedupe_key": f"AGENDADA_{doc_notificacao.id}"
-                })
-
-                # HÍBRIDO: Tenta Web Push VAPID primeiro, depois FCM como fallback
-                data_payload = {"tipo": "LEMBRETE_AGENDADO", "notificacao_agendada_id": doc_notificacao.id}
-                webpush_tag = f"LEMBRETE_AGENDADO-{doc_notificacao.id}-paciente-{paciente_id}"
-                enviado_vapid = False
-
-                # 1. Tentar Web Push VAPID
-                webpush_subscription = paciente_data.get('webpush_subscription_exames')
-                if webpush_subscription:
-                    try:
-                        from pywebpush import webpush, WebPushException
-                        from vapid_config import VAPID_PRIVATE_KEY, VAPID_CLAIMS_EMAIL
-                        import json
-
-                        payload = json.dumps({
-                            "title": titulo,
-                            "body": mensagem,
-                            "data": data_payload,
-                            "tag": webpush_tag
-                        })
-
-                        webpush(
-                            subscription_info={
-                                "endpoint": webpush_subscription["endpoint"],
-                                "keys": webpush_subscription["keys"]
-                            },
-                            data=payload,
-                            vapid_private_key=VAPID_PRIVATE_KEY,
-                            vapid_claims={"sub": VAPID_CLAIMS_EMAIL}
-                        )
-
-                        enviado_vapid = True
-                        logger.info(f"✅ LEMBRETE_AGENDADO enviado via Web Push para {paciente_id}")
-
-                    except WebPushException as e:
-                        logger.error(f"❌ Erro Web Push para {paciente_id}: {e}")
-                        if e.response and e.response.status_code == 410:
-                            paciente_doc.reference.update({"webpush_subscription_exames": firestore.DELETE_FIELD})
-                    except Exception as e:
-                        logger.error(f"❌ Erro Web Push para {paciente_id}: {e}")
-
-                # 2. Fallback: FCM (se VAPID não enviou)
-                if not enviado_vapid and tokens_fcm:
-                    try:
-                        from firebase_admin import messaging
-
-                        message = messaging.MulticastMessage(
-                            notification=messaging.Notification(
-                                title=titulo,
-                                body=mensagem
-                            ),
-                            data=data_payload,
-                            tokens=tokens_fcm
-                        )
-
-                        response = messaging.send_multicast(message)
-                        logger.info(f"✅ LEMBRETE_AGENDADO enviado via FCM: {response.success_count} sucessos")
-
-                        # Remover tokens inválidos
-                        if response.failure_count > 0:
-                            valid_tokens = []
-                            for idx, resp in enumerate(response.responses):
-                                if resp.success:
-                                    valid_tokens.append(tokens_fcm[idx])
-                                else:
-                                    logger.warning(f"Token FCM inválido removido: {resp.exception}")
-
-                            if len(valid_tokens) != len(tokens_fcm):
-                                db.collection('usuarios').document(paciente_id).update({
-                                    "fcm_tokens": valid_tokens
-                                })
-
-                    except Exception as e:
-                        logger.error(f"Erro ao enviar push notification: {e}")
-
-                # Marcar notificação como enviada
-                doc_notificacao.reference.update({
-                    "status": "enviada",
-                    "data_envio": firestore.SERVER_TIMESTAMP
-                })
-
-                stats["notificacoes_enviadas"] += 1
-                logger.info(f"Notificação {doc_notificacao.id} enviada com sucesso")
-
-            except Exception as e:
-                logger.error(f"Erro ao processar notificação {doc_notificacao.id}: {e}")
-                stats["notificacoes_erro"] += 1
-                try:
-                    doc_notificacao.reference.update({
-                        "status": "erro",
-                        "erro": str(e),
-                        "data_erro": firestore.SERVER_TIMESTAMP
-                    })
-                except:
-                    pass
-
-        return stats
-
-    except Exception as e:
-        logger.error(f"Erro geral no processamento de notificações: {e}")
-        stats["notificacoes_erro"] += 1
-        return stats
-
-
 @app.post("/tasks/process-overdue-v2", response_model=schemas.ProcessarTarefasResponse, tags=["Jobs Agendados"])
 def process_overdue_tasks_v2(db: firestore.client = Depends(get_db)):
     """
@@ -2903,6 +2925,12 @@ def process_overdue_tasks_v2(db: firestore.client = Depends(get_db)):
         except Exception as e:
             logger.error(f"Erro no processamento de lembretes de exames: {e}")
 
+        try:
+            logger.info("Iniciando envio de resumos de notificações coalescidas")
+            stats.update(crud.processar_notificacoes_coalescidas(db, now))
+        except Exception as e:
+            logger.error(f"Erro no envio de resumos de notificações coalescidas: {e}")
+
     except Exception as e:
         stats["erros"] += 1
         logger.error(f"Erro geral no job agendado: {e}")
@@ -2910,6 +2938,120 @@ def process_overdue_tasks_v2(db: firestore.client = Depends(get_db)):
     logger.info(f"Processamento de jobs concluído: {stats}")
     return stats
 
+@app.post("/tasks/migrar-reservas-agendamentos", tags=["Jobs Agendados"])
+def migrar_reservas_agendamentos_endpoint(db: firestore.client = Depends(get_db)):
+    """
+    Migração única (idempotente) que cria as reservas de horário dos agendamentos futuros ativos.
+    """
+    try:
+        return crud.migrar_reservas_agendamentos(db)
+    except Exception as e:
+        logger.error(f"Erro ao migrar reservas de agendamentos: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/tasks/migrar-device-tokens", tags=["Jobs Agendados"])
+def migrar_device_tokens_endpoint(db: firestore.client = Depends(get_db)):
+    """
+    Migração única (idempotente) dos arrays de tokens dos usuários para a coleção `device_tokens`.
+    """
+    try:
+        return crud.migrar_tokens_para_registro(db)
+    except Exception as e:
+        logger.error(f"Erro ao migrar tokens para o registro de dispositivos: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/tasks/migrar-campos-notificacoes", tags=["Jobs Agendados"])
+def migrar_campos_notificacoes_endpoint(db: firestore.client = Depends(get_db)):
+    """
+    Migração única (idempotente) que normaliza os campos legados das notificações (titulo/corpo -> title/body).
+    """
+    try:
+        return crud.migrar_campos_notificacoes(db)
+    except Exception as e:
+        logger.error(f"Erro ao migrar campos das notificações: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/tasks/consolidar-contadores-postagens", tags=["Jobs Agendados"])
+def consolidar_contadores_postagens_endpoint(db: firestore.client = Depends(get_db)):
+    """
+    (PÚBLICO) Soma os shards de curtidas/comentários das postagens alteradas e atualiza os totais exibidos no feed.
+    Deve ser agendado no Cloud Scheduler com alta frequência (ex.: a cada minuto).
+    """
+    try:
+        return crud.consolidar_contadores_postagens(db)
+    except Exception as e:
+        logger.error(f"Erro ao consolidar contadores das postagens: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/tasks/varrer-postagens-orfas", tags=["Jobs Agendados"])
+def varrer_postagens_orfas_endpoint(db: firestore.client = Depends(get_db)):
+    """
+    (PÚBLICO) Retoma exclusões em cascata de postagens que falharam ou pararam no meio.
+    Deve ser agendado no Cloud Scheduler com baixa frequência (ex.: diariamente).
+    """
+    try:
+        return crud.varrer_postagens_orfas(db)
+    except Exception as e:
+        logger.error(f"Erro na varredura de postagens órfãs: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/tasks/migrar-subcolecoes-orfas-postagens", tags=["Jobs Agendados"])
+def migrar_subcolecoes_orfas_postagens_endpoint(db: firestore.client = Depends(get_db)):
+    """
+    Migração única (manual) que apaga curtidas/comentários de postagens apagadas antes da exclusão em cascata.
+    Percorre todas as curtidas e comentários da plataforma; não agendar.
+    """
+    try:
+        return crud.migrar_subcolecoes_orfas_postagens(db)
+    except Exception as e:
+        logger.error(f"Erro na migração de subcoleções órfãs de postagens: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/tasks/recalcular-resumos-avaliacoes", tags=["Jobs Agendados"])
+def recalcular_resumos_avaliacoes_endpoint(db: firestore.client = Depends(get_db)):
+    """
+    Migração/reconciliação (idempotente) que recalcula o resumo de avaliações de cada profissional.
+    """
+    try:
+        return crud.recalcular_resumos_avaliacoes(db)
+    except Exception as e:
+        logger.error(f"Erro ao recalcular resumos de avaliações: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/tasks/sincronizar-thumbnails-postagens", tags=["Jobs Agendados"])
+def sincronizar_thumbnails_postagens_endpoint(db: firestore.client = Depends(get_db)):
+    """
+    Migração única (idempotente) que copia a miniatura atual de cada profissional para as suas postagens.
+    """
+    try:
+        return crud.sincronizar_thumbnails_postagens(db)
+    except Exception as e:
+        logger.error(f"Erro ao sincronizar miniaturas das postagens: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/tasks/reconciliar-contadores-notificacoes", tags=["Jobs Agendados"])
+def reconciliar_contadores_notificacoes_endpoint(db: firestore.client = Depends(get_db)):
+    """
+    (PÚBLICO) Recalcula o contador `unread_count` de cada usuário com agregação count().
+    Deve ser agendado no Cloud Scheduler com baixa frequência (ex.: diariamente).
+    """
+    try:
+        return crud.reconciliar_contadores_nao_lidas(db)
+    except Exception as e:
+        logger.error(f"Erro ao reconciliar contadores de notificações: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/tasks/arquivar-notificacoes", tags=["Jobs Agendados"])
+def arquivar_notificacoes_endpoint(db: firestore.client = Depends(get_db)):
+    """
+    (PÚBLICO) Move notificações lidas mais antigas que NOTIFICACOES_RETENCAO_DIAS para o arquivo mensal.
+    """
+    try:
+        return crud.arquivar_notificacoes_antigas(db)
+    except Exception as e:
+        logger.error(f"Erro ao arquivar notificações: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.post("/processar-lembretes-exames", tags=["Jobs Agendados"])
 def processar_lembretes_exames_endpoint(db: firestore.client = Depends(get_db)):
     """
@@ -2936,15 +3078,34 @@ def test_notificacao_paciente(paciente_id: str, db: firestore.client = Depends(g
             raise HTTPException(status_code=404, detail="Paciente não encontrado")
 
         paciente_data = paciente_doc.to_dict()
-        fcm_tokens = paciente_data.get('fcm_tokens', [])
+        fcm_tokens, _ = crud.buscar_tokens_do_usuario(db, paciente_id)
+        webpush_subscription = paciente_data.get('webpush_subscription_exames')
 
-        if not fcm_tokens:
-            return {"erro": "Paciente não tem FCM tokens registrados"}
+        if not fcm_tokens and not webpush_subscription:
+            return {"erro": "Paciente não tem FCM tokens nem subscription Web Push registrados"}
 
         titulo = "Teste de Notificação"
         corpo = "Esta é uma notificação de teste do sistema."
 
         resultados = []
+        if webpush_subscription:
+            from webpush_service import get_webpush_service
+
+            webpush_service = get_webpush_service()
+            status_envio = webpush_service.send_notification(webpush_subscription, {
+                "title": titulo,
+                "body": corpo,
+                "data": {"tipo": "TESTE", "paciente_id": paciente_id},
+                "tag": f"TESTE-paciente-{paciente_id}"
+            })
+            if webpush_service.subscription_invalida(status_envio):
+                paciente_doc.reference.update({"webpush_subscription_exames": firestore.DELETE_FIELD})
+            resultados.append({
+                "canal": "vapid",
+                "status": "enviado" if webpush_service.sucesso(status_envio) else "erro",
+                "http_status": status_envio
+            })
+
         for token in fcm_tokens:
             try:
                 message = messaging.Message(
@@ -2960,6 +3121,7 @@ def test_notificacao_paciente(paciente_id: str, db: firestore.client = Depends(g
         return {
             "paciente_id": paciente_id,
             "total_tokens": len(fcm_tokens),
+            "webpush_vapid": bool(webpush_subscription),
             "resultados": resultados
         }
     except HTTPException:
@@ -3335,9 +3497,7 @@ async def processar_lembrete_exame(
                 exame_id=payload.exame_id
             )
 
-        paciente_data = paciente_doc.to_dict()
-        fcm_tokens = paciente_data.get('fcm_tokens', [])
-        apns_tokens = paciente_data.get('apns_tokens', [])
+        fcm_tokens, apns_tokens = crud.buscar_tokens_do_usuario(db, payload.paciente_id)
         print(f"✅ [LEMBRETE EXAME] Paciente encontrado. FCM tokens: {len(fcm_tokens)}, APNs tokens: {len(apns_tokens)}")
 
         if not fcm_tokens and not apns_tokens:
@@ -121,35 +121,3 @@ def enviar_notificacao_hibrida(
 
     return resultado
 
-
-def enviar_notificacao_para_usuario(
-    usuario_data: Dict,
-    titulo: str,
-    corpo: str,
-    data_payload: Optional[Dict[str, str]] = None,
-    webpush_tag: Optional[str] = None
-) -> Dict[str, int]:
-    """
-    Versão simplificada: recebe o dicionário do usuário e envia para todos os tokens dele.
-
-    Args:
-        usuario_data: Dicionário do documento do usuário do Firestore
-        titulo: Título da notificação
-        corpo: Corpo da notificação
-        data_payload: Dados extras
-        webpush_tag: Tag WebPush (opcional)
-
-    Returns:
-        Dicionário com contadores de envio
-    """
-    fcm_tokens = usuario_data.get('fcm_tokens', [])
-    apns_tokens = usuario_data.get('apns_tokens', [])
-
-    return enviar_notificacao_hibrida(
-        fcm_tokens=fcm_tokens,
-        apns_tokens=apns_tokens,
-        titulo=titulo,
-        corpo=corpo,
-        data_payload=data_payload,
-        webpush_tag=webpush_tag
-    )
@@ -0,0 +1,183 @@
+"""
+Stream de Notificações (Server-Sent Events)
+Mantém UM listener Firestore (on_snapshot) por usuário, compartilhado entre todas
+as conexões SSE abertas por ele, e repassa para cada conexão:
+
+    event: contagem       -> {"count": 3, "delta": 1}      (campo unread_count do usuário)
+    event: notificacao    -> notificação nova no histórico
+    event: notificacao_atualizada -> notificação existente alterada (lida, resumo coalescido...)
+
+Comentários `: heartbeat` são enviados periodicamente para manter a conexão viva
+através de proxies. O número de usuários com listener ativo por processo é limitado.
+
+USO (main.py):
+    gerador = notification_stream.abrir_stream(db, current_user.id, request)
+    return StreamingResponse(gerador, media_type="text/event-stream")
+"""
+
+import asyncio
+import json
+import logging
+import os
+import threading
+from datetime import datetime
+from typing import Any, AsyncGenerator, Dict, Optional, Tuple
+
+from firebase_admin import firestore
+
+logger = logging.getLogger(__name__)
+
+SSE_MAX_OUVINTES = int(os.getenv('SSE_MAX_OUVINTES', '500'))
+SSE_HEARTBEAT_SEGUNDOS = int(os.getenv('SSE_HEARTBEAT_SEGUNDOS', '25'))
+SSE_RETRY_MS = 5000
+# Janela de notificações recentes observada para detectar novidades
+SSE_JANELA_NOTIFICACOES = 10
+
+
+class LimiteOuvintesAtingido(Exception):
+    """Este processo já está com o número máximo de usuários conectados."""
+
+
+def _serializar(valor: Any) -> Any:
+    if isinstance(valor, datetime):
+        return valor.isoformat()
+    if isinstance(valor, dict):
+        return {chave: _serializar(v) for chave, v in valor.items()}
+    if isinstance(valor, list):
+        return [_serializar(v) for v in valor]
+    return valor
+
+
+class _OuvinteUsuario:
+    """Listener Firestore de um usuário, compartilhado entre suas conexões SSE."""
+
+    def __init__(self, db: firestore.client, usuario_id: str):
+        self.usuario_id = usuario_id
+        self.assinaturas: Dict[int, Tuple[asyncio.AbstractEventLoop, asyncio.Queue]] = {}
+        self.unread_count: Optional[int] = None
+        self._snapshot_inicial = True
+
+        usuario_ref = db.collection('usuarios').document(usuario_id)
+        self._watch_usuario = usuario_ref.on_snapshot(self._on_usuario)
+        self._watch_notificacoes = usuario_ref.collection('notificacoes')\
+            .order_by('data_criacao', direction=firestore.Query.DESCENDING)\
+            .limit(SSE_JANELA_NOTIFICACOES)\
+            .on_snapshot(self._on_notificacoes)
+
+    def _publicar(self, evento: str, dados: Dict):
+        # Callbacks do Firestore rodam em outra thread: copia as assinaturas sob o lock
+        with _ouvintes_lock:
+            assinaturas = list(self.assinaturas.values())
+        for loop, fila in assinaturas:
+            loop.call_soon_threadsafe(fila.put_nowait, (evento, dados))
+
+    def _on_usuario(self, docs, changes, read_time):
+        if not docs or not docs[0].exists:
+            return
+        unread = max((docs[0].to_dict() or {}).get('unread_count', 0) or 0, 0)
+        if unread == self.unread_count:
+            return
+        delta = unread - self.unread_count if self.unread_count is not None else 0
+        self.unread_count = unread
+        self._publicar('contagem', {"count": unread, "delta": delta})
+
+    def _on_notificacoes(self, docs, changes, read_time):
+        # O primeiro snapshot traz as notificações que já existiam
+        if self._snapshot_inicial:
+            self._snapshot_inicial = False
+            return
+        for change in changes:
+            tipo = change.type.name
+            if tipo not in ('ADDED', 'MODIFIED'):
+                continue
+            dados = change.document.to_dict() or {}
+            dados['id'] = change.document.id
+            evento = 'notificacao' if tipo == 'ADDED' else 'notificacao_atualizada'
+            self._publicar(evento, _serializar(dados))
+
+    def fechar(self):
+        for watch in (self._watch_usuario, self._watch_notificacoes):
+            try:
+                watch.unsubscribe()
+            except Exception as e:
+                logger.warning(f"⚠️ Erro ao encerrar listener do usuário {self.usuario_id}: {e}")
+
+
+_ouvintes: Dict[str, _OuvinteUsuario] = {}
+_ouvintes_lock = threading.Lock()
+
+
+def _assinar(db: firestore.client, usuario_id: str, loop: asyncio.AbstractEventLoop, fila: asyncio.Queue) -> int:
+    with _ouvintes_lock:
+        ouvinte = _ouvintes.get(usuario_id)
+        if ouvinte is None:
+            if len(_ouvintes) >= SSE_MAX_OUVINTES:
+                raise LimiteOuvintesAtingido()
+            ouvinte = _OuvinteUsuario(db, usuario_id)
+            _ouvintes[usuario_id] = ouvinte
+            logger.info(f"📡 Listener de notificações aberto para {usuario_id} (ativos: {len(_ouvintes)})")
+        assinatura_id = id(fila)
+        ouvinte.assinaturas[assinatura_id] = (loop, fila)
+
+        # A nova conexão recebe a contagem atual sem esperar mudança
+        if ouvinte.unread_count is not None:
+            fila.put_nowait(('contagem', {"count": ouvinte.unread_count, "delta": 0}))
+        return assinatura_id
+
+
+def _cancelar(usuario_id: str, assinatura_id: int):
+    with _ouvintes_lock:
+        ouvinte = _ouvintes.get(usuario_id)
+        if ouvinte is None:
+            return
+        ouvinte.assinaturas.pop(assinatura_id, None)
+        if ouvinte.assinaturas:
+            return
+        _ouvintes.pop(usuario_id, None)
+        ativos = len(_ouvintes)
+    # Fora do lock: encerrar o watch espera a thread de callbacks, que usa o lock em _publicar
+    ouvinte.fechar()
+    logger.info(f"📡 Listener de notificações encerrado para {usuario_id} (ativos: {ativos})")
+
+
+def _verificar_capacidade(usuario_id: str):
+    with _ouvintes_lock:
+        if usuario_id not in _ouvintes and len(_ouvintes) >= SSE_MAX_OUVINTES:
+            raise LimiteOuvintesAtingido()
+
+
+def abrir_stream(db: firestore.client, usuario_id: str, request) -> AsyncGenerator[str, None]:
+    """
+    Devolve o gerador SSE da conexão. Levanta LimiteOuvintesAtingido antes de a
+    resposta começar, se o processo estiver cheio.
+
+    A conexão só é registrada no listener do usuário quando o gerador começa a ser
+    consumido, e o `finally` do gerador a remove: uma resposta que nunca chega a
+    iniciar o stream não deixa listener aberto.
+    """
+    _verificar_capacidade(usuario_id)
+    loop = asyncio.get_running_loop()
+
+    async def _gerar() -> AsyncGenerator[str, None]:
+        fila: asyncio.Queue = asyncio.Queue()
+        yield f"retry: {SSE_RETRY_MS}\n\n"
+        try:
+            assinatura_id = _assinar(db, usuario_id, loop, fila)
+        except LimiteOuvintesAtingido:
+            # Processo lotou entre a verificação e o início do stream: o cliente reconecta
+            logger.warning(f"⚠️ Limite de listeners atingido ao iniciar o stream de {usuario_id}")
+            return
+        try:
+            while True:
+                if await request.is_disconnected():
+                    break
+                try:
+                    evento, dados = await asyncio.wait_for(fila.get(), timeout=SSE_HEARTBEAT_SEGUNDOS)
+                except asyncio.TimeoutError:
+                    yield ": heartbeat\n\n"
+                    continue
+                yield f"event: {evento}\ndata: {json.dumps(dados, ensure_ascii=False)}\n\n"
+        finally:
+            _cancelar(usuario_id, assinatura_id)
+
+    return _gerar()
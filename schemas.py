@@ -176,6 +176,7 @@ class ProfissionalResponse(ProfissionalBase):
     servicos: List['ServicoResponse'] = []
     postagens: List['PostagemResponse'] = []
     avaliacoes: List['AvaliacaoResponse'] = []
+    avaliacoes_resumo: Optional['AvaliacoesResumo'] = None
 
 class ProfissionalUpdate(BaseModel):
     especialidades: Optional[str] = None
@@ -254,9 +255,10 @@ class PostagemResponse(PostagemCreate):
     data_postagem: datetime
     profissional_nome: str
     profissional_foto_thumbnail: Optional[str] = None
-    total_curtidas: int = 0
-    total_comentarios: int = 0
+    total_curtidas: int = Field(0, description="Total consolidado periodicamente a partir dos shards; pode atrasar alguns minutos em relação às curtidas.")
+    total_comentarios: int = Field(0, description="Total consolidado periodicamente a partir dos shards; pode atrasar alguns minutos em relação aos comentários.")
     curtido_pelo_usuario: bool = Field(False, description="Indica se o usuário autenticado curtiu.")
+    comentarios_recentes: List['ComentarioResponse'] = Field(default_factory=list, description="Prévia dos últimos comentários (quando solicitada).")
 
 class ComentarioCreate(BaseModel):
     negocio_id: str
@@ -281,6 +283,12 @@ class AvaliacaoResponse(AvaliacaoCreate):
     cliente_id: str
     cliente_nome: str
 
+class AvaliacoesResumo(BaseModel):
+    total: int = 0
+    soma: int = 0
+    media: float = 0.0
+    histograma: Dict[str, int] = Field(default_factory=dict, description="Quantidade de avaliações por nota ('1' a '5').")
+
 # =================================================================================
 # SCHEMAS DE GESTÃO CLÍNICA
 # =================================================================================
@@ -463,6 +471,18 @@ class Bloqueio(BaseModel):
     inicio: datetime
     fim: datetime
     motivo: Optional[str] = None
+
+class DisponibilidadeDia(BaseModel):
+    inicio: Optional[time] = None  # Primeiro slot do expediente (None = não atende no dia)
+    mapa: str = ""  # Caractere i: '1' se o slot inicio + i*duracao está livre, '0' se ocupado
+
+class DisponibilidadeProfissional(BaseModel):
+    profissional_id: str
+    dias: Dict[str, DisponibilidadeDia]  # Chave: data AAAA-MM-DD
+
+class DisponibilidadePeriodoResponse(BaseModel):
+    duracao_minutos: int
+    profissionais: List[DisponibilidadeProfissional]
     
 # =================================================================================
 # SCHEMAS DE NOTIFICAÇÕES
@@ -480,6 +500,27 @@ class NotificacaoResponse(BaseModel):
 class NotificacaoContagemResponse(BaseModel):
     count: int
 
+class ArquivoNotificacoesMesResponse(BaseModel):
+    mes: str = Field(..., description="Mês arquivado no formato AAAA-MM.")
+    total: int
+
+class NotificacaoArquivadaResponse(BaseModel):
+    id: str
+    title: str
+    body: str
+    tipo: Optional[str] = None
+    data_criacao: Optional[datetime] = None
+
+class AvisoNegocioCreate(BaseModel):
+    titulo: str = Field(..., min_length=1, max_length=200)
+    corpo: str = Field(..., min_length=1, max_length=1000)
+    roles: Optional[List[str]] = Field(None, description="Roles que devem receber o aviso. Vazio/nulo envia para todo o negócio.")
+
+class AvisoNegocioResponse(BaseModel):
+    id: str
+    topicos: List[str]
+    enviados: int
+
 class MarcarLidaRequest(BaseModel):
     notificacao_id: str
 
@@ -943,6 +984,7 @@ class ProcessarTarefasResponse(BaseModel):
 
 
 ProfissionalResponse.model_rebuild()
+PostagemResponse.model_rebuild()
 
 # =================================================================================
 # SCHEMAS PARA SOLICITAÇÃO DE EXCLUSÃO DE CONTA E DADOS
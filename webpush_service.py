@@ -0,0 +1,144 @@
+"""
+Serviço de Web Push VAPID (Lembretes de Exames / Notificações Agendadas)
+Carrega a chave VAPID uma única vez, reaproveita o JWT assinado para cada push
+service (audience) até perto da expiração e envia em paralelo sobre um pool de
+conexões HTTP compartilhado.
+
+USO:
+    from webpush_service import get_webpush_service
+
+    resultados = get_webpush_service().send_batch({
+        "usuario_1": (subscription, {"title": "...", "body": "...", "data": {...}, "tag": "..."}),
+    })
+    # resultados -> {"usuario_1": 201}
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from py_vapid import Vapid
+from pywebpush import WebPusher
+
+from vapid_config import VAPID_PRIVATE_KEY, VAPID_CLAIMS_EMAIL
+
+logger = logging.getLogger(__name__)
+
+WEBPUSH_MAX_WORKERS = int(os.getenv('WEBPUSH_MAX_WORKERS', '10'))
+WEBPUSH_TTL_SEGUNDOS = int(os.getenv('WEBPUSH_TTL_SEGUNDOS', '86400'))
+WEBPUSH_TIMEOUT_SEGUNDOS = 10
+
+# O JWT VAPID pode valer no máximo 24h; usamos 12h (mesmo padrão do pywebpush)
+# e renovamos alguns minutos antes de expirar.
+JWT_VALIDADE_SEGUNDOS = 12 * 60 * 60
+JWT_MARGEM_RENOVACAO_SEGUNDOS = 10 * 60
+
+# Respostas que indicam que a subscription não existe mais no push service
+STATUS_SUBSCRIPTION_INVALIDA = (404, 410)
+
+
+class WebPushService:
+    """Envia Web Push VAPID reaproveitando chave, assinatura e conexões."""
+
+    def __init__(self):
+        self._vapid = Vapid.from_string(private_key=VAPID_PRIVATE_KEY)
+        self._headers_por_audience: Dict[str, Tuple[Dict[str, str], int]] = {}
+        self._lock = threading.Lock()
+
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=WEBPUSH_MAX_WORKERS, pool_maxsize=WEBPUSH_MAX_WORKERS)
+        self._session.mount('https://', adapter)
+
+        self._executor = ThreadPoolExecutor(max_workers=WEBPUSH_MAX_WORKERS, thread_name_prefix='webpush')
+        logger.info("✅ WebPushService inicializado")
+
+    def _get_vapid_headers(self, endpoint: str) -> Dict[str, str]:
+        """Retorna o header Authorization VAPID do push service, assinando só quando necessário."""
+        parsed = urlparse(endpoint)
+        audience = f"{parsed.scheme}://{parsed.netloc}"
+        agora = int(time.time())
+
+        with self._lock:
+            cache = self._headers_por_audience.get(audience)
+            if cache and cache[1] - JWT_MARGEM_RENOVACAO_SEGUNDOS > agora:
+                return dict(cache[0])
+
+            expiracao = agora + JWT_VALIDADE_SEGUNDOS
+            headers = self._vapid.sign({"sub": VAPID_CLAIMS_EMAIL, "aud": audience, "exp": expiracao})
+            self._headers_por_audience[audience] = (headers, expiracao)
+            return dict(headers)
+
+    def send_notification(self, subscription: Dict, payload: Dict) -> int:
+        """
+        Envia um Web Push para uma subscription.
+
+        Args:
+            subscription: {"endpoint": "...", "keys": {"p256dh": "...", "auth": "..."}}
+            payload: Conteúdo entregue ao service worker (title, body, data, tag)
+
+        Returns:
+            Status HTTP retornado pelo push service (0 em caso de erro de rede/criptografia)
+        """
+        try:
+            endpoint = subscription["endpoint"]
+            response = WebPusher(
+                {"endpoint": endpoint, "keys": subscription["keys"]},
+                requests_session=self._session
+            ).send(
+                data=json.dumps(payload),
+                headers=self._get_vapid_headers(endpoint),
+                ttl=WEBPUSH_TTL_SEGUNDOS,
+                timeout=WEBPUSH_TIMEOUT_SEGUNDOS
+            )
+            if response.status_code >= 400:
+                logger.warning(f"⚠️ Web Push recusado ({response.status_code}): {response.text[:200]}")
+            return response.status_code
+        except Exception as e:
+            logger.warning(f"⚠️ Erro ao enviar Web Push: {e}")
+            return 0
+
+    def send_batch(self, envios: Dict[str, Tuple[Dict, Dict]]) -> Dict[str, int]:
+        """
+        Envia vários Web Push em paralelo.
+
+        Args:
+            envios: {chave: (subscription, payload)} — a chave costuma ser o ID do usuário
+
+        Returns:
+            {chave: status HTTP}
+        """
+        if not envios:
+            return {}
+        chaves = list(envios.keys())
+        status = self._executor.map(lambda chave: self.send_notification(*envios[chave]), chaves)
+        return dict(zip(chaves, status))
+
+    @staticmethod
+    def sucesso(status: int) -> bool:
+        return 200 <= status < 300
+
+    @staticmethod
+    def subscription_invalida(status: int) -> bool:
+        return status in STATUS_SUBSCRIPTION_INVALIDA
+
+
+# Instância global (singleton)
+_webpush_service: Optional[WebPushService] = None
+_webpush_service_lock = threading.Lock()
+
+
+def get_webpush_service() -> WebPushService:
+    """Retorna instância singleton do serviço Web Push VAPID."""
+    global _webpush_service
+    if _webpush_service is None:
+        with _webpush_service_lock:
+            if _webpush_service is None:
+                _webpush_service = WebPushService()
+    return _webpush_service